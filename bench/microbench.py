@@ -0,0 +1,592 @@
+# This is the microbenchmark suite for the e-book/server system
+# Written by: Ian Wong
+#
+# Times the hot paths of the server and reader on synthetic data made up with fixed
+# seeds, so that runs on different commits can be compared:
+#   server.*	ServerDB inserts and lookups, scaled by the number of posts in the database
+#   reader.*	ReaderDB lookups, scaled the same way
+#   book.*	loading / encoding the pages of a large generated book
+#   protocol.*	building, framing and parsing messages
+#   search.*	building the full-text index of a book, sealing a segment of the posts' index,
+#		and searching the books / posts
+#
+# Results are written as JSON. Given the JSON of an earlier run, benchmarks that got
+# slower by more than the threshold are flagged (and the exit status is 1).
+#
+# Usage: python microbench.py [--sizes 1000,10000,100000] [--repeat 5] [--output results.json]
+#                             [--baseline old.json] [--threshold 0.15] [--only server.]
+
+import argparse
+import subprocess
+import platform
+import tempfile
+import shutil
+import random
+import json
+import gc
+import sys
+import os
+import time
+from timeit import default_timer
+
+# Make the server, reader and the components they share importable
+rootDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(rootDir)
+sys.path.append(os.path.join(rootDir, 'server'))
+sys.path.append(os.path.join(rootDir, 'reader'))
+import server_ex
+import reader_ex
+from common.framing import encodeFrames, FrameDecoder
+
+# ----------------------------------------------------
+# CONSTANTS
+# ----------------------------------------------------
+
+# Shape of the generated library that posts are made on
+NUM_BOOKS = 20
+PAGES_PER_BOOK = 50
+LINES_PER_PAGE = 40
+
+# Shape of the large generated book that is loaded
+LARGE_BOOK_PAGES = 500
+LARGE_BOOK_LINES = 60
+
+# Words the generated books are made up of
+BOOK_WORDS = [ 'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'serve', 'exile', 'cunning', 'silence', 'home' ]
+
+# Number of lookups timed against a filled database
+NUM_LOOKUPS = 20000
+
+# Number of searches timed, and the matches asked for by each
+NUM_SEARCHES = 200
+SEARCH_LIMIT = 10
+
+# Makeup of the generated posts
+NUM_SENDERS = 1000
+CONTENT_LENGTH = 40
+
+# Words the posts searched through are made up of, the most common first. As in real text,
+# a word is picked about as often as the first one divided by its rank (Zipf's law), and
+# the vocabulary is filled out with rarer made up words.
+POST_WORDS = ('the of and to a in is it that was he for on as with his be at by i this had not are but '
+	'from or have an they which one you were her all she there would their we him been has when who '
+	'will more no if out so said what up its about into than them can only other new some could time '
+	'these two may then do first any my now such like our over man me even most made after also did '
+	'many before must through back years where much your way well down should because each just those '
+	'people how too little good very make world still own see men work long get here between both life '
+	'being under never day same another know while last might great old year off come since against '
+	'go came right used take three book page line read chapter story author reader ending').split()
+POST_VOCABULARY_SIZE = 20000
+POST_WORDS_PER_POST = (4, 20)
+
+DEFAULT_SIZES = '1000,10000,100000'
+
+# ----------------------------------------------------
+# CLASSES
+# ----------------------------------------------------
+
+# This class makes up the data the benchmarks run on, the same for a given seed
+class SyntheticData(object):
+
+	# Constructor given the seed, and the directory to generate books in
+	def __init__(self, seed, libraryDir):
+		self.seed = seed
+		self.libraryDir = libraryDir
+		self.booknames = [ 'benchbook%d' % i for i in range(NUM_BOOKS) ]
+		self.largeBookname = 'benchlarge'
+		self.posts = {}		# number of posts -> list of (postInfoString, postContentString)
+		self.serverDBs = {}	# number of posts -> ServerDB filled with them
+		self.wordServerDBs = {}	# number of posts -> ServerDB filled with posts made up of words
+		self.readerDBs = {}	# number of posts -> ReaderDB filled with them
+
+	# Write out the library of books (in the same layout as the server's books)
+	def generateLibrary(self):
+		rand = random.Random(self.seed)
+		for bookname in self.booknames:
+			self.generateBook(rand, bookname, PAGES_PER_BOOK, LINES_PER_PAGE)
+		self.generateBook(rand, self.largeBookname, LARGE_BOOK_PAGES, LARGE_BOOK_LINES)
+
+	# Write out a single book: a directory of pages '[bookname]/[bookname]_page[pagenum]',
+	# each line in the format: 3 spaces, line number, 1 space, line content
+	def generateBook(self, rand, bookname, numPages, numLines):
+		bookDir = os.path.join(self.libraryDir, bookname)
+		os.makedirs(bookDir)
+		for pageNum in range(1, numPages + 1):
+			pageFile = open(os.path.join(bookDir, bookname + '_page' + str(pageNum)), 'w')
+			for lineNum in range(1, numLines + 1):
+				line = ' '.join([ rand.choice(BOOK_WORDS) for i in range(12) ])
+				pageFile.write('   %d %s\n' % (lineNum, line))
+			pageFile.close()
+
+	# Load the library into the server, as its 'books'
+	def loadBooks(self):
+		cwd = os.getcwd()
+		os.chdir(self.libraryDir)
+		try:
+			server_ex.books = dict([ (bookname, server_ex.Book(bookname, 'Bench')) for bookname in self.booknames ])
+		finally:
+			os.chdir(cwd)
+
+	# Return 'numPosts' posts, as the strings a reader uploads:
+	# postInfoString: 	'#NewPostInfo#SenderName#BookName#PageNumber#LineNumber'
+	# postContentString: 	'#NewPostContent#Content'
+	def getNewPosts(self, numPosts):
+		if (numPosts not in self.posts):
+			rand = random.Random(self.seed + numPosts)
+			posts = []
+			for i in xrange(numPosts):
+				postInfoString = '#NewPostInfo#reader%d#%s#%d#%d' % (rand.randrange(NUM_SENDERS), \
+						rand.choice(self.booknames), rand.randint(1, PAGES_PER_BOOK), rand.randint(1, LINES_PER_PAGE))
+				postContentString = '#NewPostContent#' + ('%x' % rand.getrandbits(CONTENT_LENGTH * 4)).zfill(CONTENT_LENGTH)
+				posts.append((postInfoString, postContentString))
+			self.posts = { numPosts: posts }	# only keep one size at a time
+		return self.posts[numPosts]
+
+	# Return a server database filled with 'numPosts' posts
+	# NOTE: The database is shared by the benchmarks, which must not change it
+	def getServerDB(self, numPosts):
+		if (numPosts not in self.serverDBs):
+			serverDB = server_ex.ServerDB()
+			quiet = Quiet()
+			try:
+				for postInfoString, postContentString in self.getNewPosts(numPosts):
+					serverDB.insertPost(postInfoString, postContentString)
+			finally:
+				quiet.restore()
+			self.serverDBs = { numPosts: serverDB }		# only keep one size at a time
+		return self.serverDBs[numPosts]
+
+	# Return a server database filled with 'numPosts' posts whose content is made up of words
+	# (see POST_WORDS), for searching
+	# NOTE: The database is shared by the benchmarks, which must not change it
+	def getWordServerDB(self, numPosts):
+		if (numPosts not in self.wordServerDBs):
+			rand = random.Random(self.seed + numPosts)
+			syllables = [ 'ka', 'lo', 'mi', 'ren', 'tas', 'vo', 'lin', 'der', 'pa', 'su', 'gor', 'bel' ]
+			vocabulary = list(POST_WORDS)
+			while (len(vocabulary) < POST_VOCABULARY_SIZE):
+				vocabulary.append(''.join([ rand.choice(syllables) for i in range(rand.randint(2, 4)) ]))
+
+			serverDB = server_ex.ServerDB()
+			quiet = Quiet()
+			try:
+				for i in xrange(numPosts):
+					postInfoString = '#NewPostInfo#reader%d#%s#%d#%d' % (rand.randrange(NUM_SENDERS), \
+							rand.choice(self.booknames), rand.randint(1, PAGES_PER_BOOK), rand.randint(1, LINES_PER_PAGE))
+					words = [ vocabulary[int(len(vocabulary) ** rand.random()) - 1] \
+							for j in range(rand.randint(*POST_WORDS_PER_POST)) ]
+					serverDB.insertPost(postInfoString, '#NewPostContent#' + ' '.join(words))
+			finally:
+				quiet.restore()
+			serverDB.postIndex.join()
+			self.wordServerDBs = { numPosts: serverDB }	# only keep one size at a time
+		return self.wordServerDBs[numPosts]
+
+	# Return a reader database filled with the posts of the server database of 'numPosts' posts
+	# NOTE: The database is shared by the benchmarks, which must not change it
+	def getReaderDB(self, numPosts):
+		if (numPosts not in self.readerDBs):
+			serverDB = self.getServerDB(numPosts)
+			readerDB = reader_ex.ReaderDB()
+			for postID in serverDB.getAllPostIDs():
+				postInfoStr, postContentStr = serverDB.getPostAsStr(postID)[1].split('|', 1)
+				readerDB.insertPost(postInfoStr, postContentStr)
+			self.readerDBs = { numPosts: readerDB }		# only keep one size at a time
+		return self.readerDBs[numPosts]
+
+	# Return 'count' random (bookname, pagenum, linenum) locations
+	def getLocations(self, count, seed):
+		rand = random.Random(seed)
+		return [ (rand.choice(self.booknames), rand.randint(1, PAGES_PER_BOOK), rand.randint(1, LINES_PER_PAGE)) \
+			for i in xrange(count) ]
+
+# This class silences stdout (the server prints as it works) until restored
+class Quiet(object):
+
+	def __init__(self):
+		self.stdout = sys.stdout
+		self.devnull = open(os.devnull, 'w')
+		sys.stdout = self.devnull
+
+	def restore(self):
+		sys.stdout = self.stdout
+		self.devnull.close()
+
+# ----------------------------------------------------
+# BENCHMARKS
+# ----------------------------------------------------
+# Each benchmark is given the synthetic data and the number of posts, sets up whatever
+# it needs (untimed) and returns a tuple: (function to time, number of operations it does)
+
+def benchServerInsertPost(data, numPosts):
+	posts = data.getNewPosts(numPosts)
+	serverDB = server_ex.ServerDB()
+	def run():
+		for postInfoString, postContentString in posts:
+			serverDB.insertPost(postInfoString, postContentString)
+	return (run, numPosts)
+
+def benchServerGetPostsID(data, numPosts):
+	serverDB = data.getServerDB(numPosts)
+	pages = [ (bookname, pagenum) for bookname, pagenum, _ in data.getLocations(NUM_LOOKUPS, 1) ]
+	def run():
+		for bookname, pagenum in pages:
+			serverDB.getPostsID(bookname, pagenum)
+	return (run, len(pages))
+
+def benchServerGetPostAsStr(data, numPosts):
+	serverDB = data.getServerDB(numPosts)
+	rand = random.Random(data.seed)
+	allIDs = serverDB.getAllPostIDs()
+	postIDs = [ rand.choice(allIDs) for i in xrange(NUM_LOOKUPS) ]
+	def run():
+		for postID in postIDs:
+			serverDB.getPostAsStr(postID)
+	return (run, len(postIDs))
+
+def benchServerExportAsStr(data, numPosts):
+	serverDB = data.getServerDB(numPosts)
+	def run():
+		serverDB.exportAsStr()
+	return (run, numPosts)
+
+def benchServerGetPostsSince(data, numPosts):
+	serverDB = data.getServerDB(numPosts)
+	cursors = [ numPosts * i / 100 for i in range(100) ]
+	def run():
+		for cursor in cursors:
+			serverDB.getPostsSince(cursor)
+	return (run, len(cursors))
+
+def benchReaderInsertPost(data, numPosts):
+	serverDB = data.getServerDB(numPosts)
+	postStrs = [ serverDB.getPostAsStr(postID)[1].split('|', 1) for postID in serverDB.getAllPostIDs() ]
+	readerDB = reader_ex.ReaderDB()
+	def run():
+		for postInfoStr, postContentStr in postStrs:
+			readerDB.insertPost(postInfoStr, postContentStr)
+	return (run, numPosts)
+
+def benchReaderGetPostIDs(data, numPosts):
+	readerDB = data.getReaderDB(numPosts)
+	locations = data.getLocations(NUM_LOOKUPS, 2)
+	def run():
+		for bookname, pagenum, linenum in locations:
+			readerDB.getPostIDs(bookname, pagenum, linenum)
+	return (run, len(locations))
+
+def benchReaderConsultPostsStatus(data, numPosts):
+	readerDB = data.getReaderDB(numPosts)
+	locations = data.getLocations(NUM_LOOKUPS, 3)
+	def run():
+		for bookname, pagenum, linenum in locations:
+			readerDB.consultPostsStatus(bookname, pagenum, linenum)
+	return (run, len(locations))
+
+def benchBookLoad(data, numPosts):
+	def run():
+		cwd = os.getcwd()
+		os.chdir(data.libraryDir)
+		try:
+			server_ex.Book(data.largeBookname, 'Bench')
+		finally:
+			os.chdir(cwd)
+	return (run, LARGE_BOOK_PAGES)
+
+def benchBookLazyPages(data, numPosts):
+	cwd = os.getcwd()
+	os.chdir(data.libraryDir)
+	try:
+		book = server_ex.Book(data.largeBookname, 'Bench', server_ex.PageCache(LARGE_BOOK_PAGES / 10))
+	finally:
+		os.chdir(cwd)
+	rand = random.Random(data.seed)
+	pageNums = [ rand.randint(1, LARGE_BOOK_PAGES) for i in xrange(1000) ]
+	def run():
+		os.chdir(data.libraryDir)
+		try:
+			for pageNum in pageNums:
+				book.getPageObj(pageNum)
+		finally:
+			os.chdir(cwd)
+	return (run, len(pageNums))
+
+def benchPageGetContent(data, numPosts):
+	cwd = os.getcwd()
+	os.chdir(data.libraryDir)
+	try:
+		book = server_ex.Book(data.largeBookname, 'Bench')
+	finally:
+		os.chdir(cwd)
+	def run():
+		for pageNum in range(1, LARGE_BOOK_PAGES + 1):
+			book.getPageContent(pageNum)
+	return (run, LARGE_BOOK_PAGES)
+
+def benchProtocolFormatPost(data, numPosts):
+	serverDB = data.getServerDB(numPosts)
+	rows = [ serverDB.posts.getRow(row) for row in xrange(len(serverDB.posts)) ]
+	def run():
+		for row in rows:
+			serverDB.formatPost(row)
+	return (run, numPosts)
+
+def benchProtocolEncodeFrames(data, numPosts):
+	serverDB = data.getServerDB(numPosts)
+	msgs = [ serverDB.getPostAsStr(postID)[1] for postID in serverDB.getAllPostIDs() ]
+	def run():
+		encodeFrames(msgs)
+	return (run, numPosts)
+
+def benchProtocolDecodeFrames(data, numPosts):
+	serverDB = data.getServerDB(numPosts)
+	encoded = encodeFrames([ serverDB.getPostAsStr(postID)[1] for postID in serverDB.getAllPostIDs() ])
+	chunks = [ encoded[i:i + 65536] for i in xrange(0, len(encoded), 65536) ]
+	def run():
+		decoder = FrameDecoder()
+		for chunk in chunks:
+			decoder.feed(chunk)
+	return (run, numPosts)
+
+def benchSearchIndexBook(data, numPosts):
+	cwd = os.getcwd()
+	os.chdir(data.libraryDir)
+	try:
+		book = server_ex.Book(data.largeBookname, 'Bench')
+	finally:
+		os.chdir(cwd)
+	def run():
+		bookIndex = server_ex.BookSearchIndex()
+		bookIndex.addBook(book)
+		bookIndex.freeze()
+	return (run, LARGE_BOOK_PAGES * LARGE_BOOK_LINES)
+
+# Every word is on most lines of the generated book, so each search has thousands of matches
+def benchSearchBooks(data, numPosts):
+	cwd = os.getcwd()
+	os.chdir(data.libraryDir)
+	try:
+		bookIndex = server_ex.BookSearchIndex()
+		bookIndex.addBook(server_ex.Book(data.largeBookname, 'Bench'))
+		bookIndex.freeze()
+	finally:
+		os.chdir(cwd)
+	rand = random.Random(data.seed)
+	queries = [ rand.sample(BOOK_WORDS, rand.randint(1, 3)) for i in xrange(NUM_SEARCHES) ]
+	def run():
+		for terms in queries:
+			bookIndex.search(terms, SEARCH_LIMIT)
+	return (run, len(queries))
+
+def benchSearchPosts(data, numPosts):
+	serverDB = data.getServerDB(numPosts)
+	rand = random.Random(data.seed)
+	allIDs = serverDB.getAllPostIDs()
+	queries = [ server_ex.getSearchTerms(serverDB.getPost(rand.choice(allIDs))[1][1]) for i in xrange(NUM_SEARCHES) ]
+	def run():
+		for terms in queries:
+			serverDB.searchPosts(terms, SEARCH_LIMIT)
+	return (run, len(queries))
+
+# Searches for words picked from the posts, so common words such as 'the' are searched for
+# (alone and with others) about as often as they are written
+def benchSearchPostWords(data, numPosts):
+	serverDB = data.getWordServerDB(numPosts)
+	rand = random.Random(data.seed)
+	allIDs = serverDB.getAllPostIDs()
+	queries = []
+	for i in xrange(NUM_SEARCHES):
+		words = server_ex.getSearchTerms(serverDB.getPost(rand.choice(allIDs))[1][1])
+		queries.append(rand.sample(words, min(rand.randint(1, 3), len(words))))
+	def run():
+		for terms in queries:
+			serverDB.searchPosts(terms, SEARCH_LIMIT)
+	return (run, len(queries))
+
+# Seals a full segment of the posts' index, as the sealer thread does in the background
+# (it pauses every so often, which is timed as well)
+def benchSearchSealSegment(data, numPosts):
+	serverDB = data.getWordServerDB(numPosts)
+	segment = serverDB.postIndex.segments[0][1]
+	if (isinstance(segment, server_ex.ImpactIndex)):
+		segment = segment.index
+	avgLength = serverDB.postIndex.getAvgLength()
+	def run():
+		server_ex.ImpactIndex(segment, avgLength, serverDB.postIndex.pauseSealing)
+	return (run, len(segment))
+
+# Benchmarks, in the order they are run: (name, function, whether it scales with the number of posts)
+BENCHMARKS = [
+	('server.insertPost', benchServerInsertPost, True),
+	('server.getPostsID', benchServerGetPostsID, True),
+	('server.getPostAsStr', benchServerGetPostAsStr, True),
+	('server.getPostsSince', benchServerGetPostsSince, True),
+	('server.exportAsStr', benchServerExportAsStr, True),
+	('reader.insertPost', benchReaderInsertPost, True),
+	('reader.getPostIDs', benchReaderGetPostIDs, True),
+	('reader.consultPostsStatus', benchReaderConsultPostsStatus, True),
+	('book.load', benchBookLoad, False),
+	('book.lazyPages', benchBookLazyPages, False),
+	('page.getContent', benchPageGetContent, False),
+	('protocol.formatPost', benchProtocolFormatPost, True),
+	('protocol.encodeFrames', benchProtocolEncodeFrames, True),
+	('protocol.decodeFrames', benchProtocolDecodeFrames, True),
+	('search.indexBook', benchSearchIndexBook, False),
+	('search.books', benchSearchBooks, False),
+	('search.posts', benchSearchPosts, True),
+	('search.postWords', benchSearchPostWords, True),
+	('search.sealSegment', benchSearchSealSegment, True),
+]
+
+# ----------------------------------------------------
+# MAIN FUNCTIONS
+# ----------------------------------------------------
+
+# Run a single benchmark 'repeat' times, each time set up afresh
+# Returns a dict: { ops, best_s, median_s, ns_per_op }
+def runBenchmark(benchFunc, data, numPosts, repeat):
+	times = []
+	for i in range(repeat):
+		run, numOps = benchFunc(data, numPosts)
+
+		# Time it without the garbage collector (or the server's prints) getting in the way
+		gc.collect()
+		gc.disable()
+		quiet = Quiet()
+		try:
+			startTime = default_timer()
+			run()
+			times.append(default_timer() - startTime)
+		finally:
+			quiet.restore()
+			gc.enable()
+
+	times.sort()
+	return {
+		'ops': numOps,
+		'best_s': times[0],
+		'median_s': times[len(times) / 2],
+		'ns_per_op': times[0] / max(numOps, 1) * 1e9,
+	}
+
+# Run every (selected) benchmark, at every size
+# Returns a dict: { '[name][n=[size]]': result }
+def runSuite(data, sizes, repeat, only):
+	results = {}
+	for numPosts in sizes:
+		for name, benchFunc, scaled in BENCHMARKS:
+			if (only is not None and not any([ name.startswith(prefix) for prefix in only ])):
+				continue
+
+			# Benchmarks that do not depend on the number of posts are only run once
+			key = name
+			if (scaled):
+				key = '%s[n=%d]' % (name, numPosts)
+			elif (numPosts != sizes[0]):
+				continue
+
+			result = runBenchmark(benchFunc, data, numPosts, repeat)
+			results[key] = result
+			print "%-40s %12.0f ns/op %10d ops  best %.4fs" % (key, result['ns_per_op'], result['ops'], result['best_s'])
+			sys.stdout.flush()
+	return results
+
+# Compare results against those of an earlier run
+# Returns a list of the keys of the benchmarks that got slower by more than 'threshold'
+def compareResults(results, baseline, threshold):
+	regressions = []
+	print ""
+	print "%-40s %12s %12s %8s" % ('Benchmark', 'Base ns/op', 'Now ns/op', 'Change')
+	for key in sorted(results.keys()):
+		if (key not in baseline):
+			continue
+		old = baseline[key]['ns_per_op']
+		new = results[key]['ns_per_op']
+		change = (new - old) / max(old, 1e-9)
+		flag = ''
+		if (change > threshold):
+			flag = '  REGRESSION'
+			regressions.append(key)
+		elif (change < -threshold):
+			flag = '  improved'
+		print "%-40s %12.0f %12.0f %+7.1f%%%s" % (key, old, new, change * 100, flag)
+	return regressions
+
+# Return the commit the tree is at, if it can be found
+def getCommit():
+	try:
+		process = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], cwd=rootDir, \
+				stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		output = process.communicate()[0].strip()
+		if (process.returncode == 0):
+			return output
+	except OSError:
+		pass
+	return None
+
+# ----------------------------------------------------
+# MAIN PROCEDURE
+# ----------------------------------------------------
+
+def main():
+	parser = argparse.ArgumentParser(description='Microbenchmarks for the e-book forum server and reader.')
+	parser.add_argument('--sizes', default=DEFAULT_SIZES,
+			help="comma separated numbers of posts to scale the benchmarks to (eg. up to 10000000)")
+	parser.add_argument('--repeat', type=int, default=5, help="runs of each benchmark (the best is kept)")
+	parser.add_argument('--seed', type=int, default=0, help="seed the synthetic data is made from")
+	parser.add_argument('--only', default=None, help="comma separated prefixes of the benchmarks to run")
+	parser.add_argument('--output', default=None, help="file to write the results to, as JSON")
+	parser.add_argument('--baseline', default=None, help="results of an earlier run (JSON) to compare against")
+	parser.add_argument('--threshold', type=float, default=0.15,
+			help="fraction by which a benchmark may slow down before it is flagged")
+	options = parser.parse_args()
+
+	sizes = [ int(size) for size in options.sizes.split(',') ]
+	only = None
+	if (options.only is not None):
+		only = options.only.split(',')
+
+	# Make up the library to run against
+	libraryDir = tempfile.mkdtemp(prefix='microbench')
+	try:
+		data = SyntheticData(options.seed, libraryDir)
+		data.generateLibrary()
+		data.loadBooks()
+		results = runSuite(data, sizes, options.repeat, only)
+	finally:
+		shutil.rmtree(libraryDir)
+
+	report = {
+		'meta': {
+			'commit': getCommit(),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'seed': options.seed,
+			'sizes': sizes,
+			'repeat': options.repeat,
+		},
+		'results': results,
+	}
+	if (options.output is not None):
+		outputFile = open(options.output, 'w')
+		json.dump(report, outputFile, indent=2, sort_keys=True)
+		outputFile.close()
+		print "Results written to '%s'." % options.output
+
+	# Flag the benchmarks that have slowed down
+	if (options.baseline is not None):
+		baselineFile = open(options.baseline, 'r')
+		baseline = json.load(baselineFile)['results']
+		baselineFile.close()
+		regressions = compareResults(results, baseline, options.threshold)
+		if (len(regressions) > 0):
+			print "%d benchmark(s) slowed down by more than %.0f%%." % (len(regressions), options.threshold * 100)
+			sys.exit(1)
+		print "No regressions."
+
+# ----------------------------------------------------
+# RUNNING MAIN
+# ----------------------------------------------------
+if (__name__ == "__main__"):
+	main()
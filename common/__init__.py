@@ -0,0 +1 @@
+# Components shared by the e-book reader and server
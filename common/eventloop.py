@@ -0,0 +1,171 @@
+# This is a small event loop, for running many connections (and timers) on one thread
+# Written by: Ian Wong
+#
+# Sockets (or any object with a 'fileno') are registered with callbacks for when
+# they are readable / writable, and functions can be scheduled to run later.
+# The loop waits on all of them at once with 'poll', so nothing busy-waits.
+
+import select
+import errno
+import heapq
+import time
+
+# ----------------------------------------------------
+# CLASSES
+# ----------------------------------------------------
+
+# This class is a function scheduled to run on the loop (see EventLoop.callLater)
+class Timer(object):
+
+	# Constructor given the time to run at, the function (and its arguments) to run, and
+	# the loop it is scheduled on
+	def __init__(self, when, func, args, loop):
+		self.when = when
+		self.func = func
+		self.args = args
+		self.cancelled = False
+		self.loop = loop		# until taken off the loop's heap
+
+	# Stop the function from being run
+	def cancel(self):
+		if (not self.cancelled):
+			self.cancelled = True
+			if (self.loop is not None):
+				self.loop.timerCancelled()
+
+# This class runs callbacks for ready file descriptors and due timers, on a single thread
+# NOTE: Not thread-safe - it should only be used from the thread that runs it
+class EventLoop(object):
+
+	# Constructor
+	def __init__(self):
+		self.poller = select.poll()
+		self.readers = {}		# fd -> callback for when it is readable
+		self.writers = {}		# fd -> callback for when it is writable
+		self.timers = []		# heap of (when, sequence number, Timer)
+		self.numTimers = 0
+		self.numCancelled = 0		# cancelled timers still on the heap
+		self.running = False
+
+	# Call 'onReadable()' whenever the file object is readable (or closed)
+	def addReader(self, fileObj, onReadable):
+		fd = fileObj.fileno()
+		self.readers[fd] = onReadable
+		self.updateInterest(fd)
+
+	# Stop watching a file object for reading
+	def removeReader(self, fileObj):
+		fd = fileObj.fileno()
+		self.readers.pop(fd, None)
+		self.updateInterest(fd)
+
+	# Call 'onWritable()' whenever the file object is writable, until removed
+	def addWriter(self, fileObj, onWritable):
+		fd = fileObj.fileno()
+		self.writers[fd] = onWritable
+		self.updateInterest(fd)
+
+	# Stop watching a file object for writing
+	def removeWriter(self, fileObj):
+		fd = fileObj.fileno()
+		if (self.writers.pop(fd, None) is not None):
+			self.updateInterest(fd)
+
+	# Register (or unregister) a file descriptor with the events it is watched for
+	def updateInterest(self, fd):
+		eventMask = 0
+		if (fd in self.readers):
+			eventMask = eventMask | select.POLLIN
+		if (fd in self.writers):
+			eventMask = eventMask | select.POLLOUT
+		try:
+			self.poller.unregister(fd)
+		except KeyError:
+			pass
+		if (eventMask != 0):
+			self.poller.register(fd, eventMask)
+
+	# Run 'func(*args)' after 'delay' seconds
+	# Returns a Timer that can be cancelled
+	def callLater(self, delay, func, *args):
+		timer = Timer(time.time() + delay, func, args, self)
+		self.numTimers = self.numTimers + 1
+		heapq.heappush(self.timers, (timer.when, self.numTimers, timer))
+		return timer
+
+	# A timer on the heap has been cancelled - once they are most of it, the cancelled
+	# timers are dropped from the heap (rather than each kept until it is due)
+	def timerCancelled(self):
+		self.numCancelled = self.numCancelled + 1
+		if (self.numCancelled * 2 > len(self.timers)):
+			timers = []
+			for entry in self.timers:
+				if (entry[2].cancelled):
+					entry[2].loop = None
+				else:
+					timers.append(entry)
+			heapq.heapify(timers)
+			self.timers = timers
+			self.numCancelled = 0
+
+	# Take the next timer off the heap, and return it
+	def popTimer(self):
+		_, _, timer = heapq.heappop(self.timers)
+		timer.loop = None
+		if (timer.cancelled):
+			self.numCancelled = self.numCancelled - 1
+		return timer
+
+	# Run the loop until 'stop' is called
+	def run(self):
+		self.running = True
+		while self.running:
+			self.runOnce()
+
+	# Stop the loop (once the current callback returns)
+	def stop(self):
+		self.running = False
+
+	# Wait for (at most) 'timeout' seconds, or until the next timer is due,
+	# then run the callbacks of everything that is ready
+	def runOnce(self, timeout=None):
+
+		# Do not sleep past the next timer (one that was cancelled is just dropped)
+		while (len(self.timers) > 0 and self.timers[0][2].cancelled):
+			self.popTimer()
+		if (len(self.timers) > 0):
+			untilTimer = max(self.timers[0][0] - time.time(), 0)
+			if (timeout is None or untilTimer < timeout):
+				timeout = untilTimer
+
+		try:
+			if (timeout is None):
+				events = self.poller.poll()
+			else:
+				events = self.poller.poll(int(timeout * 1000) + 1)
+		except select.error, e:
+			if (e.args[0] == errno.EINTR):
+				return
+			raise
+
+		# An error or hang-up is handled by the reader (which then reads the close) - or by the
+		# writer, if the file object is only being written (whose write then fails), as poll
+		# reports it for as long as the file object is registered
+		for fd, event in events:
+			failed = (event & (select.POLLHUP | select.POLLERR | select.POLLNVAL))
+			hasReader = (fd in self.readers)
+			if (event & select.POLLIN or failed):
+				onReadable = self.readers.get(fd)
+				if (onReadable is not None):
+					onReadable()
+			if (event & select.POLLOUT or (failed and not hasReader)):
+				onWritable = self.writers.get(fd)
+				if (onWritable is not None):
+					onWritable()
+
+		# Run the timers that are due
+		now = time.time()
+		while (len(self.timers) > 0 and self.timers[0][0] <= now):
+			timer = self.popTimer()
+			if (not timer.cancelled):
+				timer.func(*timer.args)
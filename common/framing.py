@@ -0,0 +1,283 @@
+# This is the message framing layer shared by the e-book reader and server
+# Written by: Ian Wong
+#
+# Every message is sent over TCP as a frame:
+#   [4-byte big-endian payload length][payload]
+# where the payload is an ordinary '#'-delimited message string.
+# Frames let either side split a byte stream back into whole messages no
+# matter how TCP coalesces or splits the underlying segments.
+
+import socket
+import struct
+import errno
+import threading
+from collections import deque
+
+# ----------------------------------------------------
+# CONSTANTS
+# ----------------------------------------------------
+
+HEADER_FORMAT = '!I'				# unsigned 32-bit payload length
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECV_SIZE = 65536				# bytes requested from the socket per recv
+MAX_FRAME_SIZE = 64 * 1024 * 1024		# reject absurd lengths (corrupt stream)
+
+# ----------------------------------------------------
+# FUNCTIONS
+# ----------------------------------------------------
+
+# Encode a single message string as a frame
+def encodeFrame(msg):
+	return struct.pack(HEADER_FORMAT, len(msg)) + msg
+
+# Encode a list of message strings as one contiguous block of frames,
+# ready to be written with a single send
+def encodeFrames(msgs):
+	return ''.join([ encodeFrame(msg) for msg in msgs ])
+
+# Disable Nagle's algorithm on a TCP socket (other sockets, eg. Unix domain ones, are left alone)
+def disableNagle(sock):
+	if (sock.family in (socket.AF_INET, socket.AF_INET6)):
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+# ----------------------------------------------------
+# CLASSES
+# ----------------------------------------------------
+
+# Raised when the byte stream cannot be a valid sequence of frames
+class FrameError(Exception):
+	pass
+
+# This class incrementally rebuilds frames from arbitrary chunks of bytes
+# NOTE: Chunks are only joined once enough bytes for the next frame have arrived,
+# so a large frame delivered over many recv's is not re-copied on every chunk
+class FrameDecoder(object):
+
+	# Constructor
+	def __init__(self):
+		self.chunks = []		# received bytes not yet decoded
+		self.pending = 0		# total length of the chunks
+		self.needed = HEADER_SIZE	# bytes required before the next frame can complete
+
+	# Feed received bytes into the decoder
+	# Returns a list of all the frames (payloads) completed by this chunk
+	def feed(self, data):
+		self.chunks.append(data)
+		self.pending = self.pending + len(data)
+		if (self.pending < self.needed):
+			return []
+
+		buf = ''.join(self.chunks)
+		end = len(buf)
+		offset = 0
+		frames = []
+
+		# Decode as many whole frames as the buffer holds
+		while (end - offset >= HEADER_SIZE):
+			length = struct.unpack_from(HEADER_FORMAT, buf, offset)[0]
+			if (length > MAX_FRAME_SIZE):
+				raise FrameError("Frame of %d bytes exceeds maximum size." % length)
+			if (end - offset - HEADER_SIZE < length):
+				# Partial frame - wait for the rest of it
+				self.needed = HEADER_SIZE + length
+				break
+			start = offset + HEADER_SIZE
+			frames.append(buf[start:start + length])
+			offset = start + length
+		else:
+			self.needed = HEADER_SIZE
+
+		# Keep the undecoded remainder
+		rest = buf[offset:]
+		if (rest == ''):
+			self.chunks = []
+		else:
+			self.chunks = [rest]
+		self.pending = len(rest)
+
+		return frames
+
+# This class wraps a connected TCP socket so that whole messages are sent and received
+# NOTE: Sends are serialised with a lock, so several threads may send through the same
+# framed socket without interleaving their frames
+class FramedSocket(object):
+
+	# Constructor given a connected socket
+	def __init__(self, sock):
+		self.sock = sock
+		self.decoder = FrameDecoder()
+
+		# Every send is already a whole message - do not let Nagle's algorithm hold
+		# back small frames (such as stream acks) waiting for delayed ACKs
+		disableNagle(self.sock)
+
+		self.frames = deque()		# decoded frames not yet handed out
+		self.sendLock = threading.Lock()
+		self.closed = False
+
+		# Bytes sent / received through the socket so far
+		self.bytesSent = 0
+		self.bytesReceived = 0
+
+	# Allows the framed socket to be given to 'select'
+	def fileno(self):
+		return self.sock.fileno()
+
+	# Send a single message as a frame
+	def send(self, msg):
+		self.sendRaw(encodeFrame(msg))
+
+	# Send a list of messages as consecutive frames with a single write
+	def sendMany(self, msgs):
+		self.sendRaw(encodeFrames(msgs))
+
+	# Send bytes that are already encoded as frames
+	def sendRaw(self, data):
+		self.sendLock.acquire()
+		try:
+			self.sock.sendall(data)
+			self.bytesSent = self.bytesSent + len(data)
+		finally:
+			self.sendLock.release()
+
+	# Returns whether there are whole messages buffered, that can be obtained
+	# without reading from the socket
+	def hasFrames(self):
+		return (len(self.frames) > 0)
+
+	# Obtain the next whole message, blocking until one has arrived
+	# Returns an empty string when the connection has been closed
+	def recv(self):
+		while (len(self.frames) == 0):
+			if (self.closed):
+				return ''
+			try:
+				data = self.sock.recv(RECV_SIZE)
+			except socket.error:
+				data = ''
+			if (data == ''):
+				self.closed = True
+				return ''
+			self.bytesReceived = self.bytesReceived + len(data)
+			self.frames.extend(self.decoder.feed(data))
+		return self.frames.popleft()
+
+	# Shut the connection down (in both directions) - a thread blocked receiving on
+	# the socket will see the connection closed
+	def shutdown(self):
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+
+	# Close the underlying socket
+	def close(self):
+		self.closed = True
+		self.sock.close()
+
+# This class wraps a non-blocking TCP socket, for use inside an event loop
+# Sends are buffered and written out by 'flush' whenever the socket is writable,
+# and 'recvAvailable' decodes every whole frame that can be read without blocking
+class NonBlockingFramedSocket(object):
+
+	# Constructor given a connected socket, and an optional callback that is
+	# called (with this object) whenever output becomes pending
+	def __init__(self, sock, onPendingOutput=None):
+		self.sock = sock
+		self.sock.setblocking(0)
+		disableNagle(self.sock)
+		self.decoder = FrameDecoder()
+		self.outbuf = deque()		# encoded frames waiting to be written
+		self.onPendingOutput = onPendingOutput
+		self.closed = False
+
+		# Bytes sent / received through the socket so far
+		self.bytesSent = 0
+		self.bytesReceived = 0
+
+	# Allows the framed socket to be given to 'select' / 'poll'
+	def fileno(self):
+		return self.sock.fileno()
+
+	# Queue a single message to be sent as a frame
+	def send(self, msg):
+		self.sendRaw(encodeFrame(msg))
+
+	# Queue a list of messages to be sent as consecutive frames
+	def sendMany(self, msgs):
+		if (len(msgs) > 0):
+			self.sendRaw(encodeFrames(msgs))
+
+	# Queue bytes that are already encoded as frames
+	def sendRaw(self, data):
+		if (self.closed):
+			return
+		wasEmpty = (len(self.outbuf) == 0)
+		self.outbuf.append(data)
+		if (wasEmpty and self.onPendingOutput is not None):
+			self.onPendingOutput(self)
+
+	# Returns whether there is output waiting to be written
+	def hasPendingOutput(self):
+		return (len(self.outbuf) > 0)
+
+	# Write as much of the pending output as the socket will take
+	# Returns whether all of it has been written
+	def flush(self):
+		# Coalesce queued frames so they go out in as few writes as possible
+		if (len(self.outbuf) > 1):
+			data = ''.join(self.outbuf)
+			self.outbuf.clear()
+			self.outbuf.append(data)
+
+		while (len(self.outbuf) > 0 and not self.closed):
+			data = self.outbuf[0]
+			try:
+				numWritten = self.sock.send(data)
+			except socket.error, e:
+				if (e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)):
+					return False
+				self.closed = True
+				self.outbuf.clear()
+				break
+			self.bytesSent = self.bytesSent + numWritten
+			if (numWritten < len(data)):
+				self.outbuf[0] = data[numWritten:]
+				return False
+			self.outbuf.popleft()
+		return True
+
+	# Read everything that is available without blocking
+	# Returns a list of all the whole frames (payloads) received. Sets 'closed'
+	# if the connection has been closed.
+	def recvAvailable(self):
+		frames = []
+		while not self.closed:
+			try:
+				data = self.sock.recv(RECV_SIZE)
+			except socket.error, e:
+				if (e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)):
+					break
+				data = ''
+			if (data == ''):
+				self.closed = True
+				break
+			self.bytesReceived = self.bytesReceived + len(data)
+			frames.extend(self.decoder.feed(data))
+			if (len(data) < RECV_SIZE):
+				break
+		return frames
+
+	# Shut the connection down (in both directions) - the event loop will see the
+	# connection closed the next time it reads from the socket
+	def shutdown(self):
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+
+	# Close the underlying socket
+	def close(self):
+		self.closed = True
+		self.outbuf.clear()
+		self.sock.close()
@@ -0,0 +1,153 @@
+# This is a leveled logger that writes its records on a background thread
+# Written by: Ian Wong
+#
+# Logging a record neither formats nor writes anything: the record (time, level,
+# format string and arguments) is put on a queue, and a writer thread formats and
+# writes the records in batches. So the threads handling requests never block on
+# the terminal (or a file) however slow it is.
+#
+# Records below the logger's level are discarded straight away. Of those below
+# WARNING, only a sample ('sampleRate') is kept, for logging busy request paths
+# without logging every request. If the writer falls behind and the queue is full,
+# records are dropped (and counted) rather than holding up the caller.
+
+import sys
+import time
+import random
+import threading
+import Queue
+
+# ----------------------------------------------------
+# CONSTANTS
+# ----------------------------------------------------
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = { DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR' }
+LEVELS = dict([ (name.lower(), level) for level, name in LEVEL_NAMES.items() ])
+
+# ----------------------------------------------------
+# CLASSES
+# ----------------------------------------------------
+
+# This class is the logger - see above
+class AsyncLogger(object):
+
+	MAX_BATCH = 256		# most records written at once
+
+	# Constructor given the lowest level to log, the fraction of records below WARNING
+	# to keep, the stream to write to (None = the current sys.stdout) and the most
+	# records that may be waiting to be written
+	def __init__(self, level=INFO, sampleRate=1.0, stream=None, maxQueued=10000):
+		self.level = level
+		self.sampleRate = sampleRate
+		self.stream = stream
+		self.queue = Queue.Queue(maxQueued)
+		self.dropped = 0		# records dropped as the queue was full
+		self.sampledOut = 0		# records not kept by sampling
+		self.writerThread = None
+		self.startLock = threading.Lock()
+
+	# Set the lowest level to log
+	def setLevel(self, level):
+		self.level = level
+
+	# Set the fraction of records below WARNING to keep
+	def setSampleRate(self, sampleRate):
+		self.sampleRate = sampleRate
+
+	# Return whether records of a level would be logged (before sampling)
+	def isEnabledFor(self, level):
+		return (level >= self.level)
+
+	# Log a record: 'fmt % args' is only formatted by the writer thread
+	# NOTE: Arguments should not be changed after being logged
+	def log(self, level, fmt, *args):
+		if (level < self.level):
+			return
+		if (level < WARNING and self.sampleRate < 1.0 and random.random() >= self.sampleRate):
+			self.sampledOut += 1
+			return
+		if (self.writerThread is None):
+			self.start()
+		try:
+			self.queue.put_nowait((time.time(), level, fmt, args))
+		except Queue.Full:
+			self.dropped += 1
+
+	# Log a record at each level
+	def debug(self, fmt, *args):
+		self.log(DEBUG, fmt, *args)
+
+	def info(self, fmt, *args):
+		self.log(INFO, fmt, *args)
+
+	def warning(self, fmt, *args):
+		self.log(WARNING, fmt, *args)
+
+	def error(self, fmt, *args):
+		self.log(ERROR, fmt, *args)
+
+	# Start the writer thread (done when the first record is logged)
+	def start(self):
+		self.startLock.acquire()
+		try:
+			if (self.writerThread is None):
+				self.writerThread = threading.Thread(target=self.run)
+				self.writerThread.daemon = True
+				self.writerThread.start()
+		finally:
+			self.startLock.release()
+
+	# Start afresh in a forked child process - the writer thread (and any lock it held)
+	# was left behind in the parent. Records queued but not yet written are discarded.
+	def afterFork(self):
+		self.queue = Queue.Queue(self.queue.maxsize)
+		self.writerThread = None
+		self.startLock = threading.Lock()
+
+	# Write out the records logged so far, and stop the writer thread
+	def close(self, timeout=2.0):
+		if (self.writerThread is None):
+			return
+		self.queue.put(None)
+		self.writerThread.join(timeout)
+		self.writerThread = None
+
+	# Writer thread - format and write the records as they arrive, a batch at a time
+	def run(self):
+		while True:
+			batch = [ self.queue.get() ]
+			while (batch[-1] is not None and len(batch) < self.MAX_BATCH):
+				try:
+					batch.append(self.queue.get_nowait())
+				except Queue.Empty:
+					break
+
+			stopping = (batch[-1] is None)
+			if (stopping):
+				batch.pop()
+			self.write(batch)
+			if (stopping):
+				return
+
+	# Format and write a batch of records
+	def write(self, batch):
+		lines = []
+		for created, level, fmt, args in batch:
+			try:
+				message = (fmt % args) if args else fmt
+			except (TypeError, ValueError), e:
+				message = "%r %% %r (%s)" % (fmt, args, e)
+			lines.append("%s.%03d %-7s %s\n" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created)), \
+					int(created * 1000) % 1000, LEVEL_NAMES.get(level, level), message))
+
+		stream = self.stream or sys.stdout
+		try:
+			stream.write(''.join(lines))
+			stream.flush()
+		except (IOError, ValueError):
+			pass
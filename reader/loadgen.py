@@ -0,0 +1,510 @@
+# This is a headless load generator for the e-book/server system
+# Written by: Ian Wong
+#
+# Simulates many pull and push readers from a single process, all speaking the real
+# protocol to a server (see ReaderClient in reader_ex.py), then reports the throughput
+# and latency percentiles for each message type.
+#
+# Usage: python loadgen.py [server_name] [server_port] [--pull N] [--push N] [--duration S] ...
+# (see 'python loadgen.py --help')
+#
+# NOTE: Latencies are measured from the simulated readers, so they include the time
+# a response waits for this process to get to it - keep an eye on its CPU use.
+
+import socket
+import argparse
+import bisect
+import random
+import resource
+import json
+import sys
+import os
+import time
+
+# Make the reader and the components shared with the server importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from reader_ex import ReaderClient, DEFAULT_STREAM_WINDOW
+from common.eventloop import EventLoop
+
+# ----------------------------------------------------
+# CONSTANTS
+# ----------------------------------------------------
+
+# Actions a simulated reader takes, and their default weights
+ACTIONS = ['display', 'read', 'post', 'update', 'sync', 'chat']
+DEFAULT_MIX = 'display=40,read=30,post=15,update=10,sync=0,chat=5'
+
+# Prefix of the posts made by the load generator, followed by the time they were sent
+POST_PREFIX = 'load t='
+
+# ----------------------------------------------------
+# CLASSES
+# ----------------------------------------------------
+
+# This class collects the latencies measured for each message type
+class LatencyRecorder(object):
+
+	# Constructor given the time before which samples are not kept (warm up)
+	def __init__(self, startTime):
+		self.startTime = startTime
+		self.samples = {}		# message type -> [latency (seconds), ...]
+		self.counts = {}		# event name -> count (errors, local reads, chats etc.)
+
+	# Record the latency of a single message sent at 'sentTime'
+	def record(self, msgType, sentTime, now=None):
+		if (sentTime < self.startTime):
+			return
+		if (now is None):
+			now = time.time()
+		self.samples.setdefault(msgType, []).append(now - sentTime)
+
+	# Count an event
+	def count(self, name, amount=1):
+		self.counts[name] = self.counts.get(name, 0) + amount
+
+	# Summarise the samples over a run of 'elapsed' seconds
+	# Returns a dict: { message type: { count, per_sec, p50_ms, p95_ms, p99_ms, max_ms } }
+	def summarise(self, elapsed):
+		summary = {}
+		for msgType, latencies in self.samples.items():
+			latencies.sort()
+			summary[msgType] = {
+				'count': len(latencies),
+				'per_sec': len(latencies) / elapsed,
+				'p50_ms': percentile(latencies, 50) * 1000,
+				'p95_ms': percentile(latencies, 95) * 1000,
+				'p99_ms': percentile(latencies, 99) * 1000,
+				'max_ms': latencies[-1] * 1000,
+			}
+		return summary
+
+# This class is the set of pages that the simulated readers go to, some more than others:
+# the page of popularity rank r is chosen with weight 1 / r^skew (a Zipf distribution)
+class PagePicker(object):
+
+	# Constructor given a list of (bookname, pagenum, number of lines), the skew, and the
+	# random number generator that ranks the pages
+	def __init__(self, pages, skew, rng):
+		self.pages = list(pages)
+		rng.shuffle(self.pages)
+		self.cumulativeWeights = []
+		total = 0.0
+		for rank in range(1, len(self.pages) + 1):
+			total = total + 1.0 / (rank ** skew)
+			self.cumulativeWeights.append(total)
+
+	# Choose a page
+	# Returns (bookname, pagenum, number of lines)
+	def pick(self, rng):
+		point = rng.random() * self.cumulativeWeights[-1]
+		return self.pages[bisect.bisect_right(self.cumulativeWeights, point)]
+
+# This class is a single simulated reader
+# It starts off displaying a page, then keeps taking actions at random (with a random
+# think time in between), timing how long the server takes to answer each request.
+# NOTE: Requests of the same type on one connection are answered in order, so the time
+# each was sent is kept in a queue per type.
+class SimulatedReader(ReaderClient):
+
+	# Constructor given the load generator, the reader's number, and its mode
+	def __init__(self, loadGen, number, opmode):
+		options = loadGen.options
+		ReaderClient.__init__(self, loadGen.loop, 'load%d' % number, opmode, options.poll_interval, options.stream_window)
+		self.loadGen = loadGen
+		self.recorder = loadGen.recorder
+		self.rng = random.Random(options.seed * 100003 + number)
+		self.sentTimes = {}		# message type -> [time sent, ...] (oldest first)
+		self.pendingChats = set()	# user names of the readers asked to chat
+		self.numLines = 0		# lines on the current page
+		self.nextAction = None
+
+	# Start taking actions
+	def start(self):
+		if (self.opmode == 'push' and self.loadGen.options.push_scope != 'all'):
+			self.subscribeScope = self.loadGen.options.push_scope
+		self.act('display')
+
+	# Stop taking actions, and say goodbye to the server
+	def stop(self):
+		if (self.nextAction is not None):
+			self.nextAction.cancel()
+		if (self.isConnected()):
+			self.sendExit()
+
+	# Take a single action, then schedule the next
+	def act(self, action=None):
+		if (not self.isConnected()):
+			return
+		if (action is None):
+			action = self.loadGen.pickAction(self.rng)
+
+		if (action == 'display'):
+			bookName, pageNum, self.numLines = self.loadGen.pagePicker.pick(self.rng)
+			self.displayPage(bookName, pageNum)
+		elif (action == 'read'):
+			self.readPosts(self.rng.randint(1, self.numLines))
+			self.recorder.count('read (local)')
+		elif (action == 'post'):
+			self.postToForum(self.rng.randint(1, self.numLines), POST_PREFIX + '%.6f' % time.time())
+		elif (action == 'update'):
+			self.reqUpdateLocalPosts(self.currentBookname, self.currentPagenumber)
+		elif (action == 'sync'):
+			self.reqSyncPosts()
+		elif (action == 'chat'):
+			self.chatWithAnyone()
+
+		self.nextAction = self.loop.callLater(self.rng.expovariate(1.0 / self.loadGen.options.think_time), self.act)
+
+	# Chat with another reader, first asking them to chat if they have not been yet
+	def chatWithAnyone(self):
+		other = self.loadGen.pickReader(self.rng)
+		if (other is None or other is self):
+			return
+		if (self.sendChatMessage(other.userName, 'hello')):
+			self.recorder.count('chat messages sent')
+		elif (other.userName not in self.pendingChats):
+			self.pendingChats.add(other.userName)
+			self.reqChatSession(other.userName)
+
+	# Note when a request of the given type was sent
+	def sent(self, msgType):
+		self.sentTimes.setdefault(msgType, []).append(time.time())
+
+	# The answer to the oldest request of the given type has arrived
+	def answered(self, msgType):
+		sentTimes = self.sentTimes.get(msgType)
+		if (sentTimes):
+			self.recorder.record(msgType, sentTimes.pop(0))
+
+	# Record how long ago the posts (each in the format: #PostInfo...|#PostContent) were
+	# made, if they were made by the load generator
+	def delivered(self, msgType, postsData):
+		now = time.time()
+		for postData in postsData:
+			postContent = postData.split('|', 1)[1].split('#', 3)[3]
+			if (postContent.startswith(POST_PREFIX)):
+				self.recorder.record(msgType, float(postContent[len(POST_PREFIX):]), now)
+
+	# ----------------------------------------------------
+	# Requests (timed)
+	# ----------------------------------------------------
+
+	def reqDisplayPage(self, bookName, pageNum):
+		self.sent('DisplayReq')
+		ReaderClient.reqDisplayPage(self, bookName, pageNum)
+
+	def reqDisplayPageWithPosts(self, bookName, pageNum):
+		self.sent('DisplayPageReq')
+		ReaderClient.reqDisplayPageWithPosts(self, bookName, pageNum)
+
+	def sendNewPost(self, postInfoStr, postContentStr):
+		self.sent('UploadPost')
+		ReaderClient.sendNewPost(self, postInfoStr, postContentStr)
+
+	def reqUpdateLocalPosts(self, bookname, pagenum):
+		self.sent('GetPostsLocReq')
+		ReaderClient.reqUpdateLocalPosts(self, bookname, pagenum)
+
+	def reqSyncPosts(self):
+		self.sent('SyncPostsReq')
+		ReaderClient.reqSyncPosts(self)
+
+	def reqChatSession(self, targetUser):
+		self.sent('StartChatReq')
+		ReaderClient.reqChatSession(self, targetUser)
+
+	# ----------------------------------------------------
+	# Responses
+	# ----------------------------------------------------
+
+	def onDisplayResp(self, bookName, pageNum, pageContents):
+		self.answered('DisplayReq')
+		ReaderClient.onDisplayResp(self, bookName, pageNum, pageContents)
+
+	def onDisplayPageResp(self, bookName, pageNum, version, streamItems):
+		self.answered('DisplayPageReq')
+		ReaderClient.onDisplayPageResp(self, bookName, pageNum, version, streamItems)
+
+	def onPostUploaded(self, errorMsg):
+		self.answered('UploadPost')
+		if (errorMsg is not None):
+			self.recorder.count('UploadPost errors')
+
+	def onGetPostsLocResp(self, bookName, pageNum, unknownPosts):
+		self.answered('GetPostsLocReq')
+		ReaderClient.onGetPostsLocResp(self, bookName, pageNum, unknownPosts)
+
+	def onSyncPostsResp(self, cursor, unsyncedPosts):
+		self.answered('SyncPostsReq')
+		ReaderClient.onSyncPostsResp(self, cursor, unsyncedPosts)
+
+	# [Pull mode] Posts delivered by a page watch
+	def onPagePostsResp(self, bookName, pageNum, version, newPosts):
+		self.delivered('Watch delivery', newPosts)
+		ReaderClient.onPagePostsResp(self, bookName, pageNum, version, newPosts)
+
+	# [Push mode] A post delivered by the server as soon as it was made
+	def onPostPushed(self, postID, bookName, pageNum):
+		postInfo, postContent = self.readerDB.getPost(postID)
+		if (postContent.startswith(POST_PREFIX)):
+			self.recorder.record('Push delivery', float(postContent[len(POST_PREFIX):]))
+
+	def onDisplayError(self, errorMsg):
+		self.recorder.count('display errors')
+
+	# Accept every invitation to chat
+	def onChatInvite(self, aUsername, aIP, aChatport):
+		self.respondChatInvite(aUsername, aIP, aChatport, True)
+
+	def onChatResponse(self, response, detail):
+		self.answered('StartChatReq')
+		self.pendingChats.discard(detail)
+		if (response == 'Error'):
+			self.recorder.count('StartChatReq errors')
+
+	def onChatMessage(self, sender, chatMsg):
+		self.recorder.count('chat messages received')
+
+	def onUnknownMessage(self, data):
+		self.recorder.count('unknown messages')
+
+	def onDisconnected(self):
+		if (not self.loadGen.stopping):
+			self.recorder.count('disconnects')
+		self.loadGen.readerClosed(self)
+
+# This class runs the simulated readers, and reports on them
+class LoadGenerator(object):
+
+	# Constructor given the parsed command line options
+	def __init__(self, options):
+		self.options = options
+		self.loop = EventLoop()
+		self.rng = random.Random(options.seed)
+		self.recorder = LatencyRecorder(time.time() + options.ramp + options.warmup)
+		self.pagePicker = PagePicker(loadLibrary(options.library), options.skew, self.rng)
+		self.actions, self.cumulativeWeights = parseMix(options.mix)
+		self.readers = []
+		self.numOpen = 0
+		self.stopping = False
+		self.startTime = time.time()
+		self.measureStart = None
+		self.measureEnd = None
+
+	# Choose an action, by the weights of the mix
+	def pickAction(self, rng):
+		point = rng.random() * self.cumulativeWeights[-1]
+		return self.actions[bisect.bisect_right(self.cumulativeWeights, point)]
+
+	# Choose any connected reader
+	def pickReader(self, rng):
+		if (len(self.readers) == 0):
+			return None
+		reader = self.readers[rng.randrange(len(self.readers))]
+		if (not reader.isConnected()):
+			return None
+		return reader
+
+	# Run the readers, then report on them
+	def run(self):
+		options = self.options
+		numReaders = options.pull + options.push
+		print "Simulating %d pull and %d push readers against %s:%d for %ds..." % \
+			(options.pull, options.push, options.server_name, options.server_port, options.duration)
+
+		# Connect the readers gradually over the ramp up
+		for number in range(numReaders):
+			opmode = 'pull'
+			if (number >= options.pull):
+				opmode = 'push'
+			delay = options.ramp * number / max(numReaders, 1)
+			self.loop.callLater(delay, self.startReader, number, opmode)
+
+		self.loop.callLater(options.ramp + options.warmup, self.startMeasuring)
+		self.loop.callLater(options.ramp + options.warmup + options.duration, self.stop)
+		if (options.report_interval > 0):
+			self.loop.callLater(options.report_interval, self.reportProgress)
+		self.loop.run()
+
+		return self.report()
+
+	# Connect a single simulated reader, and start it off
+	def startReader(self, number, opmode):
+		if (self.stopping):
+			return
+		reader = SimulatedReader(self, number, opmode)
+		try:
+			reader.connect(self.options.server_name, self.options.server_port, '127.0.0.1')
+		except socket.error, e:
+			self.recorder.count('connect errors')
+			return
+		self.readers.append(reader)
+		self.numOpen = self.numOpen + 1
+		reader.start()
+
+	# The measurements start (once every reader is up and warmed up)
+	def startMeasuring(self):
+		self.measureStart = time.time()
+		print "Measuring (%d readers connected)..." % self.numOpen
+
+	# Print the number of requests answered so far
+	def reportProgress(self):
+		if (self.stopping):
+			return
+		numSamples = sum([ len(latencies) for latencies in self.recorder.samples.values() ])
+		print "%6.1fs: %d readers connected, %d responses measured" % \
+			(time.time() - self.startTime, self.numOpen, numSamples)
+		self.loop.callLater(self.options.report_interval, self.reportProgress)
+
+	# Stop every reader, waiting (a little) for the server to close their connections
+	def stop(self):
+		self.measureEnd = time.time()
+		self.stopping = True
+		for reader in self.readers:
+			reader.stop()
+		self.loop.callLater(5.0, self.loop.stop)
+		if (self.numOpen == 0):
+			self.loop.stop()
+
+	# A reader's connection has been closed
+	def readerClosed(self, reader):
+		self.numOpen = self.numOpen - 1
+		if (self.stopping and self.numOpen == 0):
+			self.loop.stop()
+
+	# Print the throughput and latency of each message type
+	# Returns the report as a dict
+	def report(self):
+		for reader in self.readers:
+			reader.close()
+
+		elapsed = max(self.measureEnd - (self.measureStart or self.measureEnd), 1e-6)
+		summary = self.recorder.summarise(elapsed)
+		total = sum([ stats['count'] for stats in summary.values() ])
+
+		print ""
+		print "%-16s %8s %9s %9s %9s %9s %9s" % ('Message', 'Count', 'Per sec', 'p50 ms', 'p95 ms', 'p99 ms', 'Max ms')
+		for msgType in sorted(summary.keys()):
+			stats = summary[msgType]
+			print "%-16s %8d %9.1f %9.2f %9.2f %9.2f %9.2f" % (msgType, stats['count'], stats['per_sec'], \
+				stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['max_ms'])
+		print "%-16s %8d %9.1f" % ('Total', total, total / elapsed)
+		for name in sorted(self.recorder.counts.keys()):
+			print "%s: %d" % (name, self.recorder.counts[name])
+
+		return {
+			'options': vars(self.options),
+			'elapsed': elapsed,
+			'messages': summary,
+			'counts': self.recorder.counts,
+		}
+
+# ----------------------------------------------------
+# MAIN FUNCTIONS
+# ----------------------------------------------------
+
+# Returns the value at the given percentile of a sorted list (nearest rank)
+def percentile(sortedValues, percent):
+	rank = int(round(percent / 100.0 * len(sortedValues) + 0.5)) - 1
+	return sortedValues[min(max(rank, 0), len(sortedValues) - 1)]
+
+# Parse the action mix, in the format: 'action=weight,action=weight,...'
+# Returns a tuple: (actions, cumulative weights)
+def parseMix(mixStr):
+	weights = {}
+	for part in mixStr.split(','):
+		action, weight = part.split('=')
+		if (action not in ACTIONS):
+			raise ValueError("Unknown action '%s' (valid actions: %s)" % (action, ', '.join(ACTIONS)))
+		weights[action] = float(weight)
+
+	actions = []
+	cumulativeWeights = []
+	total = 0.0
+	for action in ACTIONS:
+		if (weights.get(action, 0) > 0):
+			total = total + weights[action]
+			actions.append(action)
+			cumulativeWeights.append(total)
+	if (len(actions) == 0):
+		raise ValueError("The action mix has no actions.")
+	return (actions, cumulativeWeights)
+
+# Find the pages served by a server, from its directory of books (see the server's 'booklist')
+# Returns a list of (bookname, pagenum, number of lines)
+def loadLibrary(libraryDir):
+	pages = []
+	for line in open(os.path.join(libraryDir, 'booklist'), 'r').read().split('\n'):
+		if (line == ''):
+			continue
+		bookName = line.split(',')[0]
+		numPages = len(os.listdir(os.path.join(libraryDir, bookName)))
+		for pageNum in range(1, numPages + 1):
+			pageFile = open(os.path.join(libraryDir, bookName, bookName + '_page' + str(pageNum)), 'r')
+			numLines = len(pageFile.readlines())
+			pageFile.close()
+			pages.append((bookName, pageNum, max(numLines, 1)))
+	return pages
+
+# Allow as many open files as the system will, as each reader needs two sockets
+def raiseFileLimit():
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	if (hard == resource.RLIM_INFINITY or soft < hard):
+		try:
+			resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+		except ValueError:
+			pass
+
+# ----------------------------------------------------
+# MAIN PROCEDURE
+# ----------------------------------------------------
+
+def main():
+	defaultLibrary = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'server')
+
+	parser = argparse.ArgumentParser(description='Headless load generator for the e-book forum server.')
+	parser.add_argument('server_name')
+	parser.add_argument('server_port', type=int)
+	parser.add_argument('--pull', type=int, default=50, help="number of pull mode readers")
+	parser.add_argument('--push', type=int, default=50, help="number of push mode readers")
+	parser.add_argument('--duration', type=float, default=30, help="seconds to measure for")
+	parser.add_argument('--ramp', type=float, default=2, help="seconds over which the readers connect")
+	parser.add_argument('--warmup', type=float, default=1, help="seconds after the ramp before measuring")
+	parser.add_argument('--think-time', type=float, default=1.0,
+			help="mean seconds between a reader's actions (exponentially distributed)")
+	parser.add_argument('--mix', default=DEFAULT_MIX,
+			help="weights of the actions readers take: %s" % ', '.join(ACTIONS))
+	parser.add_argument('--skew', type=float, default=1.0,
+			help="Zipf exponent of page popularity (0 = every page equally popular)")
+	parser.add_argument('--poll-interval', type=int, default=30,
+			help="seconds a pull reader's page watch waits for new posts")
+	parser.add_argument('--push-scope', choices=ReaderClient.SUBSCRIBE_SCOPES, default='all',
+			help="posts pushed to push readers")
+	parser.add_argument('--stream-window', type=int, default=DEFAULT_STREAM_WINDOW,
+			help="credit window granted to the server for streams")
+	parser.add_argument('--library', default=defaultLibrary,
+			help="server directory holding the 'booklist' and books, to choose pages from")
+	parser.add_argument('--seed', type=int, default=1, help="seed for the readers' random choices")
+	parser.add_argument('--report-interval', type=float, default=5, help="seconds between progress lines (0 = none)")
+	parser.add_argument('--json', default=None, help="file to also write the report to, as JSON")
+	options = parser.parse_args()
+
+	try:
+		parseMix(options.mix)
+	except ValueError, e:
+		parser.error(str(e))
+
+	raiseFileLimit()
+	report = LoadGenerator(options).run()
+
+	if (options.json is not None):
+		jsonFile = open(options.json, 'w')
+		json.dump(report, jsonFile, indent=2, sort_keys=True)
+		jsonFile.close()
+		print "Report written to '%s'." % options.json
+
+# ----------------------------------------------------
+# RUNNING MAIN
+# ----------------------------------------------------
+if (__name__ == "__main__"):
+	main()
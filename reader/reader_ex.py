@@ -2,12 +2,31 @@
 # Written by: Ian Wong
 
 import socket
-import select
+import errno
 import threading
 from sys import argv
 import sys
+import os
 import time
 
+# Make the components shared with the server importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.framing import NonBlockingFramedSocket, FrameDecoder, encodeFrame
+from common.eventloop import EventLoop
+
+# ----------------------------------------------------
+# CONSTANTS
+# ----------------------------------------------------
+
+# Default credit window granted to the server for streams, and the largest it grants
+# (see the server's StreamSender - the reader acks every half window, so it must not
+# ask for more than the server will send ahead of its acks)
+DEFAULT_STREAM_WINDOW = 64
+MAX_STREAM_WINDOW = 1024
+
+# Matches shown per page of search results
+SEARCH_PAGE_SIZE = 10
+
 # ----------------------------------------------------
 # CLASSES
 # ----------------------------------------------------
@@ -19,6 +38,18 @@ import time
 # postInfo = (senderName, bookName, pageNum, lineNum, readStatus)
 # postContents = postContent
 #
+# syncCursor is the sequence number (assigned by the server, in insert order) of the
+# latest post such that this reader has every post up to it
+#
+# Indexes, so that looking up the posts on a book / page / line only touches those posts:
+# bookIndex = { bookName: [postID, ...] }
+# pageIndex = { (bookName, pageNum): [postID, ...] }
+# lineIndex = { (bookName, pageNum, lineNum): [postID, ...] }
+# unreadCounts = { (bookName, pageNum, lineNum): number of unread posts on the line }
+#
+# pageVersions = { (bookName, pageNum): version }
+# version = the number of the page's posts (in the server's order) this reader has
+#
 class ReaderDB(object):
 
 	# Constants
@@ -33,6 +64,24 @@ class ReaderDB(object):
 		# Storing forum posts for each book
 		self.db = {}
 
+		# Indexes of the posts by book / page / line, and the unread posts on each line
+		self.bookIndex = {}
+		self.pageIndex = {}
+		self.lineIndex = {}
+		self.unreadCounts = {}
+
+		# Posts may be inserted and read from different threads (eg. when used as a library)
+		self.lock = threading.Lock()
+
+		# Sequence number of the latest post synced from the server
+		self.syncCursor = 0
+
+		# [Pull mode] Versions of the pages fetched from the server
+		self.pageVersions = {}
+
+		# On-disk cache that changes are written through to (see ReaderCache)
+		self.cache = None
+
 	# Insert a new post, given two strings:
 	# postInfoString: 	'#PostInfo#Id#SenderName#BookName#PageNumber#LineNumber'
 	# postContentString: 	'#PostContent#Id#Content' 
@@ -63,8 +112,23 @@ class ReaderDB(object):
 		postInfo = (sendername, bookname, pagenumber, linenumber, readstatus)
 		postContent = postcontent
 		
-		# Insert tuple into database
-		self.db[postID] = (postInfo, postContent)
+		# Insert tuple into database, and index it
+		lineKey = (bookname, pagenumber, linenumber)
+		self.lock.acquire()
+		try:
+			# Already have the post (eg. both pushed and synced) - keep its read status
+			if (postID in self.db):
+				return
+
+			self.db[postID] = (postInfo, postContent)
+			self.bookIndex.setdefault(bookname, []).append(postID)
+			self.pageIndex.setdefault((bookname, pagenumber), []).append(postID)
+			self.lineIndex.setdefault(lineKey, []).append(postID)
+			self.unreadCounts[lineKey] = self.unreadCounts.get(lineKey, 0) + 1
+			if (self.cache is not None):
+				self.cache.append(postInfoStr + '|' + postContentStr)
+		finally:
+			self.lock.release()
 
 	# Given a postID, returns a tuple, containing info and content of a forum post
 	def getPost(self, postID):
@@ -80,12 +144,20 @@ class ReaderDB(object):
 			postInfo, postContent = self.getPost(readPostID)
 			
 			# Manipulate the read status
-			sender, book, page, line, _ = postInfo
+			sender, book, page, line, oldstatus = postInfo
 			readstatus = self.READ
 			
-			# Re-insert tuple into database
+			# Re-insert tuple into database, with one less unread post on the line
 			newPostInfo = (sender, book, page, line, readstatus)
-			self.db[readPostID] = (newPostInfo, postContent)
+			self.lock.acquire()
+			try:
+				self.db[readPostID] = (newPostInfo, postContent)
+				if (oldstatus == self.UNREAD):
+					self.unreadCounts[(book, page, line)] -= 1
+					if (self.cache is not None):
+						self.cache.append('#Read#' + str(readPostID))
+			finally:
+				self.lock.release()
 
 		except:
 			print "Error: No such post with id %d found." % readPostID
@@ -96,36 +168,57 @@ class ReaderDB(object):
 	# Content: [post content]
 	# 
 	def exportAsStr(self):
-		dbStr = ""
+		dbStrs = []
 		for postID in self.db.keys():
-			dbStr = dbStr + "Post ID " + str(postID) + ":\n"
+			dbStrs.append("Post ID " + str(postID) + ":\n")
 			postInfo, postContent = self.db[postID]
 			sender, book, page, line, readStatus = postInfo
-			dbStr = dbStr + "Info: " + sender + "," + book + "," + str(page) + \
-				"," + str(line) + "," + str(readStatus) + "\n"
-			dbStr = dbStr + "Content: " + postContent + "\n\n"
-		return dbStr
+			dbStrs.append("Info: " + sender + "," + book + "," + str(page) + \
+				"," + str(line) + "," + str(readStatus) + "\n")
+			dbStrs.append("Content: " + postContent + "\n\n")
+		return ''.join(dbStrs)
 
 	# Obtains a list of post ID's in the entire database
 	def getAllPostIDs(self):
 		return self.db.keys()
 
+	# Set the sync cursor, after syncing every post up to sequence number 'cursor'
+	# NOTE: The server's cursor is taken as is, even if it is behind (eg. the server lost its posts)
+	def setSyncCursor(self, cursor):
+		if (cursor != self.syncCursor):
+			self.syncCursor = cursor
+			if (self.cache is not None):
+				self.cache.append('#Cursor#' + str(cursor))
+
+	# Get the version of a page this reader has (0 if it has none of the page's posts)
+	def getPageVersion(self, bookName, pageNum):
+		return self.pageVersions.get((bookName, pageNum), 0)
+
+	# Set the version of a page, after fetching its posts up to that version
+	def setPageVersion(self, bookName, pageNum, version):
+		self.pageVersions[(bookName, pageNum)] = version
+		if (self.cache is not None):
+			self.cache.append('#PageVersion#' + bookName + '#' + str(pageNum) + '#' + str(version))
+
+	# Advance the sync cursor past a single post (eg. a pushed one) with sequence number 'seq'
+	# NOTE: Only moves if there is no gap, ie. no posts in between have been missed
+	def advanceSyncCursor(self, seq):
+		if (seq == self.syncCursor + 1):
+			self.setSyncCursor(seq)
+
 	# Gets a single character corresponding to whether a particular line (in a book/page)
 	# contains read / unread posts, or nothing otherwise.
 	def consultPostsStatus(self, bookname, pagenum, linenum):
 		
-		postIDs = self.getPostIDs(bookname, pagenum, linenum)
+		lineKey = (bookname, int(pagenum), int(linenum))
 	
-		# Check if list is empty
-		if (len(postIDs) == 0):
+		# Check if there are no posts on the line
+		if (lineKey not in self.lineIndex):
 			return self.post_status_chars[-1]
 
 		# Check if there are any unread posts
-		for postID in postIDs:
-			postInfo, _ = self.getPost(postID)
-			_, _, _, _, status = postInfo
-			if (status == self.UNREAD):
-				return self.post_status_chars[self.UNREAD]
+		if (self.unreadCounts[lineKey] > 0):
+			return self.post_status_chars[self.UNREAD]
 		
 		# At this point, all messages are read
 		return self.post_status_chars[self.READ]
@@ -140,564 +233,1182 @@ class ReaderDB(object):
 		args = list(args)
 		numargs = len(args)
 		bookName = args[0]
-		if (numargs > 1):
-			pageNum = int(args[1])
-		if (numargs > 2):
-			lineNum = int(args[2])
 
-		# Loop through all posts, returning the ones that match the condition
-		idList = []
-		for postID in self.db.keys():
-			i = 0
-			postInfo, _ = self.getPost(postID)
-			_, bookname, page, line, _ = postInfo
-			if (bookname == bookName):
-				i = i+1
-				if (numargs > 1 and page == pageNum):
-					i = i+1
-					if (numargs > 2 and line == lineNum):
-						i = i+1
-			if (i == numargs):
-				idList.append(postID)	
-		return idList
-
-# This is the thread that fulfils background processes when reader is running
-# Provides the background functionalities needed by pull / push mode
-# Works closely with global variables / functions in main thread
-class BackgroundThread(threading.Thread):
-
-	# Constructor given the socket connected to the server
-	def __init__(self):
-		threading.Thread.__init__(self)
-		self.event = threading.Event()		# for terminating thread
-		self.currentCommand = ""		# Used to keep track of current user command
-		self.command_changed = False		# For terminating timer early
-		self.updateDBComplete = False		# Signalling the 'display' process
-
-	# Execute thread - constantly listen for messages
-	# from the connected server
-	def run(self):
-
-		# Push mode - request update of posts from server, and listen indefinitely for incoming messages
-		if (opmode == 'push'):
-			
-			# Reqeuest to update the reader's database with server's
-			reqSyncPosts()
+		# Look up the posts in the matching index (copied, as posts may be inserted meanwhile)
+		if (numargs == 1):
+			idList = self.bookIndex.get(bookName, [])
+		elif (numargs == 2):
+			idList = self.pageIndex.get((bookName, int(args[1])), [])
+		else:
+			idList = self.lineIndex.get((bookName, int(args[1]), int(args[2])), [])
+		return list(idList)
+
+# This class keeps a reader's posts (and read status) in a file on disk, so that a
+# restarted reader only has to sync the posts it missed while it was away
+# The file is a log of framed records (see common/framing.py), each one of:
+#   '#PostInfo#...|#PostContent#...'		a post (as sent by the server)
+#   '#Read#[postID]'				a post has been read
+#   '#Cursor#[syncCursor]'			the reader's sync cursor moved
+#   '#PageVersion#[bookname]#[pagenum]#[version]'	[pull mode] a page's version moved
+# Records are replayed in order at startup. A record torn by a crash is cut off, and
+# when most records have been superseded the log is rewritten compacted.
+# NOTE: The cache is not synced to disk - anything lost is simply synced again.
+class ReaderCache(object):
 
-			# Indicate db is updated
-			self.updateDBComplete = True	
-	
-		# Pull mode - carry out appropriate procedures depending on current command		
-		elif (opmode == 'pull'):
-			while not self.event.isSet():
-
-				# Set the command to be unchanged
-				self.command_changed = False
-				
-				# Display command:
-				if (self.currentCommand == 'display'):
-
-					# Indicate DB is not updated
-					self.updateDBComplete = False
-					
-					# Update the local posts for current book and page
-					reqUpdateLocalPosts(currentBookname, currentPagenumber)
-					
-					# DB is now updated
-					self.updateDBComplete = True
-		
-					# Delay so display can be carried out
-					time.sleep(0.0015)
+	# Constants
+	READ_SIZE = 1024 * 1024
+
+	# Constructor given the file to keep the posts in
+	def __init__(self, filename):
+		self.filename = filename
+		self.logFile = None
+		self.lock = threading.Lock()
+
+	# Load the cached posts into the reader's database, then attach the cache to it,
+	# so that posts and changes made from now on are appended to the cache
+	# Returns the number of posts loaded
+	def load(self, readerDB):
+
+		# Replay the records
+		records = []
+		validLength = 0
+		if (os.path.exists(self.filename)):
+			records, validLength = self.readRecords()
+		for record in records:
+			components = record.split('#')
+			if (components[1] == 'PostInfo'):
+				postInfoStr, postContentStr = record.split('|', 1)
+				readerDB.insertPost(postInfoStr, postContentStr)
+			elif (components[1] == 'Read'):
+				readerDB.setRead(int(components[2]))
+			elif (components[1] == 'Cursor'):
+				readerDB.setSyncCursor(int(components[2]))
+			elif (components[1] == 'PageVersion'):
+				readerDB.setPageVersion(components[2], int(components[3]), int(components[4]))
+
+		# Rewrite the log once it is mostly superseded records, or cut off a torn record
+		numPosts = len(readerDB.getAllPostIDs())
+		if (len(records) > 2 * numPosts + len(readerDB.pageVersions) + 1):
+			self.compact(readerDB)
+		elif (os.path.exists(self.filename) and validLength < os.path.getsize(self.filename)):
+			logFile = open(self.filename, 'r+b')
+			logFile.truncate(validLength)
+			logFile.close()
+
+		self.logFile = open(self.filename, 'ab')
+		readerDB.cache = self
+		return numPosts
+
+	# Append a record to the cache
+	def append(self, record):
+		self.lock.acquire()
+		try:
+			if (self.logFile is not None):
+				self.logFile.write(encodeFrame(record))
+		finally:
+			self.lock.release()
+
+	# Write the cache out afresh, holding just the current state of the reader's database
+	def compact(self, readerDB):
+		tmpFilename = self.filename + '.tmp'
+		tmpFile = open(tmpFilename, 'wb')
+		for postID in readerDB.getAllPostIDs():
+			postInfo, postContent = readerDB.getPost(postID)
+			sender, book, page, line, readStatus = postInfo
+			tmpFile.write(encodeFrame('#PostInfo#' + str(postID) + '#' + sender + '#' + book + '#' + \
+					str(page) + '#' + str(line) + '|#PostContent#' + str(postID) + '#' + postContent))
+			if (readStatus == readerDB.READ):
+				tmpFile.write(encodeFrame('#Read#' + str(postID)))
+		tmpFile.write(encodeFrame('#Cursor#' + str(readerDB.syncCursor)))
+		for (book, page), version in readerDB.pageVersions.items():
+			tmpFile.write(encodeFrame('#PageVersion#' + book + '#' + str(page) + '#' + str(version)))
+		tmpFile.close()
+		os.rename(tmpFilename, self.filename)
+
+	# Flush and close the cache
+	def close(self):
+		self.lock.acquire()
+		try:
+			if (self.logFile is not None):
+				self.logFile.close()
+				self.logFile = None
+		finally:
+			self.lock.release()
+
+	# Read all the whole records in the cache
+	# Returns a tuple: (records, lengthOfWholeRecords)
+	def readRecords(self):
+		decoder = FrameDecoder()
+		records = []
+		dataFile = open(self.filename, 'rb')
+		data = dataFile.read(self.READ_SIZE)
+		length = 0
+		while (data != ''):
+			records.extend(decoder.feed(data))
+			length = length + len(data)
+			data = dataFile.read(self.READ_SIZE)
+		dataFile.close()
+		return (records, length - decoder.pending)
+
+# This class receives a single stream of messages from the server, a message at a time
+# The reader grants the server a credit window of 'window' items, and acknowledges
+# cumulatively (with the number of items received so far) every half window, so the
+# server never has to wait for a round trip per item. Acks carry the number of the stream
+# on the connection, so that any arriving after the server has finished sending are not
+# taken for those of the next stream.
+# A window of 0 asks the server to send the whole stream at once, without acks.
+# NOTE: Tacks on a '#' to startAckPhrase and ackPhrase to adhere to message format rules
+class StreamReceiver(object):
+
+	# Constructor given the socket connected to the server, the window to grant, the phrases
+	# of the stream, and a function to call with the list of all the items once it has ended
+	# If the window was already granted in the request, the stream is not acked to start it.
+	def __init__(self, sock, window, startAckPhrase, ackPhrase, endMsg, onComplete, windowGranted=False, streamNum=0):
+		self.sock = sock
+		self.window = window
+		self.streamNum = streamNum
+		self.ackPhrase = ackPhrase
+		self.endMsg = endMsg
+		self.onComplete = onComplete
+		self.ackInterval = max(window / 2, 1)
+		self.numUnacked = 0
+		self.items = []
+
+		# Send the startAckPhrase (and window) to indicate the server can begin stream sending
+		if (not windowGranted):
+			self.sock.send('#' + startAckPhrase + '#' + str(window))
+
+	# Take the next message of the stream
+	# Returns whether it was the end message
+	def receive(self, msg):
+		if (msg.split('#')[1] == self.endMsg):
+			return True
+
+		self.items.append(msg)
+		self.numUnacked = self.numUnacked + 1
+
+		# Send a cumulative ack for the stream messages received
+		if (self.window > 0 and self.numUnacked >= self.ackInterval):
+			self.sock.send('#' + self.ackPhrase + '#' + str(len(self.items)) + '#' + str(self.streamNum))
+			self.numUnacked = 0
+		return False
+
+# This class represents the chat engine between this reader and others, over UDP
+# Chat clients are specified by their destination IP and destination port
+class ChatSocket(object):
+
+	# Constants
+	BUFFER_SIZE = 1024
+
+	# Constructor given the event loop to run on, the user name of the reader, and a
+	# function to call with (sender, chat message) for every chat message received
+	def __init__(self, loop, username, onChatMessage):
+		self.loop = loop
+		self.username = username
+		self.onChatMessage = onChatMessage
+
+		# Create the UDP socket (bound to any free port)
+		self.chatSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.chatSock.bind(('', 0))
+		self.chatSock.setblocking(0)
+
+		# Set the chat port number
+		self.chatPortnum = self.chatSock.getsockname()[1]
+
+		# Initiate dict of chat clients = { username: (IP, chat port) }
+		self.chatClients = {}
+
+		self.loop.addReader(self.chatSock, self.onReadable)
 
-					# Set db updated back to false
-					self.updateDBComplete = False
+	# Receive every chat message waiting on the socket
+	def onReadable(self):
+		while True:
+			try:
+				msg, addr = self.chatSock.recvfrom(self.BUFFER_SIZE)
+			except socket.error, e:
+				if (e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK)):
+					print "Error receiving chat message: %s" % e
+				return
 
-					# Terminate timer when new command is issued
-					sleepIntervals = int((poll_interval - 0.0015) / (0.0001 * 3))
-					for i in range(0, sleepIntervals):
-						if (self.command_changed):
-							break
-						time.sleep(0.0001)
+			# Check validity of message
+			# should be of format:
+			# '#NewChatMessage#[sender]#[chatmsg]
+			msg_components = msg.split('#')
+			if (len(msg_components) < 4):
+				# Something happened with message - ignore it
+				continue
 
-	# Indicate that the command has changed (not necessarily a different command)
-	def setCommand(self, newCommand):
-		self.currentCommand = newCommand
-		self.command_changed = True
+			self.onChatMessage(msg_components[2], '#'.join(msg_components[3:]))
 
-# This class is the thread that runs when reader is listening for input from server
+	# Sends a message over udp to a particular targetInfo: (targetIP, targetPortnum)
+	# in the format:
+	# '#NewChatMessage#[sender]#[chatmsg]'
+	def sendChatMessage(self, chatMessage, targetInfo):
+		msgStr = '#NewChatMessage#' + self.username + '#' + chatMessage
+		self.chatSock.sendto(msgStr, targetInfo)
+
+	# Returns whether there is a client with the specified name that is available to chat
+	def hasChatClient(self, username):
+		return (username in self.chatClients)
+
+	# Close the chat socket
+	def close(self):
+		self.loop.removeReader(self.chatSock)
+		self.chatSock.close()
+
+# This class is the core of a reader: it exchanges messages with the server (and chat
+# messages with other readers) on an event loop, and keeps the posts in a ReaderDB
+# Nothing in it blocks or runs on its own thread, so any number of readers may share one
+# loop (eg. to simulate many readers from a single process).
+# Whatever the reader shows the user is left to the 'on...' methods, which do nothing
+# here and are overridden by subclasses (see InteractiveReader).
 # NOTE: All messages sent by server should start with '#', followed by a phrase
 # that helps reader identify what message it is
-class ListenThread(threading.Thread):
+class ReaderClient(object):
+
+	# Scopes of the posts pushed by the server (push mode)
+	SUBSCRIBE_SCOPES = ['all', 'book', 'page']
+
+	# What a search may look through: the lines of the books and / or the content of the posts
+	SEARCH_SCOPES = ['all', 'books', 'posts']
+
+	# Messages the server may send at any time (even in the middle of a stream)
+	ASYNC_MSGS = ['NewSinglePost', 'ResyncHint', 'WatchPageResp', 'RelayStartChatReq', 'StartChatResp']
+
+	# Constructor given the event loop to run on, the user name and mode ('pull' / 'push')
+	# of the reader, the poll interval (seconds a page watch waits for new posts), the
+	# credit window granted to the server for streams, and the database to keep posts in
+	def __init__(self, loop, userName, opmode, pollInterval, streamWindow=DEFAULT_STREAM_WINDOW, readerDB=None):
+		self.loop = loop
+		self.userName = userName
+		self.opmode = opmode
+		self.pollInterval = pollInterval
+		self.streamWindow = streamWindow
+		if (readerDB is None):
+			readerDB = ReaderDB()
+		self.readerDB = readerDB
+
+		self.currentBookname = ""
+		self.currentPagenumber = 0
+		self.subscribeScope = 'all'		# [push mode] posts pushed by server: 'all', 'book' or 'page'
+
+		self.sock = None			# framed socket connected to the server
+		self.chat = None			# chat socket
+		self.stream = None			# stream being received from the server (if any)
+		self.numStreams = 0			# streams received on the connection so far
+		self.syncStarted = None			# (time, bytes received) when the last sync was requested
+
+	# ----------------------------------------------------
+	# Connection
+	# ----------------------------------------------------
+
+	# Connect to the server and introduce this reader to it
+	# (in push mode, the database is then brought up to date with the server's)
+	# NOTE: Raises socket.error if the server cannot be connected to
+	def connect(self, serverName, serverPort, ipAddr=None):
+		serverSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)	# TCP
+		serverSock.connect((serverName, serverPort))
+
+		# Exchange whole messages with the server through a framed socket, written
+		# out whenever the loop finds it writable
+		self.sock = NonBlockingFramedSocket(serverSock, self.onPendingOutput)
+		self.numStreams = 0
+		self.loop.addReader(self.sock, self.onReadable)
+		self.chat = ChatSocket(self.loop, self.userName, self.onChatMessage)
+
+		# Send intro message with info about this client
+		# Format: '#Intro#[Username]#[Opmode]#[IP addr]
+		if (ipAddr is None):
+			ipAddr = socket.gethostbyname(socket.getfqdn())
+		self.sock.send("#Intro#" + self.userName + "#" + self.opmode + "#" + ipAddr)
+
+		# Push mode - request update of posts from server
+		if (self.opmode == 'push'):
+			self.reqSyncPosts()
+
+	# Returns whether the reader is connected to the server
+	def isConnected(self):
+		return (self.sock is not None and not self.sock.closed)
+
+	# Close the connection to the server and the chat socket
+	def close(self):
+		if (self.sock is None):
+			return
+		self.loop.removeReader(self.sock)
+		self.loop.removeWriter(self.sock)
+		self.sock.close()
+		self.chat.close()
+		self.sock = None
+
+	# Output is waiting - write it once the socket is writable
+	def onPendingOutput(self, sock):
+		self.loop.addWriter(sock, self.onWritable)
+
+	# Write out the pending output
+	def onWritable(self):
+		if (self.sock.flush() or self.sock.closed):
+			self.loop.removeWriter(self.sock)
+
+	# Handle every whole message received from the server
+	def onReadable(self):
+		for msg in self.sock.recvAvailable():
+			self.handleMessage(msg)
+			if (self.sock is None):
+				return
+
+		# Server has closed the connection
+		if (self.sock.closed):
+			self.close()
+			self.onDisconnected()
+
+	# Handle a single message from the server
+	def handleMessage(self, data):
+		data_components = data.split('#')
+		msgType = data_components[1]
+
+		# Server is pushing something, which may arrive in the middle of a stream
+		if (msgType in self.ASYNC_MSGS):
+			self.handleAsyncMsg(data, data_components)
+
+		# Next message of the stream being received
+		elif (self.stream is not None):
+			stream = self.stream
+			if (stream.receive(data)):
+				self.stream = None
+				stream.onComplete(stream.items)
+
+		# Server is returning a stream of page data to display
+		# each in the format: #[linenum]#[line]
+		#             or    : #Error#[Error message]
+		elif (msgType == 'DisplayResp'):
+			self.receiveStream('BeginDisplayResp', 'DisplayRespRcvd', 'EndDisplayResp', \
+				lambda items: self.onDisplayResp(self.currentBookname, self.currentPagenumber, items))
+
+		# [Pull mode] Server is returning a page along with the posts on it that the reader
+		# does not have, as a stream (already granted a window) starting with the format:
+		# '#DisplayPageResp#[bookname]#[pagenum]#[new version]'
+		# the posts each in the format: #PostInfo...|#PostContent
+		# then the lines each in the format: #[linenum]#[line]
+		#             or    : #Error#[Error message]
+		elif (msgType == 'DisplayPageResp'):
+			bookName = data_components[2]
+			pageNum = int(data_components[3])
+			version = int(data_components[4])
+			self.receiveStream('BeginDisplayPageResp', 'DisplayPageRespRcvd', 'EndDisplayPageResp', \
+				lambda items: self.onDisplayPageResp(bookName, pageNum, version, items), True)
+
+		# Server is responding with a message after accepting a post from reader
+		# in the format: '#UploadPostResp#Success'  or  '#UploadPostResp#Error#[Error message]'
+		elif (msgType == 'UploadPostResp'):
+			if (data_components[2] == 'Error'):
+				self.onPostUploaded(data_components[3])
+			else:
+				self.onPostUploaded(None)
+
+		# Server is replying with a stream of posts that reader does not have,
+		# starting with the format: '#SyncPostsResp#[new sync cursor]'
+		# each in the format: #PostInfo...|#PostContent
+		elif (msgType == 'SyncPostsResp'):
+			cursor = int(data_components[2])
+			self.receiveStream('BeginSyncPostsResp', 'NewPostRcvd', 'EndSyncPostsResp', \
+				lambda items: self.onSyncPostsResp(cursor, items))
+
+		# [Pull mode] Server is replying to a watch on a page with a stream of the posts on it
+		# that the reader does NOT have, starting with the format:
+		# '#PagePostsResp#[bookname]#[pagenum]#[new version]'
+		# each in the format: #PostInfo...|#PostContent
+		#             or    : #Error#[Error message]
+		elif (msgType == 'PagePostsResp'):
+			bookName = data_components[2]
+			pageNum = int(data_components[3])
+			version = int(data_components[4])
+			self.receiveStream('BeginPagePostsResp', 'NewPostRcvd', 'EndPagePostsResp', \
+				lambda items: self.onPagePostsResp(bookName, pageNum, version, items))
+
+		# Server is replying with a stream of posts for a particular book and page
+		# that the user does NOT have
+		# each in the format: #PostInfo...|#PostContent
+		#             or    : #Error#[Error message]
+		elif (msgType == 'GetPostsLocResp'):
+			bookName = self.currentBookname
+			pageNum = self.currentPagenumber
+			self.receiveStream('BeginGetPostsLocResp', 'NewPostRcvd', 'EndGetPostsLocResp', \
+				lambda items: self.onGetPostsLocResp(bookName, pageNum, items))
+
+		# Server is replying to a search with a stream of matches, best first, starting with the format:
+		# '#SearchResp#[number of matches, followed by '+' if there may be more]#[offset of the first one sent]'
+		# each in the format: '#LineHit#[score]#[bookname]#[pagenum]#[linenum]#[line]'
+		#                 or: '#PostHit#[score]#PostInfo...|#PostContent...'
+		#             or    : #Error#[Error message]
+		elif (msgType == 'SearchResp'):
+			allCounted = not data_components[2].endswith('+')
+			numMatches = int(data_components[2].rstrip('+'))
+			offset = int(data_components[3])
+			self.receiveStream('BeginSearchResp', 'SearchRespRcvd', 'EndSearchResp', \
+				lambda items: self.onSearchResp(numMatches, allCounted, offset, items))
+
+		# Server is answering a request for its metrics, in the format:
+		# '#StatsResp#[metrics, in the Prometheus text format]'
+		elif (msgType == 'StatsResp'):
+			self.onStats(data.split('#', 2)[2])
+
+		# Unknown message
+		else:
+			self.onUnknownMessage(data)
+
+	# Handle a message the server may push at any time (even in the middle of a stream)
+	def handleAsyncMsg(self, data, data_components):
+		msgType = data_components[1]
+
+		# Server is returning a new post, in the format:
+		# postString:		'#NewSinglePost#[seq]postInfoString...|postContentString'
+		# postInfoString: 	'#PostInfo#Id#SenderName#BookName#PageNumber#LineNumber'
+		# postContentString: 	'#PostContent#Id#Content'
+		if (msgType == 'NewSinglePost'):
+
+			# Accept the new post
+			_, _, seqStr, postDataStr = data.split('#', 3)
+			postInfoStr, postContentStr = ('#' + postDataStr).split('|', 1)
+			self.readerDB.insertPost(postInfoStr, postContentStr)
+			self.readerDB.advanceSyncCursor(int(seqStr))
+
+			postInfoComponents = postInfoStr.split('#')
+			self.onPostPushed(int(postInfoComponents[2]), postInfoComponents[4], int(postInfoComponents[5]))
+
+		# Server could not push every new post to this reader in time, and is
+		# hinting that the reader should sync the posts it has missed
+		elif (msgType == 'ResyncHint'):
+			self.reqSyncPosts()
+
+		# [Pull mode] Server is answering a watch on a page - a post has landed on it, or the
+		# watch has timed out - in the format:
+		# '#WatchPageResp#[bookname]#[pagenum]#[version]'
+		elif (msgType == 'WatchPageResp'):
+
+			# Fetch any new posts and keep watching, while the reader is still on the page
+			bookName = data_components[2]
+			pageNum = int(data_components[3])
+			if (self.isCurrentPage(bookName, pageNum)):
+				self.reqWatchPage(bookName, pageNum)
+
+		# Server is requesting for this reader (B) to start a chat with another reader (A)
+		# with a message of format:
+		# '#RelayStartChatReq#[AUsername]#[AIP]#[AFreeport]'
+		# (answered with 'respondChatInvite')
+		elif (msgType == 'RelayStartChatReq'):
+			self.onChatInvite(data_components[2], data_components[3], int(data_components[4]))
+
+		# Server is responding with a response from Client B, who was invited to a chat,
+		# with format:
+		# '#StartChatResp#Accept#[BUsername]#[BIP]#[BChatport]
+		#   or
+		# '#StartChatResp#Reject#[BUsername]
+		#   or
+		# '#StartChatResp#Error#[Error msg]
+		elif (msgType == 'StartChatResp'):
+			if (data_components[2] == 'Accept'):
+				# Add client B to list of chat friends
+				bUsername = data_components[3]
+				self.chat.chatClients[bUsername] = (data_components[4], int(data_components[5]))
+			self.onChatResponse(data_components[2], data_components[3])
+
+	# Start receiving a stream from the server - 'onComplete' is called with the list of
+	# all its messages once it has ended
+	def receiveStream(self, startAckPhrase, ackPhrase, endMsg, onComplete, windowGranted=False):
+		self.numStreams = self.numStreams + 1
+		self.stream = StreamReceiver(self.sock, self.streamWindow, startAckPhrase, ackPhrase, \
+			endMsg, onComplete, windowGranted, self.numStreams)
+
+	# ----------------------------------------------------
+	# Responses
+	# ----------------------------------------------------
+
+	# A page to display has been received
+	def onDisplayResp(self, bookName, pageNum, pageContents):
+
+		# Check if response contained no errors
+		# in the format: '#Error#[error msg]'
+		if (isErrorStream(pageContents)):
+			self.onDisplayError(pageContents[0].split('#', 2)[2])
+			return
 
-	# Constructor given the socket connected to the server
-	def __init__(self):
-		threading.Thread.__init__(self)
-		self.event = threading.Event()		# for stopping thread
+		self.onPageDisplayed(bookName, pageNum, self.annotatePage(bookName, pageNum, pageContents))
 
-	# Execute thread - constantly listen for messages
-	# from the connected server
-	def run(self):
+	# [Pull mode] A page to display has been received, along with its posts
+	def onDisplayPageResp(self, bookName, pageNum, version, streamItems):
 
-		# Constantly listen for messages until event is set
-		while not self.event.isSet():
-			
-			# Listen to socket for any messages from server
-			data = selectRecv(BUFFER_SIZE)
-			if (data != ""):
-				data_components = data.split('#')
-
-				# Server is returning a new post, in the format:
-				# postString:		'#NewSinglePost#postInfoString...|postContentString'
-				# postInfoString: 	'#PostInfo#Id#SenderName#BookName#PageNumber#LineNumber'
-				# postContentString: 	'#PostContent#Id#Content'
-				if (data_components[1] == 'NewSinglePost'):
-
-					# Accept the new post
-					postInfoStr = data.split('#NewSinglePost')[1].split('|')[0]
-					postContentStr = data.split('#NewSinglePost')[1].split('|')[1]
-					readerDB.insertPost(postInfoStr, postContentStr)
-			
-					# Determine whether to print out feedback message
-					postInfoStr = postInfoStr.split('#')
-					bookName = postInfoStr[4]
-					pageNum = int(postInfoStr[5])
-					if (bookName == currentBookname and pageNum == currentPagenumber):
-						print "There are new posts!\n"
-
-				# Server is returning a stream of page data to display
-				elif (data_components[1] == 'DisplayResp'):
-
-					# Obtain the page contents
-					pageContents = receiveStream('BeginDisplayResp', 'DisplayRespRcvd', 'EndDisplayResp')
-
-					# Check if response contained no errors
-					# in the format: '#Error#[error msg]'
-					if (len(pageContents) == 1):
-						pageContents = pageContents[0].split('#')
-						if (pageContents[1] == 'Error'):
-							print 'Error: ' + pageContents[2]
-							continue
-		
-					# assume bookName and pagenumber are the current ones being requested
-					# to display
-					bookName = currentBookname
-					pageNum = currentPagenumber
-
-					# No errors - print each line on the page
-					print "Book '%s', Page %d:" % (bookName, pageNum)
-					for pageContent in pageContents:
-						# Parse the string
-						_, linenum, linecontent = pageContent.split('#')
-						lineNum = int(linenum)
-
-						# Determine whether any posts are read/unread on this line
-						linePostsStatus = readerDB.consultPostsStatus(bookName, pageNum, lineNum)
-
-						# Print appropriately
-						print "%c  %d %s" % (linePostsStatus, lineNum, linecontent)
-
-				# Server is responding with a message after accepting a post from reader
-				elif (data_components[1] == 'UploadPostResp'):
-						
-						# Check for any errors
-						if (data_components[2] == 'Error'):
-							print "Error uploading post: " + data_components[3]
-						else:
-							print "Successfully posted!"
-
-				# Server is replying with a stream of posts that reader does not have
-				# each in the format: #PostInfo...|#PostContent
-				elif (data_components[1] == 'SyncPostsResp'):
-
-					print "Now syncing posts..."
-
-					# Get new posts into a list
-					unsyncedPosts = receiveStream('BeginSyncPostsResp', 'NewPostRcvd', 'EndSyncPostsResp')
-
-					if (len(unsyncedPosts) == 0):
-						print "Database up to date!\n"
-						continue
-
-					# Insert each post into the database
-					for postData in unsyncedPosts:
-						postInfoStr = postData.split('|')[0]
-						postContentStr = postData.split('|')[1]
-						readerDB.insertPost(postInfoStr, postContentStr)
-
-					print "Database updated!\n"
-
-				# Server is replying with a stream of posts for a particular book and page
-				# that the user does NOT have
-				# each in the format: #PostInfo...|#PostContent
-				#             or    : #Error#[Error message]
-				elif (data_components[1] == 'GetPostsLocResp'):
-					
-					# Get new posts into a list
-					unknownPosts = receiveStream('BeginGetPostsLocResp', 'NewPostRcvd', 'EndGetPostsLocResp')
-
-					# Check for any new posts
-					if (len(unknownPosts) == 0):
-						# Database is up to date
-						continue
-					
-					# Check for any errors
-					if (len(unknownPosts) == 1):
-						postData = unknownPosts[0].split('#')
-						if (postData[1] == 'Error'):
-							# Error requesting
-							continue
-					
-					# Insert each post into the database
-					for postData in unknownPosts:
-						postInfoStr = postData.split('|')[0]
-						postContentStr = postData.split('|')[1]
-						readerDB.insertPost(postInfoStr, postContentStr)
-
-					print "There are new posts for this page!\n"
-
-				# Server is requesting for this reader (B) to start a chat with another reader (A)
-				# with a message of format:
-				# '#RelayStartChatReq#[AUsername]#[AIP]#[AFreeport]'
-				elif (data_components[1] == 'RelayStartChatReq'):
-
-					# Extract data
-					aUsername = data_components[2]
-					aIP = data_components[3]
-					aChatport = int(data_components[4])
-					
-					# Prompt user whether to accept or reject the chat, and execute appropriately
-					accept = self.promptStartChat(aUsername)
-
-					# Send an acceptance notification to server in the format:
-					# '#RelayStartChatResp#Accept#[BChatport]#[AUsername]#[AChatport]
-					if (accept):
-						print "You can now chat to '%s'!" % aUsername
-						print "You can do so using the command: 'chat %s [chat content]'" % aUsername
-
-						# Send acceptance notification to server
-						# in the format: 
-						acceptStr = '#RelayStartChatResp#Accept#' + str(chatThread.chatPortnum) + \
-								'#' + aUsername + '#' + str(aChatport)
-						sock.send(acceptStr)
-						chatThread.chatClients[aUsername] = (aIP, aChatport)
-
-					# Send a reject notification to server in format:
-					# '#RelayStartChatResp#Reject#[AUsername]
-					else:
-						print "Rejected chat with '%s'." % aUsername
-						rejectStr = '#RelayStartChatResp#Reject#' + aUsername
-						sock.send(rejectStr)
-
-					print ""	# formatting
-
-				# Server is responding with a response from Client B, who was invited to a chat,
-				# with format:
-				# '#StartChatResp#Accept#[BUsername]#[BIP]#[BChatport]
-				#   or
-				# '#StartChatResp#Reject#[BUsername]
-				#   or
-				# '#StartChatResp#Error#[Error msg]
-				elif (data_components[1] == 'StartChatResp'):
-	
-					# Obtain username of client B
-					bUsername = data_components[3]
-					
-					# Check if accepted
-					if (data_components[2] == 'Accept'):
-
-						# Obtain other parameters
-						bIP = data_components[4]
-						bChatport = int(data_components[5])
-		
-						print "'%s' has accepted your chat invitation!" % bUsername
-						print "You can do so using the command: 'chat %s [chat content]'" % bUsername
+		# Check if response contained no errors
+		if (isErrorStream(streamItems)):
+			self.onDisplayError(streamItems[0].split('#', 2)[2])
+			return
 
-						# Add client B to list of chat friends
-						chatThread.chatClients[bUsername] = (bIP, bChatport)
-						
-					elif (data_components[2] == 'Reject'):
-						print bUsername + ' rejected your invitation to chat.'
+		# Insert each post into the database, before the lines are annotated
+		pageContents = []
+		for streamItem in streamItems:
+			if (streamItem.startswith('#PostInfo#')):
+				self.insertPosts([streamItem])
+			else:
+				pageContents.append(streamItem)
+		self.readerDB.setPageVersion(bookName, pageNum, version)
 
-					# Error with client B
-					elif (data_components[2] == 'Error'):
-						print "Error: " + data_components[3]
+		self.onPageDisplayed(bookName, pageNum, self.annotatePage(bookName, pageNum, pageContents))
 
-					print ""	# Formatting
+		# Watch the page for new posts
+		if (self.isCurrentPage(bookName, pageNum)):
+			self.reqWatchPage(bookName, pageNum)
 
-				# Unknown message
-				else:
-					print 'Unknown message received: %s"' % data
+	# The posts the reader did not have have been synced
+	def onSyncPostsResp(self, cursor, unsyncedPosts):
+		self.insertPosts(unsyncedPosts)
 
-		sock.close()
+		# Have every post up to the cursor the server gave us
+		self.readerDB.setSyncCursor(cursor)
 
-	# Prompt the user (client B) whether they want to start a chat conversation
-	# with client A of given name 'aUsername'		
-	def promptStartChat(self, aUsername):
-		user_resp = ""
+		startTime, startBytes = self.syncStarted
+		self.onSynced(len(unsyncedPosts), self.sock.bytesReceived - startBytes, time.time() - startTime)
 
-		# Prevent reading from main
-		print aUsername + ' wants to chat with you! Accept? [y/n]'
-		user_input = raw_input('> ')
-		if (user_input == 'y'):
-			user_resp = True
-		else:
-			user_resp = False
-		return user_resp
+	# [Pull mode] The new posts on a watched page have been received
+	def onPagePostsResp(self, bookName, pageNum, version, newPosts):
 
-# This class represents the chat engine between this reader and another,
-# specified by their destination IP and destination port
-# NOTE: Assumes destPort is an int
-class ChatThread(threading.Thread):
+		# Check for any errors - the page is not watched any further
+		if (isErrorStream(newPosts)):
+			return
 
-	# Constructor given the socket connected to the server
-	def __init__(self):
-		threading.Thread.__init__(self)
-		self.event = threading.Event()		# for stopping thread
+		self.insertPosts(newPosts)
+		self.readerDB.setPageVersion(bookName, pageNum, version)
 
-		# Create the UDP socket (bind to sourcePort, destination is (destIP, destPort))
-		self.chatSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		self.chatSock.bind(('', 0))
+		# Continue watching the current page
+		if (self.isCurrentPage(bookName, pageNum)):
+			if (len(newPosts) > 0):
+				self.onNewPosts(bookName, pageNum, len(newPosts))
+			self.reqWatchPage(bookName, pageNum)
 
-		# Set the chat port number
-		self.chatPortnum = self.chatSock.getsockname()[1]
+	# The posts on a page that the reader did not have have been received
+	def onGetPostsLocResp(self, bookName, pageNum, unknownPosts):
 
-		# Bind user name of reader to chat thread
-		self.username = user_name
-		
-		# Initiate dict of chat clients
-		self.chatClients = {}
+		# Check for any new posts, or errors requesting them
+		if (len(unknownPosts) == 0 or isErrorStream(unknownPosts)):
+			return
 
-	# Running the chat thread
-	def run(self):
-		while not self.event.isSet():
-			# Use select module to read from buffer
-			read_sockets, write_sockets, error_sockets = select.select([self.chatSock], [], [])
-			for rs in read_sockets:
-				if (rs == self.chatSock):
-					msg, addr = rs.recvfrom(BUFFER_SIZE)
-					if (msg != ""):
-						msg_components = msg.split('#')
-						
-						# Check validity of message
-						# should be of format:
-						# '#NewChatMessage#[sender]#[chatmsg]
-						if (len(msg_components) < 4):
-							# Something happened with message - ignore it
-							continue
-
-						sender = msg_components[2]
-						chatMsg = '#'.join(msg_components[3:])
-						print "'%s' says: %s" % (sender, chatMsg)	
-
-		print "Exiting chat thread..."
-		self.chatSock.close()
+		self.insertPosts(unknownPosts)
+		self.onNewPosts(bookName, pageNum, len(unknownPosts))
 
-	# Sends a message over udp to a particular targetInfo: (targetIP, targetPortnum)
-	# in the format:
-	# '#NewChatMessage#[sender]#[chatmsg]'
-	def sendChatMessage(self, chatMessage, targetInfo):
-		targetIP, targetPortnum = targetInfo
-		
-		# Send an encoded message string to targetInfo
-		msgStr = '#NewChatMessage#' + self.username + '#' + chatMessage
-		self.chatSock.sendto(msgStr, targetInfo)
-		print "Sent!"
+	# The matches of a search have been received
+	def onSearchResp(self, numMatches, allCounted, offset, streamItems):
 
-	# Returns whether there is a client with the specified name that is available to chat
-	def hasChatClient(self, username):
-		return (username in self.chatClients.keys())
+		# Check if response contained no errors
+		if (isErrorStream(streamItems)):
+			self.onSearchError(streamItems[0].split('#', 2)[2])
+			return
 
-# ----------------------------------------------------
-# MAIN FUNCTIONS
-# ----------------------------------------------------
+		# Parse each match into: (score, bookname, pagenum, linenum, text, post)
+		# where post is (postID, sender) for a post, or None for a line of a book
+		matches = []
+		for streamItem in streamItems:
+			if (streamItem.startswith('#LineHit#')):
+				_, _, score, bookName, pageNum, lineNum, line = streamItem.split('#', 6)
+				matches.append((float(score), bookName, int(pageNum), int(lineNum), line, None))
+			else:
+				_, _, score, postDataStr = streamItem.split('#', 3)
+				postInfoStr, postContentStr = ('#' + postDataStr).split('|', 1)
+				postInfoComponents = postInfoStr.split('#')
+				matches.append((float(score), postInfoComponents[4], int(postInfoComponents[5]), \
+					int(postInfoComponents[6]), postContentStr.split('#', 3)[3], \
+					(int(postInfoComponents[2]), postInfoComponents[3])))
+
+		self.onSearchResults(numMatches, allCounted, offset, matches)
+
+	# Insert posts (each in the format: #PostInfo...|#PostContent) into the database
+	def insertPosts(self, postsData):
+		for postData in postsData:
+			postInfoStr, postContentStr = postData.split('|', 1)
+			self.readerDB.insertPost(postInfoStr, postContentStr)
+
+	# Annotate the lines of a page (each in the format: '#[linenum]#[line]') with whether
+	# they have read / unread posts
+	# Returns a list of: (post status character, line number, line)
+	def annotatePage(self, bookName, pageNum, pageContents):
+		lines = []
+		for pageContent in pageContents:
+			_, linenum, linecontent = pageContent.split('#', 2)
+			lineNum = int(linenum)
+			lines.append((self.readerDB.consultPostsStatus(bookName, pageNum, lineNum), lineNum, linecontent))
+		return lines
+
+	# Returns whether the given page is the one the reader is on
+	def isCurrentPage(self, bookName, pageNum):
+		return (bookName == self.currentBookname and pageNum == self.currentPagenumber)
+
+	# ----------------------------------------------------
+	# Requests
+	# ----------------------------------------------------
+
+	# Display a page of a book: the page is requested and the reader's posts on it are
+	# brought up to date, then 'onPageDisplayed' is called
+	def displayPage(self, bookName, pageNum):
+		self.currentBookname = bookName
+		self.currentPagenumber = pageNum
+
+		# Pull mode - request the page along with its posts
+		if (self.opmode == 'pull'):
+			self.reqDisplayPageWithPosts(bookName, pageNum)
+			return
 
-# Submit a reqest to update server's post database with server's
-# (involves considering ALL post id's server has)
-def reqSyncPosts():
+		# Push mode, only subscribed to this book/page - follow the reader to the
+		# new book/page, and fetch the posts on it that were not pushed
+		# NOTE: Requests are answered in order, so the page follows any sync in progress
+		if (self.subscribeScope != 'all'):
+			self.reqSubscribe(self.subscribeScope, bookName, pageNum)
+			self.reqUpdateLocalPosts(bookName, pageNum)
+
+		# Request to display the page
+		self.reqDisplayPage(bookName, pageNum)
+
+	# [Push mode] Choose which new posts the server pushes to this reader
+	def subscribe(self, scope):
+		self.subscribeScope = scope
+		if (scope == 'all'):
+			# Catch up on the posts that were not pushed meanwhile
+			self.reqSubscribe(scope, self.currentBookname, self.currentPagenumber)
+			self.reqSyncPosts()
+		elif (self.currentBookname != ""):
+			self.reqSubscribe(scope, self.currentBookname, self.currentPagenumber)
+
+	# Post to a line of the current page
+	def postToForum(self, lineNum, postContent):
+
+		# Create the two strings for the post:
+		# postInfoString: 	'#NewPostInfo#SenderName#BookName#PageNumber#LineNumber'
+		# postContentString: 	'#NewPostContent#Content'
+		postInfoStr = "#NewPostInfo#" + self.userName + "#" + self.currentBookname + "#" \
+				+ str(self.currentPagenumber) + "#" + str(lineNum)
+		postContentStr = "#NewPostContent#" + postContent
+
+		self.sendNewPost(postInfoStr, postContentStr)
+
+	# Read the posts on a line of the current page, marking them read
+	# Returns a list of: (postID, sender name, post content, whether it was unread)
+	def readPosts(self, lineNum):
+		posts = []
+		for postid in self.readerDB.getPostIDs(self.currentBookname, self.currentPagenumber, lineNum):
+			postInfo, postContent = self.readerDB.getPost(postid)
+			senderName, _, _, _, readStatus = postInfo
+			posts.append((postid, senderName, postContent, readStatus == self.readerDB.UNREAD))
 
-	# Get the list of current posts this reader has
-	postIDs = readerDB.getAllPostIDs()
+			# Set the post to be read in the database
+			self.readerDB.setRead(postid)
+		return posts
+
+	# Send a chat message to another reader
+	# Returns whether a chat session with them had been started
+	def sendChatMessage(self, chatTarget, chatMessage):
+		if (not self.chat.hasChatClient(chatTarget)):
+			return False
+		self.chat.sendChatMessage(chatMessage, self.chat.chatClients[chatTarget])
+		return True
+
+	# Answer an invitation to chat from another reader (A)
+	def respondChatInvite(self, aUsername, aIP, aChatport, accept):
+
+		# Send an acceptance notification to server in the format:
+		# '#RelayStartChatResp#Accept#[BChatport]#[AUsername]#[AChatport]
+		if (accept):
+			self.sock.send('#RelayStartChatResp#Accept#' + str(self.chat.chatPortnum) + \
+					'#' + aUsername + '#' + str(aChatport))
+			self.chat.chatClients[aUsername] = (aIP, aChatport)
+
+		# Send a reject notification to server in format:
+		# '#RelayStartChatResp#Reject#[AUsername]
+		else:
+			self.sock.send('#RelayStartChatResp#Reject#' + aUsername)
 
-	# Construct string to send
-	syncReqStr = '#SyncPostsReq#'
-	for i in range(0,len(postIDs)):
-		syncReqStr = syncReqStr + str(postIDs[i])
-		if (i < len(postIDs)-1):
-			syncReqStr = syncReqStr + ','
-	sock.send(syncReqStr)
+	# Submit a reqest to update server's post database with server's
+	# (only the posts inserted after the reader's sync cursor are sent back)
+	# with a message of format:
+	# '#SyncPostsReq#[sync cursor]'
+	def reqSyncPosts(self):
 
-# Submit a request to get a stream of posts, for a particular book and page,
-# that the reader does NOT have
-def reqUpdateLocalPosts(bookname, pagenum):
+		# Note when (and how many bytes in) the sync began, to report its cost
+		self.syncStarted = (time.time(), self.sock.bytesReceived)
 
-	# Obtain a list of post ID's (in the reader's DB) that are associated
-	# with given bookname and page number
-	knownIDs = readerDB.getPostIDs(bookname, pagenum)
+		self.sock.send('#SyncPostsReq#' + str(self.readerDB.syncCursor))
 
-	# Construct the string to send in the format:
+	# Submit a request to get a stream of posts, for a particular book and page,
+	# that the reader does NOT have, in the format:
 	# '#GetPostsLocReq#[bookname]#[pagenum]#[postID],[postID]...'
-	reqStr = '#GetPostsLocReq#' + bookname + '#' + str(pagenum) + '#'
-	for i in range(0, len(knownIDs)):
-		reqStr = reqStr + str(knownIDs[i])
-		if (i < len(knownIDs)-1):
-			reqStr = reqStr + ','
-	sock.send(reqStr)
-	
-# Submit a request to dipslay the contents of a page
-# with a message of format:
-# '#DisplayReq#[bookname]#[pagenum]'
-def reqDisplayPage(bookName, pageNum):
-
-	reqStr = '#DisplayReq#' + str(bookName) + '#' + str(pageNum)
-	sock.send(reqStr)
-
-# Uploads a new post to the server
-# with a message of format:
-# '#UploadPost#^postInfoStr|^postContentStr'	
-def sendNewPost(postInfoStr, postContentStr):
-
-	print "Submitting the post..."
-
-	# Use socket to send post
-	newPostStr = '#UploadPost' + postInfoStr + '|' + postContentStr
-	sock.send(newPostStr)
-
-# Display the posts for a particular book, page, and line
-# Involves querying the database, given the bookName, pageNum, and lineNum
-# NOTE: The given pageNum and lineNum are NOT index based
-def displayPosts(bookName, pageNum, lineNum):
-
-	print "Displaying posts:"
-
-	# Obtain the list of post ids for the particular page and line
-	postids = readerDB.getPostIDs(bookName, pageNum, lineNum)
-
-	# Display the retrieved posts to the user
-	print "From book '%s', Page %d, Line number %d:" % (bookName, pageNum, lineNum)
-	if (len(postids) == 0):
-		print "\tNo posts to display."
-	else:
-		for postid in postids:
-			postInfo, postContent = readerDB.getPost(postid)
-			senderName, _, _, _, readStatus = postInfo
+	def reqUpdateLocalPosts(self, bookname, pagenum):
+		knownIDs = self.readerDB.getPostIDs(bookname, pagenum)
+		reqStr = '#GetPostsLocReq#' + bookname + '#' + str(pagenum) + '#' + ','.join(map(str, knownIDs))
+		self.sock.send(reqStr)
+
+	# [Pull mode] Submit a request to be sent the posts on a page after the version the reader has,
+	# waiting for at most the poll interval if there are none yet, with a message of format:
+	# '#WatchPageReq#[bookname]#[pagenum]#[version]#[timeout]'
+	def reqWatchPage(self, bookname, pagenum):
+		version = self.readerDB.getPageVersion(bookname, pagenum)
+		self.sock.send('#WatchPageReq#' + bookname + '#' + str(pagenum) + '#' + str(version) + \
+				'#' + str(self.pollInterval))
+
+	# [Push mode] Submit a request to only be pushed the posts for the given scope
+	# ('all', or the current 'book' or 'page'), with a message of format:
+	# '#SubscribeReq#*'  or  '#SubscribeReq#[bookname]'  or  '#SubscribeReq#[bookname]#[pagenum]'
+	def reqSubscribe(self, scope, bookName, pageNum):
+		reqStr = '#SubscribeReq#*'
+		if (scope == 'book'):
+			reqStr = '#SubscribeReq#' + bookName
+		elif (scope == 'page'):
+			reqStr = '#SubscribeReq#' + bookName + '#' + str(pageNum)
+		self.sock.send(reqStr)
+
+	# Submit a request to dipslay the contents of a page
+	# with a message of format:
+	# '#DisplayReq#[bookname]#[pagenum]'
+	def reqDisplayPage(self, bookName, pageNum):
+		self.sock.send('#DisplayReq#' + str(bookName) + '#' + str(pageNum))
+
+	# [Pull mode] Submit a request to display the contents of a page, along with the posts on it
+	# that the reader does not have (both come back in one response, granted the stream window
+	# up front), with a message of format:
+	# '#DisplayPageReq#[bookname]#[pagenum]#[version]#[window]'
+	def reqDisplayPageWithPosts(self, bookName, pageNum):
+		version = self.readerDB.getPageVersion(bookName, pageNum)
+		self.sock.send('#DisplayPageReq#' + bookName + '#' + str(pageNum) + '#' + str(version) + \
+				'#' + str(self.streamWindow))
+
+	# Uploads a new post to the server
+	# with a message of format:
+	# '#UploadPost#^postInfoStr|^postContentStr'
+	def sendNewPost(self, postInfoStr, postContentStr):
+		self.sock.send('#UploadPost' + postInfoStr + '|' + postContentStr)
+
+	# Submit a request to initiate a chat session with a given username
+	# in the format:
+	# '#StartChatReq#[TargetUserName]#[PortNumToUse]'
+	def reqChatSession(self, targetUser):
+		self.sock.send('#StartChatReq#' + targetUser + '#' + str(self.chat.chatPortnum))
+
+	# Search the books and / or posts ('scope' - see SEARCH_SCOPES) for the words of a query,
+	# requesting 'count' matches from 'offset' on (the best first)
+	# with a message of format:
+	# '#SearchReq#[scope]#[offset]#[count]#[query]'
+	def reqSearch(self, scope, query, offset, count):
+		self.sock.send('#SearchReq#' + scope + '#' + str(offset) + '#' + str(count) + '#' + query)
+
+	# Submit a request for the server's metrics
+	# with a message of format:
+	# '#StatsReq'
+	def reqStats(self):
+		self.sock.send('#StatsReq')
+
+	# Say goodbye to the server, which then closes the connection
+	def sendExit(self):
+		self.sock.send("#Exit#" + self.userName)
+
+	# ----------------------------------------------------
+	# Events (overridden by subclasses)
+	# ----------------------------------------------------
+
+	# A page has been displayed, as a list of: (post status character, line number, line)
+	def onPageDisplayed(self, bookName, pageNum, lines):
+		pass
+
+	# A page could not be displayed
+	def onDisplayError(self, errorMsg):
+		pass
+
+	# The server has answered an upload (errorMsg is None if the post was accepted)
+	def onPostUploaded(self, errorMsg):
+		pass
+
+	# The database has been synced with the server's
+	def onSynced(self, numPosts, numBytes, elapsed):
+		pass
+
+	# A post has been pushed by the server
+	def onPostPushed(self, postID, bookName, pageNum):
+		pass
+
+	# New posts on a page have been fetched from the server
+	def onNewPosts(self, bookName, pageNum, numPosts):
+		pass
+
+	# Another reader (A) has invited this one to chat (see 'respondChatInvite')
+	def onChatInvite(self, aUsername, aIP, aChatport):
+		pass
+
+	# Another reader (B) has answered this one's invitation to chat: the response is
+	# 'Accept' / 'Reject' (with B's user name), or 'Error' (with the error message)
+	def onChatResponse(self, response, detail):
+		pass
+
+	# A chat message has been received from another reader
+	def onChatMessage(self, sender, chatMsg):
+		pass
+
+	# The server's metrics have been received (in the Prometheus text format)
+	def onStats(self, metricsText):
+		pass
+
+	# A page of the matches of a search has been received (see 'onSearchResp' for the
+	# format of the matches), out of 'numMatches' in all - or at least, unless 'allCounted'
+	def onSearchResults(self, numMatches, allCounted, offset, matches):
+		pass
+
+	# A search could not be made
+	def onSearchError(self, errorMsg):
+		pass
+
+	# A message that the reader does not know has been received
+	def onUnknownMessage(self, data):
+		pass
+
+	# The server has closed the connection
+	def onDisconnected(self):
+		pass
+
+# This class is a reader driven by a user, who types in commands and is shown the
+# pages / posts / chats as they arrive
+class InteractiveReader(ReaderClient):
+
+	# Commands that the user can enter
+	COMMANDS = ['exit', 'help', 'display', 'post_to_forum', 'read_post', 'subscribe', 'chat_request', 'chat', 'search', 'stats']
+
+	# Seconds to wait for the server to close the connection after saying goodbye
+	EXIT_TIMEOUT = 2.0
+
+	# Constructor (see ReaderClient)
+	def __init__(self, loop, userName, opmode, pollInterval, streamWindow=DEFAULT_STREAM_WINDOW, readerDB=None):
+		ReaderClient.__init__(self, loop, userName, opmode, pollInterval, streamWindow, readerDB)
+		self.chatInvites = []		# invitations to chat, waiting on the user's answer
+		self.nextSearch = None		# (scope, query, offset) of the next page of matches of the last search
+		self.exiting = False
+
+	# Start reading the user's commands
+	def start(self):
+		self.loop.addReader(sys.stdin, self.onStdinReadable)
+
+	# Handle a line entered by the user
+	def onStdinReadable(self):
+		line = sys.stdin.readline()
+
+		# No more input - treat as exit
+		if (line == ""):
+			self.loop.removeReader(sys.stdin)
+			if (not self.exiting):
+				self.exit()
+			return
+
+		user_input = line.rstrip()
 
-			# Construct the string to be printed, containing the post
-			printStr = ""
-			if (readStatus == readerDB.UNREAD):
-				printStr = printStr + "[UNREAD]"
+		# The user is answering an invitation to chat
+		if (len(self.chatInvites) > 0):
+			self.answerChatInvite(user_input == 'y')
+			return
+
+		self.runCommand(user_input.split(' '))
+
+	# Run a single command entered by the user
+	def runCommand(self, user_input):
+
+		# Send an exit message to server before shutting down reader
+		if (user_input[0] == 'exit' or user_input[0] == 'q'):
+			self.exit()
+			return
+
+		# Print documentation of valid commands
+		elif (user_input[0] == 'help'):
+			print "Valid commands:"
+			print self.COMMANDS
+
+		# Display the page of the specified book
+		elif (user_input[0] == 'display'):
+			if (len(user_input) < 3):
+				print "Usage: display [book_name] [page_number]"
+				return
+			self.displayPage(user_input[1], int(user_input[2]))
+
+		# [Push mode] Choose which new posts the server pushes to this reader
+		elif (user_input[0] == 'subscribe'):
+			if (len(user_input) < 2 or user_input[1] not in self.SUBSCRIBE_SCOPES):
+				print "Usage: subscribe [all | book | page]"
+				return
+
+			if (self.opmode != 'push'):
+				print "Subscriptions only apply in push mode."
+				return
+
+			self.subscribe(user_input[1])
+			print "Subscribed to new posts in: %s" % user_input[1]
+
+		# Send a new post to the server
+		elif (user_input[0] == 'post_to_forum'):
+
+			# Check if currentBookname/cuirrentPagenum is initialised
+			if (self.currentBookname == ""):
+				print "Uncertain book and page. Use the command 'display' to initialise."
+				return
+
+			# Check if command is used properly
+			if (len(user_input) < 3):
+				print "Usage: post_to_forum [line number] [post content]"
+				return
+
+			# Check if given line number is valid
+			try:
+				postLine = int(user_input[1])
+			except ValueError:
+				print "Invalid line number '%s' to post to." % user_input[1]
+				return
+
+			print "Submitting the post..."
+			self.postToForum(postLine, ' '.join(user_input[2:]))
+
+		# Display the posts for a particular line number on the current book and page
+		elif (user_input[0] == 'read_post'):
+			if (len(user_input) < 2):
+				print "Usage: read_post [line number]"
+				return
+
+			# Check if currentBookname is initialised
+			if (self.currentBookname == ""):
+				print "Uncertain book. Use the command 'display' to initialise."
+				return
+
+			self.displayPosts(int(user_input[1]))
+
+		# Start a chat session with given username
+		elif (user_input[0] == 'chat_request'):
+			if (len(user_input) < 2):
+				print "Usage: chat_request [username]"
+				return
+
+			targetUser = user_input[1]
+
+			# Check if there is already a chat session with specified target
+			if (self.chat.hasChatClient(targetUser)):
+				print "You are already able to converse with '%s'!" % targetUser
+				return
+
+			# Submit request to initiate chat session
+			self.reqChatSession(targetUser)
+			print "Submitted request to chat with '%s'!" % targetUser
+
+		# Send a chat message to a particular client
+		elif (user_input[0] == 'chat'):
+			if (len(user_input) < 3):
+				print "Usage: chat [username] [message]"
+				return
+
+			# Parse the information
+			chatTarget = user_input[1]
+			if (self.sendChatMessage(chatTarget, ' '.join(user_input[2:]))):
+				print "Sent!"
+			else:
+				print "Error: Chat session with '%s' not instantiated." % chatTarget
+				print "Use 'chat_request' command to initiate chat session."
+
+		# Search the books and / or posts, showing a page of the matches at a time
+		# ('search' alone shows the next page of the last search)
+		elif (user_input[0] == 'search'):
+			searchWords = [ word for word in user_input[1:] if word != '' ]
+			if (len(searchWords) == 0):
+				if (self.nextSearch is None):
+					print "Usage: search [all | books | posts] [words to search for]"
+					return
+				scope, query, offset = self.nextSearch
 			else:
-				printStr = printStr + "        "
-			printStr = printStr + " " + str(postid) + " " + senderName + ": " + postContent
-			print printStr
+				scope = 'all'
+				if (searchWords[0] in self.SEARCH_SCOPES):
+					scope = searchWords.pop(0)
+				if (len(searchWords) == 0):
+					print "Usage: search [all | books | posts] [words to search for]"
+					return
+				query, offset = ' '.join(searchWords), 0
+
+			self.nextSearch = (scope, query, offset + SEARCH_PAGE_SIZE)
+			self.reqSearch(scope, query, offset, SEARCH_PAGE_SIZE)
+
+		# Show the server's metrics
+		elif (user_input[0] == 'stats'):
+			self.reqStats()
+
+		# Unknown command
+		else:
+			print "Unrecognised command:", user_input[0]
 
-			# Set the post to be read in the database
-			readerDB.setRead(postid)
+		print ""	# Formatting
 
-# Submit a request to initiate a chat session with a given username
-# in the format:
-# '#StartChatReq#[TargetUserName]#[PortNumToUse]'
-def reqChatSession(targetUser):
+	# Display the posts for a particular line of the current page, marking them read
+	def displayPosts(self, lineNum):
 
-	# Construct and send a chat request string
-	reqStr = '#StartChatReq#' + targetUser + '#' + str(chatThread.chatPortnum)
-	sock.send(reqStr)
+		print "Displaying posts:"
 
-# Send a stream of data to server, while controlling when the client
-# should continue sending. Uses the reader socket to send messages.
-# Note: Tacks on a '#' to endMsg and ackPhrase to adhere to message format rules
-def sendStream(listToSend, startMsg, startAckPhrase, ackPhrase, endMsg):
+		# Display the retrieved posts to the user
+		print "From book '%s', Page %d, Line number %d:" % (self.currentBookname, self.currentPagenumber, lineNum)
+		posts = self.readPosts(lineNum)
+		if (len(posts) == 0):
+			print "\tNo posts to display."
+		for postid, senderName, postContent, wasUnread in posts:
+			if (wasUnread):
+				printStr = "[UNREAD]"
+			else:
+				printStr = "        "
+			print printStr + " " + str(postid) + " " + senderName + ": " + postContent
+
+	# Say goodbye to the server - the loop stops once it has closed the connection
+	def exit(self):
+		self.exiting = True
+		if (not self.isConnected()):
+			self.loop.stop()
+			return
 
-	# Send start message
-	sock.send('#' + startMsg)
+		print "Saying goodbye to server..."
+		self.sendExit()
+		self.loop.callLater(self.EXIT_TIMEOUT, self.loop.stop)
+
+	# Prompt the user (client B) whether they want to start a chat conversation with client A
+	def onChatInvite(self, aUsername, aIP, aChatport):
+		self.chatInvites.append((aUsername, aIP, aChatport))
+		if (len(self.chatInvites) == 1):
+			self.promptChatInvite()
+
+	# Prompt the user to answer the first of the invitations to chat
+	def promptChatInvite(self):
+		print self.chatInvites[0][0] + ' wants to chat with you! Accept? [y/n]'
+		sys.stdout.write('> ')
+		sys.stdout.flush()
+
+	# Answer the first of the invitations to chat with the user's response
+	def answerChatInvite(self, accept):
+		aUsername, aIP, aChatport = self.chatInvites.pop(0)
+		self.respondChatInvite(aUsername, aIP, aChatport, accept)
+		if (accept):
+			print "You can now chat to '%s'!" % aUsername
+			print "You can do so using the command: 'chat %s [chat content]'" % aUsername
+		else:
+			print "Rejected chat with '%s'." % aUsername
+		print ""	# formatting
 
-	# Wait for an ack from server to start stream before sending stream items
-	msg = selectRecv(BUFFER_SIZE)
-	while (msg != ('#' + startAckPhrase)):
-		msg = selectRecv(BUFFER_SIZE)
+		if (len(self.chatInvites) > 0):
+			self.promptChatInvite()
 
-	# Ack received. Start sending stream
-	for listItem in listToSend:
-		sock.send(listItem)
+	# Print the lines of a page, marking the lines with read / unread posts
+	def onPageDisplayed(self, bookName, pageNum, lines):
+		print "Book '%s', Page %d:" % (bookName, pageNum)
+		for linePostsStatus, lineNum, linecontent in lines:
+			print "%c  %d %s" % (linePostsStatus, lineNum, linecontent)
 
-		# Wait for user acknowledgement
-		msg = selectRecv(BUFFER_SIZE)
-		while (msg != ('#' + ackPhrase)):
-			msg = selectRecv(BUFFER_SIZE)
+	def onDisplayError(self, errorMsg):
+		print 'Error: ' + errorMsg
 
-	# Send end message to indicate (toserver) end of stream
-	sock.send('#' + endMsg)
+	def onPostUploaded(self, errorMsg):
+		if (errorMsg is not None):
+			print "Error uploading post: " + errorMsg
+		else:
+			print "Successfully posted!"
 
-# Obtain a stream of data from server
-# Returns a list of all the messages
-# NOTE: Tacks on a '#' to ackPhrase to adhere to message format rules
-def receiveStream(startAckPhrase, ackPhrase, endMsg):
+	def onSynced(self, numPosts, numBytes, elapsed):
+		print "Synced %d posts (%d bytes received) in %.3fs." % (numPosts, numBytes, elapsed)
+		if (numPosts == 0):
+			print "Database up to date!\n"
+		else:
+			print "Database updated!\n"
 
-	recvList = []
+	def onPostPushed(self, postID, bookName, pageNum):
+		if (self.isCurrentPage(bookName, pageNum)):
+			print "There are new posts!\n"
 
-	# Send the startAckPhrase to indicate the server can begin stream sending
-	sock.send('#' + startAckPhrase)
+	def onNewPosts(self, bookName, pageNum, numPosts):
+		print "There are new posts for this page!\n"
 
-	# Begin receiving the stream
-	msg = selectRecv(BUFFER_SIZE)
-	while (msg == ""):
-		msg = selectRecv(BUFFER_SIZE)
-	msgComponents = msg.split('#')
+	def onChatResponse(self, response, detail):
+		if (response == 'Accept'):
+			print "'%s' has accepted your chat invitation!" % detail
+			print "You can do so using the command: 'chat %s [chat content]'" % detail
+		elif (response == 'Reject'):
+			print detail + ' rejected your invitation to chat.'
 
-	# Parse each stream message
-	while (msgComponents[1] != endMsg):
-		recvList.append(msg)
-	
-		# Send an ack that a stream message is received
-		sock.send('#' + ackPhrase)
-
-		# Re-listen for a stream message
-		msg = selectRecv(BUFFER_SIZE)
-		while (msg == ""):
-			msg = selectRecv(BUFFER_SIZE)
-		msgComponents = msg.split('#')
-	return recvList	
-
-# Use 'select' module to obtain data from buffer
-def selectRecv(bufferSize):
-	listen_sockets = [sock]
-	read_sockets, write_sockets, error_sockets = select.select(listen_sockets, [], [])
-	for rs in read_sockets:
-		if (rs == sock):
-			data = sock.recv(bufferSize)
-			return data
+		# Error with client B
+		elif (response == 'Error'):
+			print "Error: " + detail
+
+		print ""	# Formatting
+
+	def onChatMessage(self, sender, chatMsg):
+		print "'%s' says: %s" % (sender, chatMsg)
+
+	def onStats(self, metricsText):
+		print "Server metrics:"
+		print metricsText
+
+	def onSearchResults(self, numMatches, allCounted, offset, matches):
+		if (len(matches) == 0):
+			print "No matches found.\n"
+			self.nextSearch = None
+			return
+
+		if (allCounted):
+			print "Matches %d to %d of %d:" % (offset + 1, offset + len(matches), numMatches)
+		else:
+			print "Matches %d to %d of at least %d:" % (offset + 1, offset + len(matches), numMatches)
+		for score, bookName, pageNum, lineNum, text, post in matches:
+			if (post is None):
+				print "%6.2f  %s, page %d, line %d: %s" % (score, bookName, pageNum, lineNum, text)
+			else:
+				print "%6.2f  %s, page %d, line %d: post %d by %s: %s" % \
+					(score, bookName, pageNum, lineNum, post[0], post[1], text)
+
+		if (offset + len(matches) < numMatches or not allCounted):
+			print "Enter 'search' for more matches.\n"
+		else:
+			self.nextSearch = None
+			print ""	# Formatting
+
+	def onSearchError(self, errorMsg):
+		self.nextSearch = None
+		print "Error searching: " + errorMsg + "\n"
+
+	def onUnknownMessage(self, data):
+		print 'Unknown message received: %s"' % data
+
+	def onDisconnected(self):
+		if (not self.exiting):
+			print "Server has closed the connection."
+		self.loop.stop()
+
+# ----------------------------------------------------
+# MAIN FUNCTIONS
+# ----------------------------------------------------
+
+# Returns whether a stream from the server is a single error message,
+# in the format: '#Error#[Error message]'
+def isErrorStream(streamItems):
+	return (len(streamItems) == 1 and streamItems[0].split('#')[1] == 'Error')
 
 # ----------------------------------------------------
 # MAIN PROCEDURE
 # ----------------------------------------------------
 
-#Usage: python reader.py mode polling_interval user_name server_name server_port_number
+#Usage: python reader.py mode polling_interval user_name server_name server_port_number [stream_window] [cache_dir]
 def main():
 
-	# Global var declarations
-	global sock
-	global readerDB
-	global currentBookname, currentPagenumber
-	global MSG_SUCCESS, BUFFER_SIZE
-	global lock
-	global user_name, opmode, poll_interval
-	global chatThread
-
 	# Extract information from arguments provided
 	if (len(argv) < 6):
-		print "Usage: python reader.py [mode] [poll interval] [user_name] [server_name] [server_port_number]"
+		print "Usage: python reader.py [mode] [poll interval] [user_name] [server_name] [server_port_number] [stream_window] [cache_dir]"
 		exit()
-	script, opmode, poll_interval_str, user_name, server_name, server_port_str = argv
+	opmode, poll_interval_str, user_name, server_name, server_port_str = argv[1:6]
 	server_port = int(server_port_str)
 	poll_interval = int(poll_interval_str)
 
-	# Initialise other global vars
-	lock = threading.Lock()				# When reading and writing to terminal involving raw_input
-	currentBookname = ""
-	currentPagenumber = 0
-	MSG_SUCCESS = 'OK'
+	# Number of stream items the server may send ahead of our acks (0 = whole stream at once)
+	stream_window = DEFAULT_STREAM_WINDOW
+	if (len(argv) > 6):
+		stream_window = min(max(int(argv[6]), 0), MAX_STREAM_WINDOW)
 
-	# Constants
-	BUFFER_SIZE = 1024
+	# Directory to cache the posts in between runs (none = start empty every run)
+	cache_dir = None
+	if (len(argv) > 7):
+		cache_dir = argv[7]
 
 	# DEBUGGING
 	print "Username: \t", user_name
@@ -705,203 +1416,46 @@ def main():
 	print "At port: \t", server_port
 	print "Mode: \t\t",opmode
 	print "Poll interval: \t",poll_interval
+	print "Stream window: \t",stream_window
 
 	# Initialise Reader Database
 	print "Initialising reader database..."
 	readerDB = ReaderDB()
 
-	# Prepare the socket
-	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)	# TCP
+	# Load the posts cached by this user's previous runs
+	readerCache = None
+	if (cache_dir is not None):
+		if (not os.path.isdir(cache_dir)):
+			os.makedirs(cache_dir)
+		readerCache = ReaderCache(os.path.join(cache_dir, user_name + '.posts'))
+		startTime = time.time()
+		numCached = readerCache.load(readerDB)
+		print "Loaded %d posts from cache in %.3fs (sync cursor %d)." % \
+			(numCached, time.time() - startTime, readerDB.syncCursor)
+
+	# The server connection, chats and user's commands are all run on one event loop
+	loop = EventLoop()
+	reader = InteractiveReader(loop, user_name, opmode, poll_interval, stream_window, readerDB)
 
 	# Attempt to connect to server
 	print "Connecting to server '%s'..." % server_name
 	try:
-		sock.connect((server_name, server_port))
+		reader.connect(server_name, server_port)
 	except socket.error, e:
 		print "Error connecting to server: %s" % e
 		exit()
 	print "Successfully connected to server!"
 
-	# Send intro message with info about this client
-	# Format: '#Intro#[Username]#[Opmode]#[IP addr]
-	intro_message = "#Intro#" + user_name + "#" + opmode + "#" + str(socket.gethostbyname(socket.getfqdn()))
-	sock.send(intro_message)
-
-	# Start the background, listen, and chat threads
-	print "Starting background threads..."
-	backgroundThread = BackgroundThread()
-	backgroundThread.start()
-	listenThread = ListenThread()
-	listenThread.start()
-	chatThread = ChatThread()
-	chatThread.start()
-
 	# Run the reader
 	print "Reader is now up and running!\n"
-	commands = ['exit', 'help', 'display', 'post_to_forum', 'read_post']
-	listen_sockets = [sys.stdin]
-	reader_exit_req = False
-	while (not reader_exit_req):
-	
-		# Use select module to read from stdin
-		read_sockets, write_sockets, error_sockets = select.select(listen_sockets, [], [])
-		for rs in read_sockets:
-			if (rs == sys.stdin):
-
-				user_input = sys.stdin.readline().rstrip()
-				user_input = user_input.split(' ')
-
-				# Send an exit message to server before shutting down reader
-				if (user_input[0] == 'exit' or user_input[0] == 'q'):
-
-					# Set current command in backgroundthread
-					backgroundThread.setCommand(user_input[0])
-				
-					print "Saying goodbye to server..."
-					exit_message = "#Exit#" + user_name
-					sock.send(exit_message)
-					reader_exit_req = True
-
-				# Print documentation of valid commands
-				elif (user_input[0] == 'help'):
-
-					# Set current command in backgroundthread
-					backgroundThread.setCommand(user_input[0])
-
-					print "Valid commands:"	
-					print commands
-
-				# Display the page of the specified book
-				elif (user_input[0] == 'display'):
-					if (len(user_input) < 3):
-						print "Usage: display [book_name] [page_number]"
-						continue
-
-					bookname = user_input[1]
-					pagenum = int(user_input[2])
-
-					currentBookname = bookname
-					currentPagenumber = pagenum
-
-					# Set current command in backgroundthread
-					backgroundThread.setCommand(user_input[0])
-
-					# Check whether database is updated
-					while (not backgroundThread.updateDBComplete):
-						time.sleep(0.001)
-		
-					# Request to display the page
-					reqDisplayPage(bookname, pagenum)
-
-				# Send a new post to the server
-				elif (user_input[0] == 'post_to_forum'):
-
-					# Check if currentBookname/cuirrentPagenum is initialised
-					if (currentBookname == "" or currentPagenumber == ""):
-						print "Uncertain book and page. Use the command 'display' to initialise."
-						continue
-
-					# Check if command is used properly
-					if (len(user_input) < 3):
-						print "Usage: post_to_forum [line number] [post content]"
-						continue
-
-					# Set current command in backgroundthread
-					backgroundThread.setCommand(user_input[0])
-
-					# Check if given line number is valid
-					try:
-						postLine = int(user_input[1])
-					except ValueError:
-						print "Invalid line number '%s' to post to." % user_input[1]
-						continue			
-
-					# Construct the post content string
-					postContent = ' '.join(user_input[2:])	
-
-					# Create the two strings for the post:
-					# postInfoString: 	'#NewPostInfo#SenderName#BookName#PageNumber#LineNumber'
-					# postContentString: 	'#NewPostContent#Content'
-					postInfoStr = "#NewPostInfo#" + user_name + "#" + currentBookname + "#" \
-							+ str(currentPagenumber) + "#" + str(postLine)
-					postContentStr = "#NewPostContent#" + postContent
-
-					sendNewPost(postInfoStr, postContentStr)			
-
-				# Display the posts for a particular line number on the current book and page
-				elif (user_input[0] == 'read_post'):
-					if (len(user_input) < 2):
-						print "Usage: read_post [line number]"
-						continue
-
-					# Check if currentBookname is initialised
-					if (currentBookname == ""):
-						print "Uncertain book. Use the command 'display' to initialise."
-						continue
-
-					# Obtain the line number
-					postsLine = int(user_input[1])
-
-					# Set current command in backgroundthread
-					backgroundThread.setCommand(user_input[0])
-
-					# Display posts at the current book, page, and line
-					displayPosts(currentBookname, currentPagenumber, postsLine)
-	
-				# Start a chat session with given username
-				elif (user_input[0] == 'chat_request'):
-					if (len(user_input) < 2):
-						print "Usage: chat_request [username]"
-						continue
-
-					targetUser = user_input[1]
-			
-					# Set current command in backgroundthread
-					backgroundThread.setCommand(user_input[0])
-
-					# Check if there is already a chat session with specified target
-					if (chatThread.hasChatClient(targetUser)):
-						print "You are already able to converse with '%s'!" % targetUser
-						continue
-			
-					# Submit request to initiate chat session
-					reqChatSession(targetUser)	
-					print "Submitted request to chat with '%s'!" % targetUser
-
-				# Send a chat message to a particular client
-				elif (user_input [0] == 'chat'):
-					if (len(user_input) < 3):
-						print "Usage: chat [username] [message]"
-						continue
-		
-					# Parse the information
-					chatTarget = user_input[1]
-					chatMessage = ' '.join(user_input[2:])
-
-					# Check if target exists
-					try:
-						chatTargetInfo = chatThread.chatClients[chatTarget]
-						chatThread.sendChatMessage(chatMessage, chatTargetInfo)
-					
-						# Set current command in backgroundthread
-						backgroundThread.setCommand(user_input[0])
-
-					except KeyError:
-						print "Error: Chat session with '%s' not instantiated." % chatTarget
-						print "Use 'chat_request' command to initiate chat session."
-
-				# Unknown command
-				else:
-					print "Unrecognised command:", user_input[0]
-				
-				time.sleep(0.3)		# Formatting
-				print ""
+	reader.start()
+	loop.run()
 
 	# close the connection
 	print "Shutting down reader..."
-	backgroundThread.event.set()
-	listenThread.event.set()
-	chatThread.event.set()
+	reader.close()
+	if (readerCache is not None):
+		readerCache.close()
 	print "Exiting..."
 
 # ----------------------------------------------------
@@ -5,20 +5,40 @@ import socket
 import select
 import threading
 import random
-from sys import argv
+import argparse
+import errno
+import sys
 import os
 import time
+import heapq
+import signal
+import traceback
+import bisect
+import math
+import re
+from array import array
+from collections import deque, OrderedDict
+
+# Make the components shared with the reader importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.framing import FramedSocket, NonBlockingFramedSocket, FrameDecoder, encodeFrame
+from common.eventloop import EventLoop
+from common import logger
 
 # ----------------------------------------------------
 # CLASSES
 # ----------------------------------------------------
 
 # This class represents a book
+# If given a page cache, the book is loaded lazily: only the number of pages is
+# determined up front, and each page is read and parsed the first time it is used,
+# then kept in the (bounded) cache. Otherwise every page is loaded into memory.
 class Book(object):
 
-	def __init__(self, bookName, bookAuthor):
+	def __init__(self, bookName, bookAuthor, pageCache=None):
 		self.bookname = bookName
 		self.author = bookAuthor
+		self.pageCache = pageCache
 		
 		# Construct the book with pages and lines
 		self.pages = []
@@ -27,9 +47,10 @@ class Book(object):
 		self.numpages = len([name for name in os.listdir(bookName)])
 
 		# Initialise the page objects by reading each page file
-		for pagenum in range(1,self.numpages+1):
-			pageObj = Page(bookName, pagenum)	# page numbers need an offset
-			self.pages.append(pageObj)
+		if (self.pageCache is None):
+			for pagenum in range(1,self.numpages+1):
+				pageObj = Page(bookName, pagenum)	# page numbers need an offset
+				self.pages.append(pageObj)
 
 	# Return a list of strings containing all lines in a particular page
 	# Note: Assumes pageNum starts at 1 (NOT index based)
@@ -40,17 +61,30 @@ class Book(object):
 			errorStr = "#Error#Page %d does not exist." % (pageNum)
 			return [errorStr]
 
-		return self.pages[pageNum-1].getContent()
+		return self.getPageObj(pageNum).getContent()
+
+	# Return the lines in a particular page, encoded as a stream ending with 'endMsg'
+	# Note: Assumes pageNum starts at 1 (NOT index based)
+	def getEncodedPageContent(self, pageNum, endMsg):
+
+		# Check if pagenum is valid
+		if (not self.hasPage(pageNum)):
+			errorStr = "#Error#Page %d does not exist." % (pageNum)
+			return EncodedStream([errorStr], endMsg)
+
+		return self.getPageObj(pageNum).getEncodedContent(endMsg)
 
 	# Checks whether the page exists
 	# NOTE: pageNum is NOT index based
 	def hasPage(self, pageNum):
-		return (pageNum-1 in range(0, len(self.pages)))	
+		return (1 <= pageNum <= self.numpages)
 
 	# Returns a page object given a specific page number
 	# NOTE: page number is NOT index based
 	def getPageObj(self, pageNum):
-		return self.pages[pageNum-1]
+		if (self.pageCache is None):
+			return self.pages[pageNum-1]
+		return self.pageCache.get((self.bookname, pageNum), lambda: Page(self.bookname, pageNum))
 
 # This class represents a page
 # Note: a page has directory '[bookname]/[bookname]_page[pagenumber]'
@@ -73,6 +107,10 @@ class Page(object):
 			self.lines.append(lineObj)
 		self.numlines = lineNum
 
+		# Contents of the page already encoded as streams, by end message
+		# (the text of a page never changes, so they are built at most once)
+		self.encodedContent = {}
+
 	# Retrieve the contents on the page
 	def getContent(self):
 		pageLines = []
@@ -81,12 +119,64 @@ class Page(object):
 			pageLines.append(lineStr)
 		return pageLines	
 
+	# Retrieve the contents on the page, encoded as a stream ending with 'endMsg'
+	def getEncodedContent(self, endMsg):
+		encodedStream = self.encodedContent.get(endMsg)
+		if (encodedStream is None):
+			encodedStream = EncodedStream(self.getContent(), endMsg)
+			self.encodedContent[endMsg] = encodedStream
+		return encodedStream
+
 	# Returns whether there is a particular line number in the page
 	# NOTE: lineNum is NOT index based
 	def hasLine(self, lineNum):
-		return (lineNum-1 in range(0, len(self.lines)))
+		return (1 <= lineNum <= self.numlines)
 	
 
+# This class is a bounded cache of parsed pages, evicting the least recently used
+# Keeps count of hits and misses, to size the cache against the pages actually read
+class PageCache(object):
+
+	# Constructor given the maximum number of pages to keep
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.pages = OrderedDict()	# (bookname, pagenum) -> Page, least recently used first
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+
+	# Return the page with the given key, loading it with 'loadFunc' if it is not cached
+	def get(self, key, loadFunc):
+		self.lock.acquire()
+		try:
+			page = self.pages.pop(key, None)
+			if (page is not None):
+				self.hits = self.hits + 1
+				self.pages[key] = page		# now the most recently used
+				return page
+			self.misses = self.misses + 1
+		finally:
+			self.lock.release()
+
+		# Load the page outside the lock, so other pages can be served meanwhile
+		page = loadFunc()
+
+		self.lock.acquire()
+		try:
+			self.pages[key] = page
+			while (len(self.pages) > self.capacity):
+				self.pages.popitem(last=False)
+				self.evictions = self.evictions + 1
+		finally:
+			self.lock.release()
+		return page
+
+	# Return a summary of the cache's counters
+	def getStats(self):
+		return { 'size': len(self.pages), 'capacity': self.capacity, 'hits': self.hits, \
+			'misses': self.misses, 'evictions': self.evictions }
+
 # This is a class that represents a line on a page
 class Line(object):
 		
@@ -112,6 +202,912 @@ class Line(object):
 	def getContent(self):
 		return self.linecontent
 
+# This class allocates unique forum post IDs, in increasing order
+# IDs come from a counter, so allocating one (or a range of them) takes constant time.
+# To survive restarts, a ceiling is persisted to the state file one block of IDs
+# ahead of the counter. After a restart, allocation resumes from that ceiling -
+# IDs handed out before the restart are never reused (unused ones are skipped).
+class PostIDAllocator(object):
+
+	# Constants
+	BLOCK_SIZE = 1024		# IDs allocated between writes of the state file
+	MAX_ID_VAL = 2**63 - 1		# IDs are 64-bit
+
+	# Constructor given the first ID to allocate, and an optional state file
+	def __init__(self, firstID, stateFile=None):
+		self.nextID = firstID
+		self.ceiling = firstID		# IDs below the ceiling may be allocated without persisting
+		self.stateFile = stateFile
+		self.lock = threading.Lock()
+
+		# Resume from the ceiling persisted before the restart
+		if (self.stateFile is not None and os.path.exists(self.stateFile)):
+			persistedCeiling = int(open(self.stateFile, 'r').read().strip())
+			self.nextID = max(self.nextID, persistedCeiling)
+			self.ceiling = self.nextID
+
+	# Allocate a single ID
+	def allocate(self):
+		return self.reserve(1)[0]
+
+	# Allocate a contiguous range of 'count' IDs
+	# Returns the range of IDs reserved
+	def reserve(self, count):
+		self.lock.acquire()
+		try:
+			firstID = self.nextID
+			if (firstID + count - 1 > self.MAX_ID_VAL):
+				raise OverflowError("Post ID space exhausted.")
+			self.nextID = firstID + count
+			if (self.nextID > self.ceiling):
+				self.persistCeiling(self.nextID + self.BLOCK_SIZE)
+			return xrange(firstID, firstID + count)
+		finally:
+			self.lock.release()
+
+	# Make sure an ID that is already in use will not be allocated again
+	def advancePast(self, postID):
+		self.lock.acquire()
+		try:
+			if (postID >= self.nextID):
+				self.nextID = postID + 1
+				if (self.nextID > self.ceiling):
+					self.persistCeiling(self.nextID + self.BLOCK_SIZE)
+		finally:
+			self.lock.release()
+
+	# Record a new ceiling (atomically, by replacing the state file)
+	def persistCeiling(self, ceiling):
+		self.ceiling = ceiling
+		if (self.stateFile is None):
+			return
+		tmpFilename = self.stateFile + '.tmp'
+		tmpFile = open(tmpFilename, 'w')
+		tmpFile.write(str(ceiling) + '\n')
+		tmpFile.flush()
+		os.fsync(tmpFile.fileno())
+		tmpFile.close()
+		os.rename(tmpFilename, self.stateFile)
+
+# This class makes the forum posts in the server database durable
+# Every post inserted is appended to a write-ahead log before the upload is acknowledged,
+# and the log is fsync'ed in groups: by a flusher thread at least every 'fsyncInterval' seconds,
+# and, if 'fsyncEvery' is set, after that many posts. By default only the flusher syncs,
+# so no fsync happens while the database lock is held.
+# Periodically a compacted snapshot of every post is written, and the log segments it
+# covers are deleted, so recovery replays the snapshot plus only the log written since.
+#
+# Files in the data directory (each record is a frame - see common.framing):
+#   posts.snapshot 	'#Snapshot#[lastSegmentCovered]#[numPosts]', then one record per post
+#   posts.log.[segment]	one record per post
+# where a post record is in the format given by ServerDB.getPostAsStr
+class PostLog(object):
+
+	# Constants
+	SNAPSHOT_FILENAME = 'posts.snapshot'
+	LOG_PREFIX = 'posts.log.'
+	READ_SIZE = 1024 * 1024
+
+	# Constructor
+	def __init__(self, dataDir, fsyncEvery=0, fsyncInterval=1.0, snapshotEvery=10000):
+		self.dataDir = dataDir
+		self.fsyncEvery = fsyncEvery
+		self.fsyncInterval = fsyncInterval
+		self.snapshotEvery = snapshotEvery
+
+		self.segment = 0		# current log segment number
+		self.logFd = None
+		self.numUnsynced = 0		# records written since the last fsync
+		self.numSinceSnapshot = 0	# records in the log segments not covered by the snapshot
+		self.lock = threading.Lock()
+
+		if (not os.path.isdir(self.dataDir)):
+			os.makedirs(self.dataDir)
+
+	# Load the snapshot and replay the log segments written since, handing each post
+	# record to 'restoreFunc'. Then start a new log segment for appending.
+	# Returns a tuple: (numFromSnapshot, numFromLog)
+	def recover(self, restoreFunc):
+
+		# Restore the posts in the snapshot
+		numFromSnapshot = 0
+		lastCovered = -1
+		snapshotFilename = os.path.join(self.dataDir, self.SNAPSHOT_FILENAME)
+		if (os.path.exists(snapshotFilename)):
+			records, _ = self.readRecords(snapshotFilename)
+			if (len(records) > 0):
+				lastCovered = int(records[0].split('#')[2])
+				for record in records[1:]:
+					restoreFunc(record)
+				numFromSnapshot = len(records) - 1
+
+		# Replay the log segments the snapshot does not cover (in order)
+		numFromLog = 0
+		for segment in self.listSegments():
+			segmentFilename = self.segmentFilename(segment)
+			if (segment <= lastCovered):
+				os.remove(segmentFilename)
+				continue
+			records, validLength = self.readRecords(segmentFilename)
+			for record in records:
+				restoreFunc(record)
+			numFromLog = numFromLog + len(records)
+
+			# Cut off a record that was torn by a crash mid-write
+			if (validLength < os.path.getsize(segmentFilename)):
+				logFile = open(segmentFilename, 'r+b')
+				logFile.truncate(validLength)
+				logFile.close()
+			self.segment = segment
+
+		# Append to a fresh segment from now on
+		self.numSinceSnapshot = numFromLog
+		self.segment = max(self.segment, lastCovered) + 1
+		self.openSegment()
+
+		# Start flushing the log in the background
+		if (self.fsyncInterval > 0):
+			flusher = threading.Thread(target=self.runFlusher)
+			flusher.daemon = True
+			flusher.start()
+
+		return (numFromSnapshot, numFromLog)
+
+	# Append a post record to the log
+	# Returns whether it is time for a snapshot to be taken
+	def append(self, postDataStr):
+		self.lock.acquire()
+		try:
+			record = encodeFrame(postDataStr)
+			while (len(record) > 0):
+				numWritten = os.write(self.logFd, record)
+				record = record[numWritten:]
+			self.numUnsynced = self.numUnsynced + 1
+			self.numSinceSnapshot = self.numSinceSnapshot + 1
+			if (self.fsyncEvery > 0 and self.numUnsynced >= self.fsyncEvery):
+				self.sync()
+			return (self.snapshotEvery > 0 and self.numSinceSnapshot >= self.snapshotEvery)
+		finally:
+			self.lock.release()
+
+	# Close the current log segment and start the next one
+	# Returns the number of the segment closed, which a snapshot taken now should cover
+	def rotate(self):
+		self.lock.acquire()
+		try:
+			self.sync()
+			os.close(self.logFd)
+			closedSegment = self.segment
+			self.segment = self.segment + 1
+			self.numSinceSnapshot = 0
+			self.openSegment()
+			return closedSegment
+		finally:
+			self.lock.release()
+
+	# Write a snapshot holding the given post records, which cover every log segment
+	# up to (and including) 'lastCovered'. Then delete those segments.
+	def writeSnapshot(self, postDataStrs, lastCovered):
+		snapshotFilename = os.path.join(self.dataDir, self.SNAPSHOT_FILENAME)
+		tmpFilename = snapshotFilename + '.tmp'
+		snapshotFile = open(tmpFilename, 'wb')
+		snapshotFile.write(encodeFrame('#Snapshot#%d#%d' % (lastCovered, len(postDataStrs))))
+		for postDataStr in postDataStrs:
+			snapshotFile.write(encodeFrame(postDataStr))
+		snapshotFile.flush()
+		os.fsync(snapshotFile.fileno())
+		snapshotFile.close()
+		os.rename(tmpFilename, snapshotFilename)
+
+		for segment in self.listSegments():
+			if (segment <= lastCovered):
+				os.remove(self.segmentFilename(segment))
+
+	# Flush any records written to the log to disk
+	# NOTE: Assumes the lock is held
+	def sync(self):
+		if (self.numUnsynced > 0):
+			os.fsync(self.logFd)
+			self.numUnsynced = 0
+
+	# Sync and close the log
+	def close(self):
+		self.lock.acquire()
+		try:
+			if (self.logFd is not None):
+				self.sync()
+				os.close(self.logFd)
+				self.logFd = None
+		finally:
+			self.lock.release()
+
+	# Flusher thread - bounds how long a record may stay unsynced
+	def runFlusher(self):
+		while True:
+			time.sleep(self.fsyncInterval)
+			self.lock.acquire()
+			try:
+				if (self.logFd is not None):
+					self.sync()
+			finally:
+				self.lock.release()
+
+	# Open the current segment for appending
+	def openSegment(self):
+		self.logFd = os.open(self.segmentFilename(self.segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+
+	# Return the filename of a log segment
+	def segmentFilename(self, segment):
+		return os.path.join(self.dataDir, self.LOG_PREFIX + str(segment))
+
+	# Return the numbers of the log segments in the data directory, in order
+	def listSegments(self):
+		segments = []
+		for filename in os.listdir(self.dataDir):
+			if (filename.startswith(self.LOG_PREFIX)):
+				suffix = filename[len(self.LOG_PREFIX):]
+				if (suffix.isdigit()):
+					segments.append(int(suffix))
+		return sorted(segments)
+
+	# Read all the whole records in a file
+	# Returns a tuple: (records, lengthOfWholeRecords)
+	def readRecords(self, filename):
+		decoder = FrameDecoder()
+		records = []
+		dataFile = open(filename, 'rb')
+		data = dataFile.read(self.READ_SIZE)
+		length = 0
+		while (data != ''):
+			records.extend(decoder.feed(data))
+			length = length + len(data)
+			data = dataFile.read(self.READ_SIZE)
+		dataFile.close()
+		return (records, length - decoder.pending)
+
+# This class stores the posts compactly, as columns with one row per post (in insert order)
+# Post ID's, page and line numbers are held in arrays, sender and book names are interned
+# in a table (the columns holding their index), and the contents of all the posts are
+# concatenated in a single buffer - so a post costs a few dozen bytes plus its content,
+# rather than a handful of Python objects
+# NOTE: Rows are looked up by bisecting the ID column while ID's are inserted in ascending
+# order (as the allocator hands them out). Once one is not (eg. a reserved ID inserted late),
+# a dict of ID -> row is built and used from then on.
+class PostStore(object):
+
+	# Constructor
+	def __init__(self):
+
+		# Columns
+		self.ids = array('l')
+		self.senders = array('i')	# index into names
+		self.books = array('i')		# index into names
+		self.pages = array('i')
+		self.lines = array('i')
+		self.contentEnds = array('l')	# end of each post's content in 'content'
+		self.content = bytearray()
+		self.originSeqs = array('l')	# sequence number of each post at the node it came from
+
+		# Interned sender / book names
+		self.names = []
+		self.nameIndex = {}
+
+		# ID -> row, once ID's are not in ascending order
+		self.rowByID = None
+
+	# Number of posts stored
+	def __len__(self):
+		return len(self.ids)
+
+	# Whether a post with the given ID is stored
+	def __contains__(self, postID):
+		return (self.findRow(postID) is not None)
+
+	# Add a post, returning its row
+	# NOTE: Assumes a single thread adds posts at a time. The ID is added last, so a
+	# post is not found until all of it has been stored.
+	def append(self, postID, sender, bookname, page, line, content, originSeq=0):
+		row = len(self.ids)
+		self.senders.append(self.internName(sender))
+		self.books.append(self.internName(bookname))
+		self.pages.append(page)
+		self.lines.append(line)
+		self.content.extend(content)
+		self.contentEnds.append(len(self.content))
+		self.originSeqs.append(originSeq)
+
+		# Switch to looking up rows through a dict when the ID's go out of order
+		if (self.rowByID is None and row > 0 and postID <= self.ids[row-1]):
+			self.rowByID = dict([ (self.ids[i], i) for i in xrange(row) ])
+		self.ids.append(postID)
+		if (self.rowByID is not None):
+			self.rowByID[postID] = row
+		return row
+
+	# Return the index of a name in the name table, adding it if needed
+	def internName(self, name):
+		index = self.nameIndex.get(name)
+		if (index is None):
+			index = len(self.names)
+			self.names.append(name)
+			self.nameIndex[name] = index
+		return index
+
+	# Return the row of a post, or None if there is no such post
+	def findRow(self, postID):
+		rowByID = self.rowByID
+		if (rowByID is not None):
+			return rowByID.get(postID)
+		row = bisect.bisect_left(self.ids, postID)
+		if (row < len(self.ids) and self.ids[row] == postID):
+			return row
+		return None
+
+	# Return the post in a row, as a tuple: (postID, sender, bookname, page, line, content)
+	def getRow(self, row):
+		contentStart = 0
+		if (row > 0):
+			contentStart = self.contentEnds[row-1]
+		return (self.ids[row], self.names[self.senders[row]], self.names[self.books[row]], \
+			self.pages[row], self.lines[row], str(self.content[contentStart:self.contentEnds[row]]))
+
+	# Return the ID's of the posts from row 'start' onwards
+	def getIDs(self, start=0):
+		return self.ids[start:].tolist()
+
+	# Return the origin sequence number of the post in a row
+	def getOriginSeq(self, row):
+		return self.originSeqs[row]
+
+	# Approximate number of bytes used to store the posts
+	def getSizeBytes(self):
+		size = sum([ sys.getsizeof(column) for column in \
+			[self.ids, self.senders, self.books, self.pages, self.lines, self.contentEnds, self.content, self.originSeqs] ])
+		size = size + sys.getsizeof(self.names) + sys.getsizeof(self.nameIndex)
+		size = size + sum([ sys.getsizeof(name) for name in self.names ])
+		if (self.rowByID is not None):
+			size = size + sys.getsizeof(self.rowByID)
+		return size
+
+# This class is an inverted index over short text documents (eg. lines, posts), each
+# numbered in the order it was added (from 0)
+# Each term maps to the documents it appears in (in ascending order) and how often it
+# appears in each, so a query only touches the postings of its own terms - it never
+# scans the documents. Matches are ranked with BM25.
+class InvertedIndex(object):
+
+	# Constants
+	# BM25 parameters: saturation of term frequency, and normalisation by document length
+	K1 = 1.2
+	B = 0.75
+
+	# Constructor
+	def __init__(self):
+		self.postings = {}		# term -> array of document numbers, ascending
+		self.freqs = {}			# term -> array of the term's count in each of those documents
+		self.docLengths = array('i')	# number of terms in each document
+		self.totalLength = 0
+
+	# Number of documents indexed
+	def __len__(self):
+		return len(self.docLengths)
+
+	# Number of distinct terms indexed
+	def getNumTerms(self):
+		return len(self.postings)
+
+	# Add a document, returning its number
+	def addDoc(self, text):
+		return self.addTerms(getSearchTerms(text))
+
+	# Add a document given its terms, returning its number
+	# NOTE: Assumes a single thread adds documents at a time. Each posting is added after
+	# the document's length and term count, so a search never sees part of a posting.
+	def addTerms(self, terms):
+		docNum = len(self.docLengths)
+		self.docLengths.append(len(terms))
+		self.totalLength = self.totalLength + len(terms)
+
+		termCounts = {}
+		for term in terms:
+			termCounts[term] = termCounts.get(term, 0) + 1
+		for term, count in termCounts.iteritems():
+			postings = self.postings.get(term)
+			if (postings is None):
+				self.freqs[term] = array('i')
+				postings = self.postings[term] = array('l')
+			self.freqs[term].append(count)
+			postings.append(docNum)
+		return docNum
+
+	# Return the documents containing every one of the terms, as a tuple: (number of
+	# matches, list of (score, docNum) of the best 'limit' matches, best first, and whether
+	# every match was counted - always, as every document of the rarest term is looked at)
+	# The weight of each term ({ term: idf }) and the average document length may be given,
+	# when the documents are part of a larger collection (see SegmentedIndex), along with
+	# the score a match must beat to be among the best (eg. that of matches found earlier).
+	def search(self, terms, limit, idfs=None, avgLength=None, minScore=0.0):
+		termPostings = []
+		for term in set(terms):
+			postings = self.postings.get(term)
+			if (postings is None):
+				return (0, [], True)
+			termPostings.append((len(postings), term, postings, self.freqs[term]))
+		if (len(termPostings) == 0):
+			return (0, [], True)
+
+		# Weight of each term - the rarer, the higher
+		if (avgLength is None):
+			avgLength = self.getAvgLength()
+		termPostings.sort()
+		if (idfs is None):
+			weights = [ self.getIDF(numPostings) for numPostings, _, _, _ in termPostings ]
+		else:
+			weights = [ idfs[term] for _, term, _, _ in termPostings ]
+
+		# Go through the documents of the rarest term, finding each in the other terms' postings
+		# (bisecting from where the previous document was found, as both are in ascending order)
+		numPostings, _, rarestPostings, rarestFreqs = termPostings[0]
+		others = termPostings[1:]
+		starts = [0] * len(others)
+		numMatches = 0
+		matches = []
+		for i in xrange(numPostings):
+			docNum = rarestPostings[i]
+			lengthNorm = self.getLengthNorm(docNum, avgLength)
+			score = self.getTermScore(weights[0], rarestFreqs[i], lengthNorm)
+			for j in xrange(len(others)):
+				_, _, postings, freqs = others[j]
+				pos = bisect.bisect_left(postings, docNum, starts[j])
+				if (pos == len(postings) or postings[pos] != docNum):
+					break
+				starts[j] = pos + 1
+				score = score + self.getTermScore(weights[j+1], freqs[pos], lengthNorm)
+			else:
+				numMatches = numMatches + 1
+				if (score > minScore):
+					matches.append((score, -docNum))
+
+		# Equal scores are ranked by document number, earliest first
+		return (numMatches, [ (score, -negDocNum) for score, negDocNum in heapq.nlargest(limit, matches) ], True)
+
+	# Return the average number of terms in a document
+	def getAvgLength(self):
+		return float(self.totalLength) / max(len(self.docLengths), 1)
+
+	# Return the weight of a term found in 'numPostings' documents
+	def getIDF(self, numPostings):
+		return getIDF(len(self.docLengths), numPostings)
+
+	# Return how a document's length tempers the score of the terms in it
+	def getLengthNorm(self, docNum, avgLength):
+		return self.K1 * (1.0 - self.B + self.B * self.docLengths[docNum] / avgLength)
+
+	# Return the score of a term (of weight 'idf') that appears 'freq' times in a document
+	def getTermScore(self, idf, freq, lengthNorm):
+		return idf * freq * (self.K1 + 1.0) / (freq + lengthNorm)
+
+# This class is a read-only view of an InvertedIndex, for documents that no longer change
+# (eg. the lines of the books). Each term's postings are also kept best first (scored by
+# the average document length when it was made, but for the weight of the term, applied
+# as a search is made), so the best matches are found without going through every
+# document that a common term appears in: those of a single term are the start of its
+# list, and those of several terms are found with the threshold algorithm - taking each
+# term's next best posting in turn, until the matches found score at least as much as
+# any document not yet seen could.
+class ImpactIndex(object):
+
+	# Constants
+	# Most documents of the rarest term that are simply intersected with the other terms (and
+	# the matches each scored), without the threshold algorithm
+	MAX_SCORED_MATCHES = 1000
+
+	# The threshold algorithm looks each document up in the terms' postings as it comes to it,
+	# until it has looked up one for every INTERSECT_POSTINGS of them - then it intersects them
+	# as sets instead (see 'intersect'). A lookup takes about as long as intersecting 50
+	# postings, so a walk that goes on that long costs about a fifth more than intersecting first.
+	INTERSECT_POSTINGS = 256
+
+	# Postings sorted between each call to 'pause' (see the constructor)
+	PAUSE_POSTINGS = 2048
+
+	# Constructor given the index (which must no longer be added to), and optionally the
+	# average document length to order its postings by (when they are part of a larger
+	# collection - see SegmentedIndex) and a function to call every PAUSE_POSTINGS postings
+	# sorted (eg. to let other threads run, when made in the background)
+	def __init__(self, index, avgLength=None, pause=None):
+		self.index = index
+
+		# term -> (array of document numbers best first, array of their scores)
+		# term -> array of the same scores, in the order of the index's postings
+		# term -> array of the positions (in the best first order) that each group of postings of
+		#         the same frequency and document length starts at, and the end of the list
+		# term -> weight of the term (the scores above are for a weight of 1)
+		self.postings = {}
+		self.docScores = {}
+		self.groups = {}
+		self.idfs = {}
+		if (avgLength is None):
+			avgLength = index.getAvgLength()
+		self.avgLength = avgLength
+		docLengths = index.docLengths
+		numSorted = 0
+		for term, docs in index.postings.iteritems():
+			freqs = index.freqs[term]
+			docScores = [ index.getTermScore(1.0, freqs[i], index.getLengthNorm(docs[i], avgLength)) \
+					for i in xrange(len(docs)) ]
+			order = sorted(xrange(len(docs)), key=lambda i: (-docScores[i], freqs[i], docLengths[docs[i]], docs[i]))
+			kinds = [ (freqs[i], docLengths[docs[i]]) for i in order ]
+			self.postings[term] = (array('i', [ docs[i] for i in order ]), array('d', [ docScores[i] for i in order ]))
+			self.docScores[term] = array('d', docScores)
+			self.groups[term] = array('i', [ pos for pos in xrange(len(order)) if pos == 0 or kinds[pos] != kinds[pos - 1] ] + \
+						[ len(order) ])
+			self.idfs[term] = index.getIDF(len(docs))
+
+			numSorted = numSorted + len(docs)
+			if (pause is not None and numSorted >= self.PAUSE_POSTINGS):
+				pause()
+				numSorted = 0
+
+	# Number of documents indexed
+	def __len__(self):
+		return len(self.index)
+
+	# Number of distinct terms indexed
+	def getNumTerms(self):
+		return len(self.postings)
+
+	# Return the documents containing every one of the terms, as a tuple: (number of
+	# matches, list of (score, docNum) of the best 'limit' matches, best first, and whether
+	# every match was counted - otherwise the number is just of those found)
+	# The weight of each term ({ term: idf }) and the average document length may be given,
+	# when the documents are part of a larger collection (see SegmentedIndex), along with
+	# the score a match must beat to be among the best.
+	# Matches are scored by the average length given, as an InvertedIndex scores them. If it
+	# is not the one the postings were ordered by, a posting further down a term's list may
+	# score more than one above it - but by no more than the ratio of the two averages, so
+	# the threshold is raised by that much.
+	# NOTE: Once there are many matches, those of equal scores may be ranked either way
+	def search(self, terms, limit, idfs=None, avgLength=None, minScore=0.0):
+		if (idfs is None):
+			idfs = self.idfs
+		if (avgLength is None):
+			avgLength = self.avgLength
+		termPostings = []
+		for term in set(terms):
+			postings = self.postings.get(term)
+			if (postings is None):
+				return (0, [], True)
+			termPostings.append((self.index.postings[term], self.index.freqs[term], self.docScores[term]) + postings + \
+						(idfs[term],))
+		if (len(termPostings) == 0):
+			return (0, [], True)
+		termPostings.sort(key=lambda postings: len(postings[0]))
+		rarestDocs = termPostings[0][0]
+		numPostings = sum([ len(postings[0]) for postings in termPostings ])
+
+		# A single term (scored as its postings were ordered, or just counted) - its best postings
+		# come first
+		if (len(termPostings) == 1 and (avgLength == self.avgLength or limit <= 0)):
+			_, _, _, bestDocs, bestScores, idf = termPostings[0]
+			matches = [ (idf * bestScores[i], bestDocs[i]) for i in xrange(min(limit, len(bestDocs))) ]
+			return (len(bestDocs), [ match for match in matches if match[0] > minScore ], True)
+
+		# A single term scored by another average - postings of the same frequency and document
+		# length still score the same, so its list is gone down a group of them at a time (each
+		# scored once, and its first documents taken), until no group left could score more
+		best = []	# heap of (score, -docNum) of the best matches so far, worst first
+		drift = max(1.0, avgLength / self.avgLength)
+		if (len(termPostings) == 1):
+			term, = set(terms)
+			groups = self.groups[term]
+			_, _, _, bestDocs, bestScores, idf = termPostings[0]
+			for i in xrange(len(groups) - 1):
+				start, end = groups[i], groups[i + 1]
+				threshold = idf * bestScores[start] * drift
+				if (threshold <= minScore or (len(best) == limit and best[0][0] >= threshold)):
+					break
+				score = self.scoreDoc(bestDocs[start], termPostings, avgLength)
+				for docNum in bestDocs[start:min(end, start + limit)]:
+					match = (score, -docNum)
+					if (len(best) < limit):
+						heapq.heappush(best, match)
+					elif (match > best[0]):
+						heapq.heapreplace(best, match)
+			return (len(bestDocs), [ (score, -negDocNum) for score, negDocNum in sorted(best, reverse=True) \
+						if score > minScore ], True)
+
+		# Matches of several terms that are just to be counted
+		if (limit <= 0):
+			return (len(self.intersect(termPostings)), [], True)
+
+		# Every match is among the documents of the rarest term - if there are few enough, those in
+		# the other terms are each scored (unless there is a score to beat, which the threshold
+		# algorithm can stop at long before)
+		if (len(rarestDocs) <= self.MAX_SCORED_MATCHES and minScore <= 0.0):
+			matchingDocs = self.intersect(termPostings)
+			matches = [ (self.scoreDoc(docNum, termPostings, avgLength), -docNum) for docNum in matchingDocs ]
+			return (len(matchingDocs), [ (score, -negDocNum) for score, negDocNum in heapq.nlargest(limit, matches) \
+							if score > minScore ], True)
+
+		# Otherwise go down the terms' best postings together, looking each document up in the
+		# other terms as it is first seen. A document not yet seen is further down every list, so
+		# it can score no more than the sum of the scores at the current depth. Every match is in
+		# the shortest list, so all have been seen (and counted) by the end of it - or once that
+		# sum is down to 'minScore', none left could be among the best, and no more are counted.
+		# Once the walk has looked up a document for every INTERSECT_POSTINGS of the terms'
+		# postings, they are intersected (and the matches all counted) instead.
+		seen = set()
+		numMatches = 0
+		matchingDocs = None
+		allCounted = True
+		for depth in xrange(len(rarestDocs)):
+			threshold = 0.0
+			for _, _, _, bestDocs, bestScores, idf in termPostings:
+				threshold = threshold + idf * bestScores[depth] * drift
+				docNum = bestDocs[depth]
+				if (matchingDocs is not None):
+					if (docNum not in matchingDocs or docNum in seen):
+						continue
+					seen.add(docNum)
+					score = self.scoreDoc(docNum, termPostings, avgLength)
+				else:
+					if (docNum in seen):
+						continue
+					seen.add(docNum)
+					if (not self.hasTerms(docNum, termPostings)):
+						continue
+					score = self.scoreDoc(docNum, termPostings, avgLength)
+
+				numMatches = numMatches + 1
+				match = (score, -docNum)
+				if (len(best) < limit):
+					heapq.heappush(best, match)
+				elif (match > best[0]):
+					heapq.heapreplace(best, match)
+
+			if (threshold <= minScore or (len(best) == limit and best[0][0] >= threshold)):
+				allCounted = (depth == len(rarestDocs) - 1)
+				break
+			if (matchingDocs is None and len(seen) * self.INTERSECT_POSTINGS >= numPostings):
+				matchingDocs = self.intersect(termPostings)
+
+		if (matchingDocs is not None):
+			numMatches, allCounted = len(matchingDocs), True
+
+		return (numMatches, [ (score, -negDocNum) for score, negDocNum in sorted(best, reverse=True) \
+					if score > minScore ], allCounted)
+
+	# Return the documents containing every one of the terms (given their postings, the rarest
+	# first), by intersecting sets (rather than looping in Python) - unless there are far fewer
+	# left than a term has postings, then looked up in them
+	def intersect(self, termPostings):
+		matchingDocs = set(termPostings[0][0])
+		for docs, _, _, _, _, _ in termPostings[1:]:
+			if (len(matchingDocs) * 8 < len(docs)):
+				matchingDocs = set([ docNum for docNum in matchingDocs if self.hasDoc(docs, docNum) ])
+			else:
+				matchingDocs.intersection_update(docs)
+		return matchingDocs
+
+	# Return whether a term's postings (document numbers ascending) include a document
+	def hasDoc(self, docs, docNum):
+		pos = bisect.bisect_left(docs, docNum)
+		return (pos < len(docs) and docs[pos] == docNum)
+
+	# Return whether a document contains every one of the terms (given their postings, the
+	# rarest first)
+	def hasTerms(self, docNum, termPostings):
+		for docs, _, _, _, _, _ in termPostings:
+			if (not self.hasDoc(docs, docNum)):
+				return False
+		return True
+
+	# Return the score of a document containing every one of the terms (given their postings)
+	# by the average document length given.
+	# Each term's score is the one kept for the posting, if the average is the one they were
+	# made by - otherwise worked out again (as InvertedIndex.getLengthNorm / getTermScore do,
+	# without the calls).
+	# NOTE: Either way it is worked out exactly as for the best postings, and weighted after,
+	# so a document scores exactly the threshold it is found at - if it scored less by rounding,
+	# the threshold algorithm would go on through every document of the same score
+	def scoreDoc(self, docNum, termPostings, avgLength):
+		score = 0.0
+		if (avgLength == self.avgLength):
+			for docs, _, docScores, _, _, idf in termPostings:
+				score = score + idf * docScores[bisect.bisect_left(docs, docNum)]
+			return score
+
+		k1, b = InvertedIndex.K1, InvertedIndex.B
+		lengthNorm = k1 * (1.0 - b + b * self.index.docLengths[docNum] / avgLength)
+		for docs, freqs, _, _, _, idf in termPostings:
+			freq = freqs[bisect.bisect_left(docs, docNum)]
+			score = score + idf * (1.0 * freq * (k1 + 1.0) / (freq + lengthNorm))
+		return score
+
+# This class is a full-text index of documents that keep being added (eg. the content of
+# the posts), searched best first like an ImpactIndex. Documents are added to a small
+# InvertedIndex (the tail). Once the tail holds SEGMENT_SIZE documents, a new tail is
+# started, and the full one is sealed - made into an ImpactIndex on a background thread.
+# A search goes through every segment, weighting the terms by the number of documents
+# containing them in all the segments (and scoring by the average length of all the
+# documents), and merges the best matches of each.
+class SegmentedIndex(object):
+
+	# Constants
+	SEGMENT_SIZE = 4096		# documents in each sealed segment
+	SEAL_PAUSE = 0.001		# seconds the sealer sleeps every so often, to let the clients be served
+
+	# Constructor
+	def __init__(self):
+
+		# Segments in the order of their documents, each a list: [number of its first document, index]
+		# NOTE: The list is replaced (rather than changed) when a segment is added, and a segment's
+		# index once it is sealed, so searches need no lock
+		self.segments = [ [0, InvertedIndex()] ]
+
+		# Number of documents containing each term, and the number / total length of the documents
+		self.docFreqs = {}
+		self.numDocs = 0
+		self.totalLength = 0
+
+		# Thread sealing the segments, while there are any to seal
+		self.sealer = None
+		self.sealerLock = threading.Lock()
+
+	# Number of documents indexed
+	def __len__(self):
+		return self.numDocs
+
+	# Number of distinct terms indexed
+	def getNumTerms(self):
+		return len(self.docFreqs)
+
+	# Add a document, returning its number
+	# NOTE: Assumes a single thread adds documents at a time
+	def addDoc(self, text):
+		docBase, tail = self.segments[-1]
+		if (len(tail) >= self.SEGMENT_SIZE):
+			docBase, tail = self.numDocs, InvertedIndex()
+			self.segments = self.segments + [ [docBase, tail] ]
+			self.startSealer()
+
+		terms = getSearchTerms(text)
+		for term in set(terms):
+			self.docFreqs[term] = self.docFreqs.get(term, 0) + 1
+		self.totalLength = self.totalLength + len(terms)
+		self.numDocs = self.numDocs + 1
+		return docBase + tail.addTerms(terms)
+
+	# Return the documents containing every one of the terms, as a tuple: (number of
+	# matches, list of (score, docNum) of the best 'limit' matches, best first, and whether
+	# every match was counted - see ImpactIndex.search)
+	def search(self, terms, limit):
+		idfs = {}
+		for term in set(terms):
+			numPostings = self.docFreqs.get(term)
+			if (numPostings is None):
+				return (0, [], True)
+			idfs[term] = getIDF(self.numDocs, numPostings)
+		avgLength = self.getAvgLength()
+
+		# Search the segments in order, each for the matches that beat the best found so far
+		# (equal scores are ranked by document number, earliest first)
+		numMatches = 0
+		allCounted = True
+		best = []	# heap of (score, -docNum) of the best matches so far, worst first
+		for docBase, index in self.segments:
+			minScore = 0.0
+			if (limit > 0 and len(best) == limit):
+				minScore = best[0][0]
+			numSegmentMatches, segmentMatches, segmentCounted = index.search(terms, limit, idfs, avgLength, minScore)
+			numMatches = numMatches + numSegmentMatches
+			allCounted = allCounted and segmentCounted
+			for score, docNum in segmentMatches:
+				match = (score, -(docBase + docNum))
+				if (len(best) < limit):
+					heapq.heappush(best, match)
+				elif (match > best[0]):
+					heapq.heapreplace(best, match)
+
+		return (numMatches, [ (score, -negDocNum) for score, negDocNum in sorted(best, reverse=True) ], allCounted)
+
+	# Return the average number of terms in a document
+	def getAvgLength(self):
+		return float(self.totalLength) / max(self.numDocs, 1)
+
+	# Start sealing the full segments that have not been sealed yet, unless already doing so
+	def startSealer(self):
+		self.sealerLock.acquire()
+		try:
+			if (self.sealer is None):
+				self.sealer = threading.Thread(target=self.runSealer)
+				self.sealer.daemon = True
+				self.sealer.start()
+		finally:
+			self.sealerLock.release()
+
+	# Wait until the full segments have been sealed (eg. before timing searches)
+	def join(self):
+		sealer = self.sealer
+		if (sealer is not None):
+			sealer.join()
+
+	# Start afresh in a forked child process - the sealer thread was left behind in the parent
+	def afterFork(self):
+		self.sealer = None
+		self.sealerLock = threading.Lock()
+		self.startSealer()
+
+	# Sealer thread - seal the full segments (all but the tail) until there are none left to seal
+	def runSealer(self):
+		while True:
+			self.sealerLock.acquire()
+			try:
+				unsealed = [ segment for segment in self.segments[:-1] if isinstance(segment[1], InvertedIndex) ]
+				if (len(unsealed) == 0):
+					self.sealer = None
+					return
+			finally:
+				self.sealerLock.release()
+
+			for segment in unsealed:
+				segment[1] = ImpactIndex(segment[1], self.getAvgLength(), self.pauseSealing)
+
+	# Let the other threads run for a while, in the middle of sealing a segment (sealing one
+	# takes long enough to hold up the clients being served)
+	def pauseSealing(self):
+		time.sleep(self.SEAL_PAUSE)
+
+# This class is the full-text index of the lines of every book (see InvertedIndex)
+# The books never change, so it is built once, before clients are served, then frozen
+# (see ImpactIndex).
+class BookSearchIndex(object):
+
+	# Constructor
+	def __init__(self):
+		self.index = InvertedIndex()
+
+		# Where each indexed line is, by document number
+		self.books = array('i')		# index into booknames
+		self.pages = array('i')
+		self.lines = array('i')
+		self.booknames = []
+
+	# Number of lines indexed
+	def __len__(self):
+		return len(self.index)
+
+	# Index every line of a book
+	def addBook(self, book):
+		bookIndex = len(self.booknames)
+		self.booknames.append(book.bookname)
+		for pagenum in range(1, book.numpages+1):
+
+			# A lazily loaded book's pages are parsed straight from their files, leaving its cache alone
+			if (book.pageCache is None):
+				pageObj = book.getPageObj(pagenum)
+			else:
+				pageObj = Page(book.bookname, pagenum)
+
+			for line in pageObj.lines:
+				self.books.append(bookIndex)
+				self.pages.append(pagenum)
+				self.lines.append(line.linenum)
+				self.index.addDoc(line.getContent())
+
+	# Stop adding books, making the index read-only (and its searches faster)
+	def freeze(self):
+		self.index = ImpactIndex(self.index)
+
+	# Return the lines containing every one of the terms, as a tuple: (number of matches,
+	# list of (score, bookname, pagenum, linenum) of the best 'limit' matches, best first,
+	# and whether every match was counted - see ImpactIndex.search)
+	def search(self, terms, limit):
+		numMatches, matches, allCounted = self.index.search(terms, limit)
+		return (numMatches, [ (score, self.booknames[self.books[docNum]], self.pages[docNum], self.lines[docNum]) \
+					for score, docNum in matches ], allCounted)
+
 # This class represents the database for the server
 # ie postsDB = { "bookname": (postInfo, postContent) }
 #    postInfo = { "postID": (senderName, pageNumber, lineNumber) }
@@ -122,43 +1118,68 @@ class Line(object):
 class ServerDB(object):
 
 	# Constants
-	# For generating serial numbers
+	# For generating serial numbers - each server instance (node) has a range of its own
 	MIN_ID_VAL = 1000
-	MAX_ID_VAL = 9999
+	NODE_ID_SPACE = 2**48
+	MAX_NODE_ID = 2**14 - 1
 
 	# Success phrase
 	OP_FAILURE = 0		# OP = operation
 	OP_SUCCESS = 1
 
 	# Format of database:
-	# db = {
-	# 	"postID" : (postInfo, postContent)
-	# }
+	# posts = PostStore, returning posts as (postInfo, postContent)
 	# postInfo = (sender, bookname, page, line)
 	# postConent = postContent
-	db = {}
-
-	# Constructor
-	def __init__(self):
+	# A post's sequence number is its row in the store + 1
+	# Posts may be replicated between nodes (see Replicator). A post's origin is the node
+	# that inserted it (told by its ID), and its origin sequence number is its position
+	# among the posts of that origin, in the order the origin inserted them.
+
+	# Constructor, given an optional file in which the ID allocator persists its state,
+	# an optional (recovered) PostLog that makes inserted posts durable, and the ID
+	# of this node (which decides the range of post ID's it allocates)
+	def __init__(self, idStateFile=None, postLog=None, nodeID=0):
 		
-		# Maintain a list of serial numbers / post ID's
-		self.post_ids = []
-
-	# Insert a new forum post into database
-	# given two strings that contain information about the post:
-	# postInfoString: 	'#NewPostInfo#SenderName#BookName#PageNumber#LineNumber'
-	# postContentString: 	'#NewPostContent#Content'
-	# Note: Assumes the strings given are in the correct format
-	def insertPost(self, postInfoString, postContentString):
-
-		# Parse the strings
-		postInfoString = postInfoString.split('#')
-		postContentString = postContentString.split('#')
-		sendername = postInfoString[2]
-		bookname = postInfoString[3]
-		pagenum = int(postInfoString[4])
-		linenum = int(postInfoString[5])
-		postcontent = postContentString[2]
+		# Allocates serial numbers / post ID's
+		self.nodeID = nodeID
+		self.idAllocator = PostIDAllocator(self.MIN_ID_VAL + nodeID * self.NODE_ID_SPACE, idStateFile)
+
+		# The posts, in the order they were inserted - each is given a sequence number (from 1)
+		# in that order, so readers can sync just the posts inserted after the last one they saw
+		self.posts = PostStore()
+
+		# Secondary indexes, so that lookups only touch the posts on the page / line asked for
+		# pageIndex = { (bookname, page): array of postID's }
+		# lineIndex = { (bookname, page, line): array of postID's }
+		self.pageIndex = {}
+		self.lineIndex = {}
+
+		# The posts of each origin, in origin sequence order
+		# originLogs = { origin node ID: array of postID's }
+		self.originLogs = {}
+
+		# Full-text index of the content of the posts - a post's document number is its row
+		self.postIndex = SegmentedIndex()
+
+		# Serialises inserts made by different client threads
+		self.lock = threading.Lock()
+
+		# Write-ahead log of inserted posts
+		self.postLog = postLog
+		self.snapshotInProgress = False
+
+	# Parse the strings of a new post (see 'insertPost'), and check that the line it is on exists
+	# Returns a tuple: (OP_SUCCESS, ((sendername, bookname, pagenum, linenum), content))
+	#              or: (OP_FAILURE, error message)
+	def checkNewPost(self, postInfoString, postContentString):
+		try:
+			_, _, sendername, bookname, pagenum, linenum = postInfoString.split('#')
+			pagenum = int(pagenum)
+			linenum = int(linenum)
+			postcontent = postContentString.split('#')[2]
+		except (ValueError, IndexError):
+			return (self.OP_FAILURE, "Malformed post.")
 
 		# Check if post information is valid - ie bookname, pagenum, and linenum
 		try:
@@ -172,23 +1193,135 @@ class ServerDB(object):
 			errorStr = "Book '" + str(bookname) + "' not found."
 			return (self.OP_FAILURE, errorStr)
 
-		# Generate an id for the post
-		new_post_id = self.generatePostID()
-		
-		# Prepare the tuples to insert
-		postInfo = (sendername, bookname, pagenum, linenum)		
-		postContent = postcontent
+		return (self.OP_SUCCESS, ((sendername, bookname, pagenum, linenum), postcontent))
+
+	# Insert a new forum post into database
+	# given two strings that contain information about the post:
+	# postInfoString: 	'#NewPostInfo#SenderName#BookName#PageNumber#LineNumber'
+	# postContentString: 	'#NewPostContent#Content'
+	# The post is given a new ID, unless one reserved through 'reservePostIDs' is given.
+	def insertPost(self, postInfoString, postContentString, postID=None):
+
+		# Parse the strings, and check the post is on a line that exists
+		resp, result = self.checkNewPost(postInfoString, postContentString)
+		if (resp != self.OP_SUCCESS):
+			return (resp, result)
+		postInfo, postContent = result
+		sendername, bookname, pagenum, linenum = postInfo
+
+		self.lock.acquire()
+		try:
+			# Generate an id for the post (or use the reserved one)
+			if (postID is None):
+				new_post_id = self.generatePostID()
+			elif (postID in self.posts):
+				errorStr = "Post ID '%d' already in use." % postID
+				return (self.OP_FAILURE, errorStr)
+			else:
+				new_post_id = postID
 		
-		# Insert into database
-		self.db[new_post_id] = (postInfo, postContent)
+			# Insert into database, and index the post by its page and line
+			self.indexPost(new_post_id, postInfo, postContent)
+
+			# Log the post, and start a snapshot when one is due
+			if (self.postLog is not None):
+				snapshotDue = self.postLog.append(self.getPostAsStr(new_post_id)[1])
+				if (snapshotDue and not self.snapshotInProgress):
+					self.startSnapshot()
+		finally:
+			self.lock.release()
 
 		# Print successful message
 		newPostTuple = (bookname, pagenum, linenum, new_post_id)
-		print "Post added to the database and given serial number", newPostTuple
+		log.debug("Post added to the database and given serial number %s", newPostTuple)
 	
 		# return postID
 		return (self.OP_SUCCESS, new_post_id)
 
+	# Restore a post that was already in the database before a restart, given a string
+	# in the format given by 'getPostAsStr'. Posts already present are ignored.
+	def restorePost(self, postDataStr):
+		postID, postInfo, postContent = self.parsePostStr(postDataStr)
+		if (postID in self.posts):
+			return
+		self.indexPost(postID, postInfo, postContent)
+		if (self.getPostOrigin(postID) == self.nodeID):
+			self.idAllocator.advancePast(postID)
+
+	# Insert (and log) a post replicated from another node (see Replicator), given a string
+	# in the format given by 'getPostAsStr'
+	# Returns whether the post was inserted - False if it was already present
+	# NOTE: Assumes the posts of its origin before it have been inserted
+	def insertReplicatedPost(self, postDataStr):
+		postID, postInfo, postContent = self.parsePostStr(postDataStr)
+		self.lock.acquire()
+		try:
+			if (postID in self.posts):
+				return False
+			self.indexPost(postID, postInfo, postContent)
+			if (self.postLog is not None):
+				snapshotDue = self.postLog.append(postDataStr)
+				if (snapshotDue and not self.snapshotInProgress):
+					self.startSnapshot()
+		finally:
+			self.lock.release()
+
+		log.debug("Replicated post %d from node %d.", postID, self.getPostOrigin(postID))
+		return True
+
+	# Parse a string in the format given by 'getPostAsStr'
+	# Returns a tuple: (postID, postInfo, postContent)
+	def parsePostStr(self, postDataStr):
+		postInfoStr, postContentStr = postDataStr.split('|', 1)
+		postInfoComponents = postInfoStr.split('#')
+		postID = int(postInfoComponents[2])
+		postInfo = (postInfoComponents[3], postInfoComponents[4], \
+				int(postInfoComponents[5]), int(postInfoComponents[6]))
+		postContent = '#'.join(postContentStr.split('#')[3:])
+		return (postID, postInfo, postContent)
+
+	# Add a post that was inserted elsewhere (see BusHub) to the database, given a
+	# string in the format given by 'getPostAsStr'
+	# Returns the ID of the post
+	def applyPost(self, postDataStr):
+		self.lock.acquire()
+		try:
+			self.restorePost(postDataStr)
+		finally:
+			self.lock.release()
+		return int(postDataStr.split('#', 3)[2])
+
+	# Add a post (with an ID) to the database and its indexes
+	# NOTE: Assumes the lock is held (or that there are no other threads)
+	def indexPost(self, postID, postInfo, postContent):
+		sendername, bookname, pagenum, linenum = postInfo
+		originLog = self.originLogs.setdefault(self.getPostOrigin(postID), array('l'))
+		originLog.append(postID)
+		self.posts.append(postID, sendername, bookname, pagenum, linenum, postContent, len(originLog))
+		self.pageIndex.setdefault((bookname, pagenum), array('l')).append(postID)
+		self.lineIndex.setdefault((bookname, pagenum, linenum), array('l')).append(postID)
+		self.postIndex.addDoc(postContent)
+
+	# Start a new log segment, and write a snapshot of every post in the background
+	# NOTE: Assumes the lock is held, so the snapshot matches the segments it covers
+	def startSnapshot(self):
+		self.snapshotInProgress = True
+		lastCovered = self.postLog.rotate()
+		snapshotThread = threading.Thread(target=self.writeSnapshot, args=(len(self.posts), lastCovered))
+		snapshotThread.daemon = True
+		snapshotThread.start()
+
+	# Snapshot thread - format the first 'numPosts' rows and write the snapshot out
+	# Rows are append-only, so the rows that existed at the segment switch never change
+	def writeSnapshot(self, numPosts, lastCovered):
+		try:
+			startTime = time.time()
+			postDataStrs = [ self.formatPost(self.posts.getRow(row)) for row in xrange(numPosts) ]
+			self.postLog.writeSnapshot(postDataStrs, lastCovered)
+			log.info("Snapshot of %d posts written in %.3fs.", len(postDataStrs), time.time() - startTime)
+		finally:
+			self.snapshotInProgress = False
+
 	# Return a list of post IDs for a particular book and page
 	def getPostsID(self, bookName, pageNum):
 
@@ -202,98 +1335,563 @@ class ServerDB(object):
 			errorStr = "Book '%s' not found." % bookName
 			return (self.OP_FAILURE, errorStr)			
 
-		# Loop through all posts, adding those that match the criteria to the final list
-		postIDs = []
-		for postID in self.db.keys():
-			postInfo, _ = self.db[postID]
-			_, bookname, pagenum, _ = postInfo
-			if (bookname == bookName and pagenum == pageNum):
-				postIDs.append(postID)
+		# Look up the posts on the page (copied, as inserts may be appending to it)
+		postIDs = self.pageIndex.get((bookName, pageNum), array('l')).tolist()
 
 		return (self.OP_SUCCESS, postIDs)
 
-	# Return the (postInfo, postContent) tuple, corresponding to a given ID
-	def getPost(self, postID):
+	# Return a list of post IDs for a particular book, page, and line
+	def getPostsIDOnLine(self, bookName, pageNum, lineNum):
+
+		# Check bookname, pagenum and linenum validity
 		try:
-			postInfo, postContent = self.db[postID]
-			return (self.OP_SUCCESS, (postInfo, postContent))
+			if (not books[bookName].hasPage(pageNum)):
+				errorStr = "Page '%d' not found." % pageNum
+				return (self.OP_FAILURE, errorStr)
+			if (not books[bookName].getPageObj(pageNum).hasLine(lineNum)):
+				errorStr = "Line '%d' not found." % lineNum
+				return (self.OP_FAILURE, errorStr)
 
 		except KeyError:
+			errorStr = "Book '%s' not found." % bookName
+			return (self.OP_FAILURE, errorStr)			
+
+		# Look up the posts on the line
+		postIDs = self.lineIndex.get((bookName, pageNum, lineNum), array('l')).tolist()
+
+		return (self.OP_SUCCESS, postIDs)
+
+	# Return the (postInfo, postContent) tuple, corresponding to a given ID
+	def getPost(self, postID):
+		row = self.posts.findRow(postID)
+		if (row is None):
 			errorStr = "No such postID exists."
 			return (self.OP_FAILURE, errorStr)
 
+		_, sender, bookname, page, line, postContent = self.posts.getRow(row)
+		return (self.OP_SUCCESS, ((sender, bookname, page, line), postContent))
+
 	# Return a formatted version of a post, in the format:
 	# postString:		'postInfoString...|postContentString
 	# postInfoString: 	'#PostInfo#Id#SenderName#BookName#PageNumber#LineNumber'
 	# postContentString: 	'#PostContent#Id#Content'
 	def getPostAsStr(self, postID):
-		try:
-			postInfo, postContent = self.db[postID]
-			sender, bookname, page, line = postInfo
-			postInfoStr = '#PostInfo#' + str(postID) + '#' + sender + '#' + \
-					bookname + '#' + str(page) + '#' + str(line)
-			postContentStr = '#PostContent#' + str(postID) + '#' + postContent
-			postDataStr = postInfoStr + '|' + postContentStr
-			return (self.OP_SUCCESS, postDataStr)
-
-		except KeyError:
+		row = self.posts.findRow(postID)
+		if (row is None):
 			errorStr = "No such postID exists."
 			return (self.OP_FAILURE, errorStr)
 
+		return (self.OP_SUCCESS, self.formatPost(self.posts.getRow(row)))
+
+	# Format a row of the post store (see 'getPostAsStr')
+	def formatPost(self, postRow):
+		postID, sender, bookname, page, line, postContent = postRow
+		postInfoStr = '#PostInfo#' + str(postID) + '#' + sender + '#' + \
+				bookname + '#' + str(page) + '#' + str(line)
+		postContentStr = '#PostContent#' + str(postID) + '#' + postContent
+		return postInfoStr + '|' + postContentStr
 
 	# Return a list of ALL the post id's in the database
 	def getAllPostIDs(self):
-		return self.db.keys()
+		return self.posts.getIDs()
+
+	# Return the sequence number of a post, as a tuple: (OP_SUCCESS, sequence number)
+	# or: (OP_FAILURE, error message)
+	# NOTE: Sequence numbers (and so the readers' cursors - see 'getPostsSince') are of the
+	# order posts were inserted on this node - a replicated post has a different one on each
+	# node, so a cursor from one node is not valid on another
+	def getPostSeq(self, postID):
+		row = self.posts.findRow(postID)
+		if (row is None):
+			errorStr = "No such postID exists."
+			return (self.OP_FAILURE, errorStr)
+
+		return (self.OP_SUCCESS, row + 1)
+
+	# Return a tuple: (list of ID's of the posts inserted after sequence number 'cursor',
+	# the sequence number of the latest post) - ie. the reader's next cursor
+	# NOTE: A cursor ahead of the database (eg. from before the database was lost) gets every post
+	def getPostsSince(self, cursor):
+		if (cursor > len(self.posts)):
+			cursor = 0
+		postIDs = self.posts.getIDs(cursor)
+		return (postIDs, cursor + len(postIDs))
+
+	# Return the node a post came from (see the constructor)
+	def getPostOrigin(self, postID):
+		return (postID - self.MIN_ID_VAL) // self.NODE_ID_SPACE
+
+	# Return the origin sequence number of a post
+	def getPostOriginSeq(self, postID):
+		return self.posts.getOriginSeq(self.posts.findRow(postID))
+
+	# Return the number of posts from each origin, as a dict { origin node ID: count }
+	def getOriginCounts(self):
+		return dict([ (origin, len(originLog)) for origin, originLog in self.originLogs.items() ])
+
+	# Return the posts a node is missing, given the number of posts from each origin it has
+	# ({ origin node ID: count }), as '#ReplPost#...' messages (see 'formatReplPost'),
+	# leaving out the posts that came from 'excludeOrigin'
+	def getReplPostsSince(self, originCounts, excludeOrigin=None):
+		replPosts = []
+		for origin, originLog in self.originLogs.items():
+			if (origin == excludeOrigin):
+				continue
+			for index in xrange(originCounts.get(origin, 0), len(originLog)):
+				replPosts.append(formatReplPost(index + 1, self.getPostAsStr(originLog[index])[1]))
+		return replPosts
+
+	# Return the posts whose content contains every one of the terms, as a tuple: (number of
+	# matches, list of (score, postID) of the best 'limit' matches, best first, and whether
+	# every match was counted - see SegmentedIndex.search)
+	def searchPosts(self, terms, limit):
+		numMatches, matches, allCounted = self.postIndex.search(terms, limit)
+		return (numMatches, [ (score, self.posts.ids[row]) for score, row in matches ], allCounted)
+
+	# Return the version of a page - the number of posts on it, which only ever grows
+	def getPageVersion(self, pageKey):
+		return len(self.pageIndex.get(pageKey, ()))
 
 	# Export db as a string
 	# postInfoString: 	'#PostInfo#Id#SenderName#BookName#PageNumber#LineNumber'
 	# postContentString: 	'#PostContent#Id#Content'
 	def exportAsStr(self):
-		# Loop through all  posts
-		dbStr = ""
-		for postID in self.db.keys():
-			postInfo, postContent = self.db[postID]
-			sendername, bookname, pagenum, linenum = postInfo
-			postcontent = postContent
-			dbStr = dbStr + "#PostInfo#" + str(postID) + "#" + sendername + "#" \
-				+ bookname + "#" + str(pagenum) + "#" + str(linenum) + "\n"
-			dbStr = dbStr + "#PostContent#" + str(postID) + "#" + postcontent + "\n"
-		return dbStr
+		# Loop through all  posts (joined once at the end - appending to a string grows quadratically)
+		dbStrs = []
+		for row in xrange(len(self.posts)):
+			postID, sendername, bookname, pagenum, linenum, postcontent = self.posts.getRow(row)
+			dbStrs.append("#PostInfo#" + str(postID) + "#" + sendername + "#" \
+				+ bookname + "#" + str(pagenum) + "#" + str(linenum) + "\n")
+			dbStrs.append("#PostContent#" + str(postID) + "#" + postcontent + "\n")
+		return ''.join(dbStrs)
 
 	# Generate a unique forum post serial ID
 	def generatePostID(self):	
-		#new_post_id = random.randint(self.MIN_ID_VAL, self.MAX_ID_VAL)		
-		#while (new_post_id in self.post_ids):
-		#	new_post_id = random.randint(self.MIN_ID_VAL, self.MAX_ID_VAL)
-		#self.post_ids.append(new_post_id)
-		new_post_id = self.MIN_ID_VAL
-		while (new_post_id in self.post_ids):
-			new_post_id = new_post_id + 1
-		self.post_ids.append(new_post_id)
-		return new_post_id
+		return self.idAllocator.allocate()
+
+	# Reserve a range of 'count' post ID's in one call (eg. for batched imports)
+	# Returns the range of ID's, each of which can be given to 'insertPost'
+	def reservePostIDs(self, count):
+		return self.idAllocator.reserve(count)
+
+# This class keeps a set of named counters that may be incremented from any thread
+class Counters(object):
+
+	# Constructor given the names of the counters
+	def __init__(self, names):
+		self.counts = dict([ (name, 0) for name in names ])
+		self.lock = threading.Lock()
+
+	# Add 'amount' to a counter
+	def increment(self, name, amount=1):
+		self.lock.acquire()
+		self.counts[name] = self.counts.get(name, 0) + amount
+		self.lock.release()
+
+	# Return a copy of all the counts
+	def getCounts(self):
+		self.lock.acquire()
+		counts = dict(self.counts)
+		self.lock.release()
+		return counts
+
+# This class counts observations (eg. latencies) into fixed buckets, like a Prometheus
+# histogram: each bucket counts the observations up to its bound
+# NOTE: May be observed from any thread
+class Histogram(object):
+
+	# Bucket bounds for latencies (seconds) and for lengths (items)
+	LATENCY_BOUNDS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+	LENGTH_BOUNDS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000, 100000]
+
+	# Constructor given the (ascending) bucket bounds
+	def __init__(self, bounds):
+		self.bounds = bounds
+		self.bucketCounts = [0] * (len(bounds) + 1)	# the last bucket is unbounded
+		self.count = 0
+		self.sum = 0
+		self.lock = threading.Lock()
+
+	# Count an observation
+	def observe(self, value):
+		bucket = bisect.bisect_left(self.bounds, value)
+		self.lock.acquire()
+		self.bucketCounts[bucket] = self.bucketCounts[bucket] + 1
+		self.count = self.count + 1
+		self.sum = self.sum + value
+		self.lock.release()
+
+	# Return a tuple: (cumulative count up to each bound, and then in total, count, sum)
+	def getSnapshot(self):
+		self.lock.acquire()
+		bucketCounts = list(self.bucketCounts)
+		count = self.count
+		total = self.sum
+		self.lock.release()
+
+		cumulative = []
+		runningCount = 0
+		for bucketCount in bucketCounts:
+			runningCount = runningCount + bucketCount
+			cumulative.append(runningCount)
+		return (cumulative, count, total)
+
+	# Return the bound of the bucket that the given percentile of observations falls in
+	# (None if there are none, or it is beyond the last bound)
+	def getPercentile(self, percent):
+		cumulative, count, _ = self.getSnapshot()
+		if (count == 0):
+			return None
+		rank = percent / 100.0 * count
+		for bucket in range(len(self.bounds)):
+			if (cumulative[bucket] >= rank):
+				return self.bounds[bucket]
+		return None
+
+# This class gathers the server's metrics: how many requests of each type are handled
+# and how long they take (until the whole response has been sent, streams included),
+# the lengths of the streams sent, how long pushed posts wait to be written, and bytes
+# sent / received. Together with the state of the server (connections, push list,
+# watchers etc.) they are formatted in the Prometheus text format.
+# NOTE: May be updated from any thread
+class ServerMetrics(object):
+
+	# Message types measured individually (any others are measured as 'Other')
+	REQUEST_TYPES = ['Intro', 'SubscribeReq', 'Exit', 'DisplayReq', 'DisplayPageReq', 'UploadPost', \
+			'GetPostsIDReq', 'GetPostsLocReq', 'WatchPageReq', 'SyncPostsReq', 'StartChatReq', \
+			'RelayStartChatResp', 'SearchReq', 'StatsReq']
+
+	# Constructor
+	def __init__(self):
+		self.startTime = time.time()
+		self.requestLatency = dict([ (msgType, Histogram(Histogram.LATENCY_BOUNDS)) \
+						for msgType in self.REQUEST_TYPES + ['Other'] ])
+		self.pushDelay = Histogram(Histogram.LATENCY_BOUNDS)
+		self.streamLengths = {}		# stream name -> Histogram, added as streams are first sent
+		self.connections = Counters(['accepted', 'bytesReceived', 'bytesSent'])
+		self.lock = threading.Lock()
+
+	# Record how long a request took to answer
+	def observeRequest(self, msgType, elapsed):
+		histogram = self.requestLatency.get(msgType)
+		if (histogram is None):
+			histogram = self.requestLatency['Other']
+		histogram.observe(elapsed)
+
+	# Record the number of items in a stream sent to a client
+	def observeStream(self, streamName, length):
+		self.lock.acquire()
+		histogram = self.streamLengths.get(streamName)
+		if (histogram is None):
+			histogram = Histogram(Histogram.LENGTH_BOUNDS)
+			self.streamLengths[streamName] = histogram
+		self.lock.release()
+		histogram.observe(length)
+
+	# Note a newly accepted connection
+	def connectionOpened(self):
+		self.connections.increment('accepted')
+
+	# Note a closed connection, keeping the bytes sent / received through its (framed) socket
+	def connectionClosed(self, sock):
+		self.connections.increment('bytesReceived', sock.bytesReceived)
+		self.connections.increment('bytesSent', sock.bytesSent)
+
+	# Format every metric in the Prometheus text format
+	def formatPrometheus(self):
+		lines = []
+
+		# Requests, and the time taken to answer them
+		lines.append('# HELP ebook_request_seconds Time taken to answer a request, by message type.')
+		lines.append('# TYPE ebook_request_seconds histogram')
+		for msgType in self.REQUEST_TYPES + ['Other']:
+			formatHistogram(lines, 'ebook_request_seconds', 'type="%s"' % msgType, self.requestLatency[msgType])
+
+		lines.append('# HELP ebook_push_delay_seconds Time a pushed post waits to be written to a client.')
+		lines.append('# TYPE ebook_push_delay_seconds histogram')
+		formatHistogram(lines, 'ebook_push_delay_seconds', '', self.pushDelay)
+
+		lines.append('# HELP ebook_stream_items Number of items in a stream sent to a client, by stream.')
+		lines.append('# TYPE ebook_stream_items histogram')
+		self.lock.acquire()
+		streamLengths = sorted(self.streamLengths.items())
+		self.lock.release()
+		for streamName, histogram in streamLengths:
+			formatHistogram(lines, 'ebook_stream_items', 'stream="%s"' % streamName, histogram)
+
+		lines.append('# HELP ebook_pushes_total Posts pushed to clients, by outcome (see OutboundQueue).')
+		lines.append('# TYPE ebook_pushes_total counter')
+		for outcome, count in sorted(pushCounters.getCounts().items()):
+			lines.append('ebook_pushes_total{outcome="%s"} %d' % (outcome, count))
+
+		# Connections, and the bytes through them (those of open connections so far included)
+		clients = list(clientThreadIterator.clientThreads)
+		counts = self.connections.getCounts()
+		bytesReceived = counts['bytesReceived'] + sum([ client.client.sock.bytesReceived for client in clients ])
+		bytesSent = counts['bytesSent'] + sum([ client.client.sock.bytesSent for client in clients ])
+		formatMetric(lines, 'ebook_connections_accepted_total', 'counter', 'Connections accepted.', counts['accepted'])
+		formatMetric(lines, 'ebook_received_bytes_total', 'counter', 'Bytes received from clients.', bytesReceived)
+		formatMetric(lines, 'ebook_sent_bytes_total', 'counter', 'Bytes sent to clients.', bytesSent)
+		formatMetric(lines, 'ebook_connections', 'gauge', 'Clients connected.', len(clients))
+
+		# State of the server
+		formatMetric(lines, 'ebook_push_clients', 'gauge', 'Clients in push mode.', len(clientThreadIterator.pushThreads))
+		formatMetric(lines, 'ebook_push_queued', 'gauge', 'Posts queued to be pushed to clients.', \
+			sum([ len(client.pushQueue.msgs) for client in clients ]))
+		formatMetric(lines, 'ebook_page_watchers', 'gauge', 'Clients waiting on a page for new posts.', \
+			sum([ len(watchers) for watchers in pageWatchers.watchers.values() ]))
+		formatMetric(lines, 'ebook_posts', 'gauge', 'Posts in the database.', len(serverDB.posts))
+		formatMetric(lines, 'ebook_search_terms', 'gauge', 'Distinct words in the search index of the posts.', \
+			serverDB.postIndex.getNumTerms())
+		formatMetric(lines, 'ebook_uptime_seconds', 'gauge', 'Seconds since the server started.', \
+			time.time() - self.startTime)
+		formatMetric(lines, 'ebook_log_dropped_total', 'counter', 'Log records dropped as the log writer fell behind.', \
+			log.dropped)
+
+		return '\n'.join(lines) + '\n'
+
+# This is the thread that periodically writes the server's metrics to a file,
+# in the Prometheus text format (eg. for a node exporter's textfile collector)
+class MetricsWriter(threading.Thread):
+
+	# Constructor given the file to write to, and the seconds between writes
+	def __init__(self, filename, interval):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.filename = filename
+		self.interval = interval
+		self.event = threading.Event()		# for stopping thread
+
+	# Execute thread - write the metrics every interval until stopped
+	def run(self):
+		while not self.event.isSet():
+			self.write()
+			self.event.wait(self.interval)
+
+	# Write the metrics out, replacing the file in one go so it is never read half written
+	def write(self):
+		tmpFilename = self.filename + '.tmp'
+		metricsFile = open(tmpFilename, 'w')
+		metricsFile.write(serverMetrics.formatPrometheus())
+		metricsFile.close()
+		os.rename(tmpFilename, self.filename)
+
+	# Stop the thread
+	def stop(self):
+		self.event.set()
+
+# This class is a bounded queue of the messages pushed to a single client
+# Pushing only enqueues, so the uploading client never waits on the recipient's socket.
+# The queue is drained by the client's own writer (see ClientWriter and EventServer).
+# When a client falls so far behind that its queue is full, the overflow policy decides:
+#   'drop-oldest' - the oldest queued push is dropped to make room
+#   'coalesce' - every queued push is replaced by a single '#ResyncHint', which tells
+#                the client to sync the posts it missed (later pushes are folded into it)
+#   'disconnect' - the client is disconnected
+# and the outcome is counted in 'counters'
+# The time each message waits in the queue is observed in 'delayHistogram' (if given).
+class OutboundQueue(object):
+
+	# Constants
+	OVERFLOW_POLICIES = ['drop-oldest', 'coalesce', 'disconnect']
+	RESYNC_HINT = '#ResyncHint'
+
+	# Constructor given the queue's capacity, overflow policy, counters, a function
+	# that disconnects the client, and an optional histogram of queueing delays
+	def __init__(self, maxPending, overflowPolicy, counters, disconnectFunc, delayHistogram=None):
+		self.maxPending = maxPending
+		self.overflowPolicy = overflowPolicy
+		self.counters = counters
+		self.disconnectFunc = disconnectFunc
+		self.delayHistogram = delayHistogram
+
+		self.msgs = deque()
+		self.queuedTimes = deque()	# when each message was queued
+		self.resyncQueued = False	# a resync hint is waiting to be delivered
+		self.closed = False
+		self.cond = threading.Condition()
+
+	# Queue a message to be pushed to the client
+	def put(self, msg):
+		disconnect = False
+		self.cond.acquire()
+		try:
+			if (self.closed):
+				return
+			self.counters.increment('queued')
+
+			# The client will resync anyway - no need to queue the post
+			if (self.resyncQueued):
+				self.counters.increment('coalesced')
+				return
+
+			# Queue is full - apply the overflow policy
+			if (len(self.msgs) >= self.maxPending):
+				if (self.overflowPolicy == 'drop-oldest'):
+					self.msgs.popleft()
+					self.queuedTimes.popleft()
+					self.counters.increment('dropped')
+				elif (self.overflowPolicy == 'coalesce'):
+					self.counters.increment('coalesced', len(self.msgs) + 1)
+					self.msgs.clear()
+					self.queuedTimes.clear()
+					self.resyncQueued = True
+					msg = self.RESYNC_HINT
+				else:
+					self.counters.increment('disconnected')
+					self.msgs.clear()
+					self.queuedTimes.clear()
+					self.closed = True
+					disconnect = True
+
+			if (not disconnect):
+				self.msgs.append(msg)
+				self.queuedTimes.append(time.time())
+			self.cond.notify()
+		finally:
+			self.cond.release()
+
+		if (disconnect):
+			self.disconnectFunc()
+
+	# Remove and return every queued message
+	def popAll(self):
+		self.cond.acquire()
+		try:
+			msgs = list(self.msgs)
+			self.msgs.clear()
+			self.resyncQueued = False
+			self.counters.increment('delivered', len(msgs))
+			if (self.delayHistogram is not None):
+				now = time.time()
+				for queuedTime in self.queuedTimes:
+					self.delayHistogram.observe(now - queuedTime)
+			self.queuedTimes.clear()
+			return msgs
+		finally:
+			self.cond.release()
+
+	# Wait until there are messages queued, then remove and return all of them
+	# Returns None once the queue is closed
+	def waitPopAll(self):
+		self.cond.acquire()
+		try:
+			while (len(self.msgs) == 0 and not self.closed):
+				self.cond.wait()
+			if (self.closed):
+				return None
+			return self.popAll()
+		finally:
+			self.cond.release()
+
+	# Returns whether there are messages queued
+	def hasPending(self):
+		return (len(self.msgs) > 0)
+
+	# Stop accepting messages, and wake the writer so it can finish
+	def close(self):
+		self.cond.acquire()
+		self.closed = True
+		self.msgs.clear()
+		self.queuedTimes.clear()
+		self.cond.notify()
+		self.cond.release()
+
+# This is the thread that writes the messages pushed to a client, in the threaded engine
+class ClientWriter(threading.Thread):
+
+	# Constructor given the client's framed socket and its outbound queue
+	def __init__(self, clientSock, pushQueue):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.clientSock = clientSock
+		self.pushQueue = pushQueue
+
+	# Execute thread - write queued messages until the queue is closed
+	def run(self):
+		msgs = self.pushQueue.waitPopAll()
+		while (msgs is not None):
+			try:
+				self.clientSock.sendMany(msgs)
+			except socket.error:
+				self.pushQueue.close()
+				break
+			msgs = self.pushQueue.waitPopAll()
 
 # This class is responsible for iterating through list of clients, and performing action(s)
+# Clients in push mode subscribe to the posts they want pushed, by topic:
+#   ()			every post (the default)
+#   (bookname,)		posts in a book
+#   (bookname, pagenum)	posts on a page
+# A topic index maps each topic to its subscribers, so pushing a post only
+# visits the clients interested in it.
 class ClientThreadIterator(object):
 
+	# Constants
+	ALL_POSTS = ()
+
 	# Constructor
 	def __init__(self):
 		self.clientThreads = []
 		self.pushThreads = [ thread for thread in self.clientThreads if thread.client.opmode == 'push' ]
 
-	# Push a forum post to all clients operating in push mode
-	def pushPost(self, postDataStr):
-		if (len(self.pushThreads) == 0):
-			print "Push list empty. No action required!"
+		# Topic index: { topic: set of client threads }
+		self.topics = {}
+		self.topicsLock = threading.Lock()
+
+	# Push a forum post (with sequence number 'seq') to all clients operating in push mode
+	# that subscribe to its book/page
+	def pushPost(self, postDataStr, bookname, pagenum, seq):
+		self.topicsLock.acquire()
+		try:
+			recipients = set()
+			for topic in [self.ALL_POSTS, (bookname,), (bookname, pagenum)]:
+				recipients.update(self.topics.get(topic, ()))
+		finally:
+			self.topicsLock.release()
+
+		if (len(recipients) == 0):
+			log.debug("No subscribers for this post. No action required!")
 		else:
-			for thread in self.pushThreads:
-				thread.pushPost(postDataStr)
+			for thread in recipients:
+				thread.pushPost(postDataStr, seq)
+
+	# Set the topic a client subscribes to (replacing its previous subscription)
+	def subscribe(self, thread, topic):
+		self.topicsLock.acquire()
+		try:
+			self.removeSubscription(thread)
+			self.topics.setdefault(topic, set()).add(thread)
+			thread.subscription = topic
+		finally:
+			self.topicsLock.release()
+
+	# Stop pushing posts to a client
+	def unsubscribe(self, thread):
+		self.topicsLock.acquire()
+		try:
+			self.removeSubscription(thread)
+		finally:
+			self.topicsLock.release()
+
+	# Remove a client from the topic index
+	# NOTE: Assumes the topics lock is held
+	def removeSubscription(self, thread):
+		if (thread.subscription is None):
+			return
+		subscribers = self.topics.get(thread.subscription)
+		if (subscribers is not None):
+			subscribers.discard(thread)
+			if (len(subscribers) == 0):
+				del self.topics[thread.subscription]
+		thread.subscription = None
 
 	# Update the pushThreads by adding those clients who are in 'push' mode
 	def updatePushList(self):
 		oldNumPushClients = len(self.pushThreads)
 		self.pushThreads = [ thread for thread in self.clientThreads if thread.client.opmode == 'push' ]
 		if (oldNumPushClients != len(self.pushThreads)):
-			print "Updated push list!"
+			log.debug("Updated push list!")
 
 	# Add a client thread
 	def addClientThread(self, newClientThread):
@@ -303,7 +1901,10 @@ class ClientThreadIterator(object):
 	# and update push list
 	def removeClientThread(self, threadToRemove):
 		self.clientThreads.remove(threadToRemove)
+		self.unsubscribe(threadToRemove)
 		self.updatePushList()
+		if (busClient is not None and threadToRemove.client.user_name != ""):
+			busClient.userLeft(threadToRemove.client.user_name)
 
 	# Return a ClientThread obj based on the client's username
 	# Assumes 'ClientThread.ClientObj.user_name' is initialised
@@ -316,6 +1917,127 @@ class ClientThreadIterator(object):
 		# No thread with username found
 		return None		
 
+# This class holds the clients waiting (long-polling) for new posts on a page
+# A client watches one page at a time, given the version of the page it has
+# (see ServerDB.getPageVersion). It is told as soon as a post lands on the page,
+# or once its timeout expires, through 'pageChanged(bookname, pagenum, version)'
+class PageWatchers(object):
+
+	# Constructor given a function that returns the version of a (bookname, pagenum)
+	def __init__(self, versionFunc):
+		self.versionFunc = versionFunc
+
+		# watchers = { (bookname, pagenum): set of clients }
+		# Each watching client has 'watch' set to (page, token)
+		self.watchers = {}
+
+		# Heap of (deadline, token, client) - entries whose token no longer matches
+		# the client's watch are stale, and skipped
+		self.deadlines = []
+		self.nextToken = 0
+
+		# Guards the watchers, and wakes the expiry thread when a deadline is added
+		self.lock = threading.Condition(threading.RLock())
+
+	# Watch a page for posts after the given version, for up to 'timeout' seconds (0 = no timeout),
+	# replacing the client's previous watch
+	# Returns the current version if the client is behind it (the client is not left waiting),
+	# or None once the client is waiting
+	def watch(self, client, pageKey, version, timeout):
+		self.lock.acquire()
+		try:
+			self.removeWatch(client)
+
+			# Checked under the lock, so a post landing meanwhile is never missed
+			currentVersion = self.versionFunc(pageKey)
+			if (version != currentVersion):
+				return currentVersion
+
+			self.nextToken = self.nextToken + 1
+			client.watch = (pageKey, self.nextToken)
+			self.watchers.setdefault(pageKey, set()).add(client)
+			if (timeout > 0):
+				heapq.heappush(self.deadlines, (time.time() + timeout, self.nextToken, client))
+				self.lock.notify()
+			return None
+		finally:
+			self.lock.release()
+
+	# Stop a client watching
+	def cancel(self, client):
+		self.lock.acquire()
+		try:
+			self.removeWatch(client)
+		finally:
+			self.lock.release()
+
+	# Remove a client from the watchers
+	# NOTE: Assumes the lock is held
+	def removeWatch(self, client):
+		if (client.watch is None):
+			return
+		pageKey, _ = client.watch
+		watching = self.watchers.get(pageKey)
+		if (watching is not None):
+			watching.discard(client)
+			if (len(watching) == 0):
+				del self.watchers[pageKey]
+		client.watch = None
+
+	# A post has landed on a page - tell every client watching it
+	def notifyChanged(self, pageKey):
+		self.lock.acquire()
+		try:
+			watching = self.watchers.pop(pageKey, ())
+			for client in watching:
+				client.watch = None
+			version = self.versionFunc(pageKey)
+		finally:
+			self.lock.release()
+
+		bookname, pagenum = pageKey
+		for client in watching:
+			client.pageChanged(bookname, pagenum, version)
+
+	# Seconds until the earliest deadline, or None if no watch has one
+	def nextTimeout(self):
+		self.lock.acquire()
+		try:
+			if (len(self.deadlines) == 0):
+				return None
+			return max(self.deadlines[0][0] - time.time(), 0)
+		finally:
+			self.lock.release()
+
+	# Tell the clients whose deadlines have passed that their page has not changed
+	def expire(self):
+		expired = []
+		self.lock.acquire()
+		try:
+			now = time.time()
+			while (len(self.deadlines) > 0 and self.deadlines[0][0] <= now):
+				_, token, client = heapq.heappop(self.deadlines)
+				if (client.watch is not None and client.watch[1] == token):
+					pageKey, _ = client.watch
+					self.removeWatch(client)
+					expired.append((client, pageKey))
+		finally:
+			self.lock.release()
+
+		for client, pageKey in expired:
+			bookname, pagenum = pageKey
+			client.pageChanged(bookname, pagenum, self.versionFunc(pageKey))
+
+	# Expiry thread (for the threaded engine) - expire watches as their deadlines pass
+	def runExpiry(self):
+		while True:
+			self.lock.acquire()
+			try:
+				self.lock.wait(self.nextTimeout())
+			finally:
+				self.lock.release()
+			self.expire()
+
 # This class represents a client from the server's perspective
 class ClientObj(object):
 
@@ -337,285 +2059,716 @@ class ClientObj(object):
 		print "Operation mode: \t",self.opmode
 		print "Address: \t",self.addr
 
-# This is the thread that is executed when a server serves a single client
-class ClientThread(threading.Thread):
+# This class keeps track of a stream of data being sent to a client, while
+# controlling when the server should continue sending
+# The client grants a credit window when it is ready for the stream:
+#   '#[startAckPhrase]#[window]'
+# and then acknowledges cumulatively:
+#   '#[ackPhrase]#[numItemsReceived]#[streamNum]'
+# At most 'window' un-acknowledged items are in flight at any time.
+# The client may still be acking a stream after all of it has been sent, so acks carry
+# the number of the stream on the connection (counted from 1 by both ends), and those
+# of an earlier stream are not taken for the current one's.
+# A window of 0 sends the whole list (and end message) in a single write, with no acks.
+# A start ack without a window falls back to one item per ack (stop-and-wait).
+# Any other window is kept within [1, MAX_WINDOW], and acks of items not sent yet (or of
+# no more than already acked) are ignored. A window or ack that is not a number is a
+# protocol error, which drops the client (see ClientThread.guardMessage / EventClient.abandon).
+# Note: Tacks on a '#' to all parameter messages to adhere to message formatting
+class StreamSender(object):
+
+	# Credit window assumed for clients that do not grant one, and the largest one granted
+	STOP_AND_WAIT_WINDOW = 1
+	MAX_WINDOW = 1024
+
+	# Constructor given the list to send - either a list of strings, or an EncodedStream
+	# If the client granted a window along with its request, the stream begins without
+	# waiting for a start ack
+	def __init__(self, listToSend, startMsg, startAckPhrase, ackPhrase, endMsg, window=None, streamNum=None):
+		if (not isinstance(listToSend, EncodedStream)):
+			listToSend = EncodedStream(listToSend, endMsg)
+		self.listToSend = listToSend
+		self.startMsg = startMsg
+		self.startAckPhrase = startAckPhrase
+		self.ackPhrase = ackPhrase
+		self.endMsg = endMsg
+		self.streamNum = streamNum
+
+		self.window = None		# unknown until the client acks the start message (if not given)
+		if (window is not None):
+			self.window = self.clampWindow(window)
+		self.numSent = 0
+		self.numAcked = 0
+		self.done = False
+
+	# Return the (encoded) message that begins the stream, followed by the first window
+	# of items if the window is already known
+	def start(self):
+		startFrame = encodeFrame('#' + self.startMsg)
+		if (self.window is None):
+			return startFrame
+		return startFrame + self.sendWindow()
+
+	# Returns whether a message received from the client belongs to this stream
+	def accepts(self, msg):
+		msgComponents = msg.split('#')
+		if (self.window is None):
+			return (msgComponents[1] == self.startAckPhrase)
+		if (len(msgComponents) > 3 and msgComponents[3] != str(self.streamNum)):
+			return False		# a late ack of an earlier stream
+		return (msgComponents[1] == self.ackPhrase)
+
+	# Process a (start) ack from the client
+	# Returns the (encoded) messages that should now be sent
+	def receive(self, msg):
+		msgComponents = msg.split('#')
+
+		# Client is ready for the stream - obtain its window
+		if (self.window is None):
+			self.window = self.STOP_AND_WAIT_WINDOW
+			if (len(msgComponents) > 2):
+				self.window = self.clampWindow(int(msgComponents[2]))
+
+		# Cumulative ack for the items sent so far
+		elif (len(msgComponents) > 2):
+			numAcked = int(msgComponents[2])
+			if (numAcked > self.numAcked and numAcked <= self.numSent):
+				self.numAcked = numAcked
+		else:
+			self.numAcked = min(self.numAcked + 1, self.numSent)
+
+		return self.sendWindow()
+
+	# Return the window granted by the client, within [1, MAX_WINDOW] (unless 0 - batched)
+	def clampWindow(self, window):
+		if (window == 0):
+			return 0
+		return min(max(window, 1), self.MAX_WINDOW)
+
+	# Return the (encoded) items the window currently allows
+	def sendWindow(self):
+
+		# Batched - send everything at once
+		if (self.window == 0):
+			self.done = True
+			return self.listToSend.encodeRange(0, len(self.listToSend), True)
+
+		# Send every item the window currently allows, along with the end message
+		# (to indicate to client the end of stream) once every item is sent
+		sendStart = self.numSent
+		sendLimit = min(self.numAcked + self.window, len(self.listToSend))
+		self.numSent = max(self.numSent, sendLimit)
+		if (self.numSent == len(self.listToSend)):
+			self.done = True
+
+		return self.listToSend.encodeRange(sendStart, self.numSent, self.done)
+
+# This class holds the items of a stream (and its end message) encoded as frames, so
+# that a list that is sent repeatedly (eg. the lines of a page) is only serialised once
+class EncodedStream(object):
+
+	# Constructor given the list of strings to send, and the stream's end message,
+	# optionally followed by items that are already encoded
+	def __init__(self, listToSend, endMsg, encodedFrames=()):
+		self.frames = [ encodeFrame(item) for item in listToSend ] + list(encodedFrames)
+		self.endFrame = encodeFrame('#' + endMsg)
+		self.wholeStream = ''.join(self.frames) + self.endFrame
+
+	# Return the number of items in the stream
+	def __len__(self):
+		return len(self.frames)
+
+	# Return the encoded items in [start, end), followed by the end message if 'withEnd'
+	def encodeRange(self, start, end, withEnd):
+		if (start == 0 and end == len(self.frames) and withEnd):
+			return self.wholeStream
+		data = ''.join(self.frames[start:end])
+		if (withEnd):
+			data = data + self.endFrame
+		return data
+
+# This class serves a single client - it handles each message received from the client
+# NOTE: It is independent of how the connection is driven, which is left to
+# ClientThread (thread per client) or EventClient (single event loop for all clients)
+class ClientHandler(object):
 
-	# Constructor
-	def __init__(self,clientsocket, addr):
-		threading.Thread.__init__(self)
+	# Constants
+	# What a search may look through (see 'SearchReq'), the most matches sent at once, and
+	# the furthest into the matches a search may start (so no search ranks more than both)
+	SEARCH_SCOPES = ['all', 'books', 'posts']
+	MAX_SEARCH_RESULTS = 100
+	MAX_SEARCH_OFFSET = 1000
 
-		# Create the client object
-		self.client = ClientObj(clientsocket, addr)
+	# Constructor given the client's (framed) socket and address
+	def __init__(self, clientSock, addr):
 
-		# Add the client's socket to list of sockets
-		self.listen_sockets = [self.client.sock]
+		# Create the client object
+		self.client = ClientObj(clientSock, addr)
 
 		# Set the client_stop flag to false (ie client does not want to terminate 
 		# connection)
 		self.client_stop = False
 
-	# Execute thread
-	def run(self):
-		self.serve_client()
-		print "Closing connection with", addr
-
-	# Serve the client
-	def serve_client(self):
-
-		# Constants within scope of client thread
-		newPostInfo = ()
-		newPostContent = ()
+		# Messages received while a stream was being sent, to be handled afterwards
+		self.deferredMsgs = deque()
+
+		# Number of streams sent to the client so far (see StreamSender)
+		self.numStreams = 0
+
+		# Topic the client subscribes to for pushed posts (see ClientThreadIterator)
+		self.subscription = None
+
+		# Page the client is waiting on for new posts (see PageWatchers)
+		self.watch = None
+
+		# ID of the node, if the client is another node replicating this one's posts (see 'ReplSyncReq')
+		self.replicaNode = None
+
+		# Posts waiting to be pushed to the client
+		self.pushQueue = OutboundQueue(PUSH_QUEUE_SIZE, PUSH_OVERFLOW_POLICY, pushCounters, \
+						self.client.sock.shutdown, serverMetrics.pushDelay)
+
+		# (message type, time received) of the request being answered, to measure it
+		self.requestStarted = None
+
+	# Handle a single message received from the client, measuring how long it takes to
+	# answer (a response streamed by the event engine is only done once it has been acked,
+	# and an upload through the bus once the bus has answered)
+	# NOTE: An empty message indicates the client has closed the connection
+	def handleMessage(self, data):
+		if (data == ''):
+			self.dispatchMessage(data)
+			return
+
+		self.requestStarted = (data.split('#')[1], time.time())
+		self.dispatchMessage(data)
+		if (not self.isResponding()):
+			self.requestDone()
+
+	# The request being answered has been answered
+	def requestDone(self):
+		if (self.requestStarted is not None):
+			msgType, startTime = self.requestStarted
+			serverMetrics.observeRequest(msgType, time.time() - startTime)
+			self.requestStarted = None
+
+	# Returns whether the response to the request is still being sent (or waited on)
+	def isResponding(self):
+		return False
+
+	# Handle a single message received from the client (see 'handleMessage')
+	def dispatchMessage(self, data):
+
+		# Connection closed by the client without an exit message
+		if (data == ''):
+			self.client_stop = True
+			clientThreadIterator.removeClientThread(self)
+			pageWatchers.cancel(self)
+			return
+
+		msg_components = data.split('#')
+
+		# Determine the type of information received
+		# Intro message received
+		if (msg_components[1] == "Intro"):
+			# Parse information about client
+			self.client.user_name = msg_components[2]
+			self.client.opmode = msg_components[3]
+			self.client.ip_addr = msg_components[4]
+	
+			log.info("Client details received! Name: %s, Opmode: %s, IP: %s", \
+						self.client.user_name, self.client.opmode, self.client.ip_addr)
 
-		while not self.client_stop:
-			
-			data = self.selectRecv(BUFFER_SIZE)
-			msg_components = data.split('#')
-
-			# Determine the type of information received
-			# Intro message received
-			if (msg_components[1] == "Intro"):
-				# Parse information about client
-				self.client.user_name = msg_components[2]
-				self.client.opmode = msg_components[3]
-				self.client.ip_addr = msg_components[4]
+			# Let the other workers find the client (for chat requests)
+			if (busClient is not None):
+				busClient.userJoined(self.client.user_name)
 		
-				print "Client details received! Name: %s, Opmode: %s, IP: %s" % \
-							(self.client.user_name, self.client.opmode, self.client.ip_addr)
+			# Update the push list - push clients receive every post until they subscribe otherwise
+			clientThreadIterator.updatePushList()
+			if (self.client.opmode == 'push'):
+				clientThreadIterator.subscribe(self, clientThreadIterator.ALL_POSTS)
+
+		# Push client is choosing which posts to receive, in the format:
+		# '#SubscribeReq#*'  or  '#SubscribeReq#[bookname]'  or  '#SubscribeReq#[bookname]#[pagenum]'
+		elif (msg_components[1] == 'SubscribeReq'):
+
+			topic = clientThreadIterator.ALL_POSTS
+			if (msg_components[2] != '*'):
+				topic = (msg_components[2],)
+				if (len(msg_components) > 3):
+					topic = (msg_components[2], int(msg_components[3]))
+
+			log.debug("'%s' subscribed to posts in %s.", self.client.user_name, topic or "all books")
+			clientThreadIterator.subscribe(self, topic)
+
+		# Clean exit message received
+		elif (msg_components[1] == "Exit"):
+			# Cut connection with client
+			self.client_stop = True
+
+			# indicate to message pusher to remove this particular client from list	of threads
+			clientThreadIterator.removeClientThread(self)
+			pageWatchers.cancel(self)
+
+		# Display request received from client
+		elif (msg_components[1] == 'DisplayReq'):
+		
+			# Load parameters
+			bookname = msg_components[2]
+			pagenum = int(msg_components[3])
+			log.debug("%s requested to print page %d from %s.", self.client.user_name, pagenum, bookname)
+
+			# Obtain the (pre-encoded) lines of the page to send
+			displayMsg = []
+			try:
+				displayMsg = books[bookname].getEncodedPageContent(pagenum, 'EndDisplayResp')
+
+			except KeyError:
+				errorStr = "#Error#Book name '%s' not found." % bookname
+				displayMsg.append(errorStr)
+
+			# Send the list of strings as a stream of messages
+			log.debug("Sending display stream...")
+			self.sendStream(displayMsg, 'DisplayResp', 'BeginDisplayResp', 'DisplayRespRcvd', 'EndDisplayResp')
+
+		# [Client pull mode] Request to display a page along with the posts on it that the client
+		# does not have, in a single response, in the format:
+		# '#DisplayPageReq#[bookname]#[pagenum]#[version]#[window]'
+		# The window is granted up front, so the response is a stream that begins straight away:
+		# '#DisplayPageResp#[bookname]#[pagenum]#[new version]'
+		# followed by the posts ('#PostInfo...|#PostContent...'), then the lines of the page
+		# ('#[linenum]#[line]'), or a single '#Error#[error msg]'.
+		# See 'WatchPageReq' for the page versions
+		elif (msg_components[1] == 'DisplayPageReq'):
+
+			# Load parameters
+			bookname = msg_components[2]
+			pagenum = int(msg_components[3])
+			version = int(msg_components[4])
+			window = int(msg_components[5])
+			log.debug("%s requested to print page %d from %s, with its posts.", self.client.user_name, pagenum, bookname)
+
+			# Check the page exists
+			resp, result = serverDB.getPostsID(bookname, pagenum)
+			if (resp != serverDB.OP_SUCCESS):
+				self.sendStream(["#Error#" + result], 'DisplayPageResp#' + bookname + '#' + str(pagenum) + '#' + str(version), \
+						'BeginDisplayPageResp', 'DisplayPageRespRcvd', 'EndDisplayPageResp', window)
+				return
+
+			# Obtain the posts the client does not have
+			# NOTE: A version ahead of the page (eg. from before the database was lost) gets every post
+			newVersion = serverDB.getPageVersion((bookname, pagenum))
+			if (version > newVersion):
+				version = 0
+			_, postIDs = serverDB.getPostsID(bookname, pagenum)
+			posts = [ serverDB.getPostAsStr(postID)[1] for postID in postIDs[version:newVersion] ]
+
+			# Obtain the (pre-encoded) lines of the page
+			pageLines = books[bookname].getPageObj(pagenum).getEncodedContent('EndDisplayPageResp')
+
+			# Send the posts, then the lines, as one stream
+			log.debug("Sending page with %d new posts...", len(posts))
+			displayMsg = EncodedStream(posts, 'EndDisplayPageResp', pageLines.frames)
+			self.sendStream(displayMsg, 'DisplayPageResp#' + bookname + '#' + str(pagenum) + '#' + str(newVersion), \
+					'BeginDisplayPageResp', 'DisplayPageRespRcvd', 'EndDisplayPageResp', window)
+
+		# Reader is uploading a new forum post
+		# '#UploadPost#PostInfo...|#PostContent...
+		elif (msg_components[1] == 'UploadPost'):
+
+			log.debug("New post received from %s!", self.client.user_name)
+
+			# parse the strings that contain information of the post
+			postDataStr = data.split('#UploadPost')[1]
+			postInfoStr = postDataStr.split('|')[0]
+			postContentStr = postDataStr.split('|')[1]
+
+			# With several worker processes, the post is inserted by the bus hub, and
+			# published by every worker as it arrives from the bus (see BusClient)
+			# (a post that cannot be inserted is turned down here, rather than by the hub)
+			if (busClient is not None):
+				resp, result = serverDB.checkNewPost(postInfoStr, postContentStr)
+				if (resp != serverDB.OP_SUCCESS):
+					self.uploadDone(resp, result)
+					return
+				self.insertThroughBus(postInfoStr, postContentStr)
+				return
+
+			# Insert the new post into database, and obtain response
+			resp, result = serverDB.insertPost(postInfoStr, postContentStr)
+			self.uploadDone(resp, result)
+
+			# Push the new post, and wake the clients waiting for posts on its page
+			if (resp == serverDB.OP_SUCCESS):
+				publishPost(int(result))
+
+		# Posts Request message received (to obtain post IDs for a particular book/page), in the format:
+		# '#GetPostsIDReq#[bookname]#[pagenum]'
+		elif (msg_components[1] == 'GetPostsIDReq'):
+
+			# Extract information given
+			log.debug("Query for new posts received from %s!", self.client.user_name)
+			bookName = msg_components[2]
+			pageNum = int(msg_components[3])
+
+			# Get a list of all post ID's for the associated page/book,
+			resp, result = serverDB.getPostsID(bookName, pageNum)
+
+			# Check if any errors retrieving post ids
+			if (resp == serverDB.OP_FAILURE):
+				postsResp = "#Error#" + result
+				self.client.sock.send(postsResp)
+				return
+
+			# Construct the response string, and send to client
+			postsIDs = result
+			postsRespStr = "#GetPostsIDResp#"
+			for i in range(0, len(postsIDs)):
+				postsRespStr = postsRespStr + str(postsIDs[i])
+				if (i < len(postsIDs) - 1):
+					postsRespStr = postsRespStr + ','
+			self.client.sock.send(postsRespStr)
+
+		# Posts Request message received (to obtain information of posts through given ID's) in the format:
+		# '#GetPostsReq#[PostID],[PostID]...'
+		elif (msg_components[1] == 'GetPostsLocReq'):
+
+			log.debug("Query for posts received from client '%s'!", self.client.user_name)
 			
-				# Update the push list
-				clientThreadIterator.updatePushList()
+			# Extract the information given
+			bookname = msg_components[2]
+			pagenum = int(msg_components[3])
+			readerPostIDs = msg_components[4].split(',')
 
-			# Clean exit message received
-			elif (msg_components[1] == "Exit"):
-				# Cut connection with client
-				self.listen_sockets.remove(self.client.sock)
-				self.client_stop = True
+			# Convert the list of postID's into a list of ints (from strings)
+			if (len(readerPostIDs) > 0 and readerPostIDs[0] != ''):
+				readerPostIDs = [ int(postID) for postID in readerPostIDs ]
 
-				# indicate to message pusher to remove this particular client from list	of threads
-				clientThreadIterator.removeClientThread(self)
+			# Get a list of post ID's which are associated to the book and page
+			resp, result = serverDB.getPostsID(bookname, pagenum)
 
-			# Display request received from client
-			elif (msg_components[1] == 'DisplayReq'):
+			sendList = []	# to send
 			
-				# Load parameters
-				bookname = msg_components[2]
-				pagenum = int(msg_components[3])
-				print "%s requested to print page %d from %s." % (self.client.user_name, pagenum, bookname)
-
-				# Obtain a list of strings to send
-				displayMsg = []
-				try:
-					displayMsg = books[bookname].getPageContent(pagenum)
-
-				except KeyError:
-					errorStr = "#Error#Book name '%s' not found." % bookname
-					displayMsg.append(errorStr)
-
-				# Send the list of strings as a stream of messages
-				print "Sending display stream..."
-				self.sendStream(displayMsg, 'DisplayResp', 'BeginDisplayResp', 'DisplayRespRcvd', 'EndDisplayResp')
-
-			# Reader is uploading a new forum post
-			# '#UploadPost#PostInfo...|#PostContent...
-			elif (msg_components[1] == 'UploadPost'):
-
-				print "New post received from %s!" % self.client.user_name
-
-				# parse the strings that contain information of the post
-				postDataStr = data.split('#UploadPost')[1]
-				postInfoStr = postDataStr.split('|')[0]
-				postContentStr = postDataStr.split('|')[1]
-	
-				# Insert the new post into database, and obtain response
-				resp, result = serverDB.insertPost(postInfoStr, postContentStr)
-
-				# Check if any errors inserting into database
-				if (resp == serverDB.OP_FAILURE):
-					uploadResp = "#UploadPostResp#Error#" + result
-					self.client.sock.send(uploadResp)
-					continue
-
-				# Send the success sresponse back to the client
-				self.client.sock.send('#UploadPostResp#Success')
-
-				# Delay so client receives success message
-				time.sleep(0.001)
-
-				# Trigger the clientThreadIterator to push the new post
-				resp, dataStr = serverDB.getPostAsStr(int(result))
-				clientThreadIterator.pushPost(dataStr)
-
-			# Posts Request message received (to obtain post IDs for a particular book/page), in the format:
-			# '#GetPostsIDReq#[bookname]#[pagenum]'
-			elif (msg_components[1] == 'GetPostsIDReq'):
-
-				# Extract information given
-				print "Query for new posts received from %s!" % self.client.user_name
-				bookName = msg_components[2]
-				pageNum = int(msg_components[3])
+			# Check for any errors
+			if (resp != serverDB.OP_SUCCESS):
+				# Add the error into the send list
+				errorStr = "#Error#" + result
+				sendList.append(errorStr)
+			else:
+				# Get the list of ID's that are NOT owned by reader
+				serverPostIDs = result
+				readerPostIDs = set(readerPostIDs)
+				unknownPostIDs = [ postID for postID in serverPostIDs if postID not in readerPostIDs ]
+				sendList = [ serverDB.getPostAsStr(postID)[1] for postID in unknownPostIDs ]
+
+			# Send all the unknown posts as a stream
+			self.sendStream(sendList, 'GetPostsLocResp', 'BeginGetPostsLocResp', 'NewPostRcvd',  'EndGetPostsLocResp')				
+		
+		# [Client pull mode] Request to wait for new posts on a page, in the format:
+		# '#WatchPageReq#[bookname]#[pagenum]#[version]#[timeout]'
+		# If the page has posts after the version the client has, they are sent back straight away,
+		# as a stream starting with '#PagePostsResp#[bookname]#[pagenum]#[new version]'.
+		# Otherwise the request is held until a post lands on the page, or the timeout (in seconds,
+		# 0 = none) expires, and answered with '#WatchPageResp#[bookname]#[pagenum]#[version]'
+		elif (msg_components[1] == 'WatchPageReq'):
+
+			# Extract the information given
+			bookname = msg_components[2]
+			pagenum = int(msg_components[3])
+			version = int(msg_components[4])
+			timeout = float(msg_components[5])
+
+			# Check the page exists
+			resp, result = serverDB.getPostsID(bookname, pagenum)
+			if (resp != serverDB.OP_SUCCESS):
+				self.sendStream(["#Error#" + result], 'PagePostsResp#' + bookname + '#' + str(pagenum) + '#' + str(version), \
+						'BeginPagePostsResp', 'NewPostRcvd', 'EndPagePostsResp')
+				return
+
+			# Wait for the page to change, unless it already has
+			newVersion = pageWatchers.watch(self, (bookname, pagenum), version, timeout)
+			if (newVersion is None):
+				return
+
+			# Send the posts the client does not have
+			# NOTE: A version ahead of the page (eg. from before the database was lost) gets every post
+			if (version > newVersion):
+				version = 0
+			_, postIDs = serverDB.getPostsID(bookname, pagenum)
+			sendList = [ serverDB.getPostAsStr(postID)[1] for postID in postIDs[version:newVersion] ]
+
+			log.debug("Sending %d new posts on page %d of %s to '%s'...", len(sendList), pagenum, bookname, self.client.user_name)
+			self.sendStream(sendList, 'PagePostsResp#' + bookname + '#' + str(pagenum) + '#' + str(newVersion), \
+					'BeginPagePostsResp', 'NewPostRcvd', 'EndPagePostsResp')
+
+		# [Client push mode] Request for ALL posts inserted after the latest one the client has seen,
+		# received in the format:
+		# '#SyncPostsReq#[sequence number of latest post seen]'
+		elif (msg_components[1] == 'SyncPostsReq'):
+
+			log.debug("Query for syncing posts from '%s'!", self.client.user_name)
+			
+			# Extract the sequence number of the latest post that client has seen
+			cursor = 0
+			if (len(msg_components) > 2 and msg_components[2] != ''):
+				cursor = int(msg_components[2])
+		
+			# Obtain the list of id's inserted since
+			unknownPostIDs, newCursor = serverDB.getPostsSince(cursor)
 
-				# Get a list of all post ID's for the associated page/book,
-				resp, result = serverDB.getPostsID(bookName, pageNum)
+			# Convert each one into a string
+			unknownPosts = [ serverDB.getPostAsStr(postID)[1] for postID in unknownPostIDs ]
 
-				# Check if any errors retrieving post ids
-				if (resp == serverDB.OP_FAILURE):
-					postsResp = "#Error#" + result
-					self.client.sock.send(postsResp)
-					continue
+			log.debug("Client '%s' is at post %d of %d. Forwarding %d new posts...", \
+					self.client.user_name, cursor, newCursor, len(unknownPostIDs))
 
-				# Construct the response string, and send to client
-				postsIDs = result
-				postsRespStr = "#GetPostsIDResp#"
-				for i in range(0, len(postsIDs)):
-					postsRespStr = postsRespStr + str(postsIDs[i])
-					if (i < len(postsIDs) - 1):
-						postsRespStr = postsRespStr + ','
-				self.client.sock.send(postsRespStr)
-
-			# Posts Request message received (to obtain information of posts through given ID's) in the format:
-			# '#GetPostsReq#[PostID],[PostID]...'
-			elif (msg_components[1] == 'GetPostsLocReq'):
-
-				print "Query for posts received from client '%s'!" % self.client.user_name
-				
-				# Extract the information given
-				bookname = msg_components[2]
-				pagenum = int(msg_components[3])
-				readerPostIDs = msg_components[4].split(',')
-
-				# Convert the list of postID's into a list of ints (from strings)
-				if (len(readerPostIDs) > 0 and readerPostIDs[0] != ''):
-					readerPostIDs = [ int(postID) for postID in readerPostIDs ]
-
-				# Get a list of post ID's which are associated to the book and page
-				resp, result = serverDB.getPostsID(bookname, pagenum)
-
-				sendList = []	# to send
-				
-				# Check for any errors
-				if (resp != serverDB.OP_SUCCESS):
-					# Add the error into the send list
-					errorStr = "#Error#" + result
-					sendList.append(errorStr)
-				else:
-					# Get the list of ID's that are NOT owned by reader
-					serverPostIDs = result
-					unknownPostIDs = [ postID for postID in serverPostIDs if postID not in readerPostIDs ]
-					sendList = [ serverDB.getPostAsStr(postID)[1] for postID in unknownPostIDs ]
+			# Send back the unsynced posts as a stream, starting with the client's new cursor
+			self.sendStream(unknownPosts, 'SyncPostsResp#' + str(newCursor), 'BeginSyncPostsResp', 'NewPostRcvd', 'EndSyncPostsResp')
 
-				# Send all the unknown posts as a stream
-				self.sendStream(sendList, 'GetPostsLocResp', 'BeginGetPostsLocResp', 'NewPostRcvd',  'EndGetPostsLocResp')				
+		# This client (A) wants to request a chat session with another user B
+		# in the format:
+		# '#StartChatReq#[TargetUserName]#[PortNumToUse]'
+		elif (msg_components[1] == 'StartChatReq'):
 			
-			# [Client push mode] Request for ALL post ID's that client does NOT have, received int he format:
-			# '#PostsSyncIDReq#[Postid],[Postid]...'
-			elif (msg_components[1] == 'SyncPostsReq'):
-
-				print "Query for syncings posts from '%s'!" % self.client.user_name
-				
-				# Extract the list of postID's that client has
-				clientPostIDs = data.split('#SyncPostsReq#')[1].split(',')
-				if (len(clientPostIDs) > 0 and clientPostIDs[0] != ''):
-					clientPostIDs = [ int(postID) for postID in clientPostIDs ]
+			# Extract the parameters
+			bUsername = msg_components[2]
+			aChatport = msg_components[3]		# free port of client A
+
+			log.info("'%s' wants to talk to '%s' using port %s!", self.client.user_name, bUsername, aChatport)
+
+			# Get the client thread with target username
+			bThread = clientThreadIterator.getClientThread(bUsername)
+
+			# B may be served by another worker - the bus relays the request, or answers
+			# with the error if B is not connected at all
+			if (bThread is None and busClient is not None):
+				log.debug("Relaying chat request to client %s through the bus...", bUsername)
+				busClient.relay(bUsername, formatRelayStartChatReq(self.client.user_name, self.client.ip_addr, aChatport), \
+						self.client.user_name)
+				return
+
+			# Check whether target exists
+			if (bThread is None):
+				# Send back error string
+				errorStr = '#StartChatResp#Error#User does not exists.'
+				self.client.sock.send(errorStr)
+				return
 			
-				# Get the list of id's that are in the server's DB
-				serverPostIDs = serverDB.getAllPostIDs()
-				
-				# Obtain the list of id's that client does not have
-				unknownPostIDs = [ postID for postID in serverPostIDs if postID not in clientPostIDs ]
+			# Get B's thread to relay the chat request
+			log.debug("Relaying chat request to client %s...", bUsername)
+			bThread.relayStartChatReq(self.client.user_name, self.client.ip_addr, aChatport)
+
+		# This client (B) sends back a notification for the acceptance/rejection of a chat invite
+		# in the format:
+		# '#RelayStartChatResp#Accept#[BFreeport]#[AUsername]#[AChatport]
+		# 	OR
+		# '#RelayStartChatResp#Reject#[AUsername]
+		elif (msg_components[1] == 'RelayStartChatResp'):
+
+			# Check if accept or reject
+			if (msg_components[2] == 'Accept'):
+
+				# Compile necessary parameters for return message
+				bUsername = self.client.user_name
+				bIP = self.client.ip_addr
+				bChatport = msg_components[3]
+				aUsername = msg_components[4]
+				aChatport = msg_components[5]
+
+				# Get the clientThread with username belonging to client A
+				aThread = clientThreadIterator.getClientThread(aUsername)
+
+				# Client A may be served by another worker
+				if (aThread is None and busClient is not None):
+					busClient.relay(aUsername, formatStartChatResp(True, bUsername, bIP, bChatport, aChatport))
+					return
+
+				# Client A may have left since inviting this client
+				if (aThread is None):
+					log.info("%s has accepted the invitation, but %s has left.", bUsername, aUsername)
+					return
+
+				log.info("%s has accepted the invitation! Forwarding response to %s...", bUsername, aUsername)
+			
+				# Get Client A's thread to send the chat acceptance message from this client (B)
+				aThread.startChat(True, bUsername, bIP, bChatport, aChatport)
 
-				# Convert each one into a string
-				unknownPosts = [ serverDB.getPostAsStr(postID)[1] for postID in unknownPostIDs ]
+			# Send reject message
+			elif (msg_components[2] == 'Reject'):
 
-				print "Summary of posts received from '%s'. Forwarding new posts..." % self.client.user_name
+				aUsername = msg_components[3]
+				bUsername = self.client.user_name
+				log.info("%s has rejected the invitation. Forwarding response to %s...", bUsername, aUsername)
 
-				# Send back the unsynced posts as a stream
-				self.sendStream(unknownPosts, 'SyncPostsResp', 'BeginSyncPostsResp', 'NewPostRcvd', 'EndSyncPostsResp')
+				# Get username and clientThread obj of rejected client
+				aUsername = msg_components[3]
+				aThread = clientThreadIterator.getClientThread(aUsername)
 
-				print "New posts forwarded: ", unknownPostIDs
-	
-			# This client (A) wants to request a chat session with another user B
-			# in the format:
-			# '#StartChatReq#[TargetUserName]#[PortNumToUse]'
-			elif (msg_components[1] == 'StartChatReq'):
-				
-				# Extract the parameters
-				bUsername = msg_components[2]
-				aChatport = msg_components[3]		# free port of client A
-
-				print "'%s' wants to talk to '%s' using port %s!" % (self.client.user_name, bUsername, aChatport)
-
-				# Get the client thread with target username
-				bThread = clientThreadIterator.getClientThread(bUsername)
-
-				# Check whether target exists
-				if (bThread is None):
-					# Send back error string
-					errorStr = '#StartChatResp#Error#User does not exists.'
-					self.client.sock.send(errorStr)
-					continue
-				
-				# Get B's thread to relay the chat request
-				print "Relaying chat request to client %s..." % bUsername
-				bThread.relayStartChatReq(self.client.user_name, self.client.ip_addr, aChatport)
-
-			# This client (B) sends back a notification for the acceptance/rejection of a chat invite
-			# in the format:
-			# '#RelayStartChatResp#Accept#[BFreeport]#[AUsername]#[AChatport]
-			# 	OR
-			# '#RelayStartChatResp#Reject#[AUsername]
-			elif (msg_components[1] == 'RelayStartChatResp'):
-
-				# Check if accept or reject
-				if (msg_components[2] == 'Accept'):
-
-					# Compile necessary parameters for return message
-					bUsername = self.client.user_name
-					bIP = self.client.ip_addr
-					bChatport = msg_components[3]
-					aUsername = msg_components[4]
-					aChatport = msg_components[5]
-
-					# Get the clientThread with username belonging to client A
-					aThread = clientThreadIterator.getClientThread(aUsername)
-					
-					# Assume such a thread exists
-					print "%s has accepted the invitation! Forwarding response to %s..." % (bUsername, aUsername)
-				
-					# Get Client A's thread to send the chat acceptance message from this client (B)
-					aThread.startChat(True, bUsername, bIP, bChatport, aChatport)
-
-				# Send reject message
-				elif (msg_components[2] == 'Reject'):
-
-					aUsername = msg_components[3]
-					bUsername = self.client.user_name
-					print "%s has rejected the invitation. Forwarding response to %s..." % (bUsername, aUsername)
-
-					# Get username and clientThread obj of rejected client
-					aUsername = msg_components[3]
-					aThread = clientThreadIterator.getClientThread(aUsername)
-					
-					# Send reject message
+				# Send reject message (unless client A has left since)
+				if (aThread is not None):
 					aThread.startChat(False, bUsername)
+				elif (busClient is not None):
+					busClient.relay(aUsername, formatStartChatResp(False, bUsername))
+
+		# Another server instance (node) is replicating the posts of this one (see Replicator), in the format:
+		# '#ReplSyncReq#[node ID]#[origin node ID]:[number of posts from it the node has],...'
+		# The posts it is missing are sent as a stream (without acks):
+		# '#ReplSyncResp#[this node's ID]#[number of posts]', then '#ReplPost...' (see 'formatReplPost')
+		# for each, then '#EndReplSyncResp'
+		# followed by each post inserted (or replicated) from then on, in the same format.
+		# Posts that came from the node itself are left out.
+		# A node with the same ID as this one is refused, with: '#ReplSyncRefused#[reason]'
+		elif (msg_components[1] == 'ReplSyncReq'):
+			replicaNode = int(msg_components[2])
+
+			# The posts of two nodes with the same ID would be taken for those of one origin
+			if (replicaNode == serverDB.nodeID):
+				log.error("Refused to replicate to %s: it has this node's ID (%d).", self.client.addr, replicaNode)
+				self.client.sock.send('#ReplSyncRefused#Node ID %d is already in use by %s.' % \
+						(replicaNode, socket.gethostname()))
+				self.client_stop = True
+				clientThreadIterator.removeClientThread(self)
+				pageWatchers.cancel(self)
+				return
+
+			self.replicaNode = replicaNode
+			originCounts = {}
+			for originCount in msg_components[3].split(','):
+				if (originCount != ''):
+					origin, count = originCount.split(':')
+					originCounts[int(origin)] = int(count)
+			log.info("Node %d is replicating posts from this node (it has %s).", self.replicaNode, originCounts)
+
+			# A node must receive every post - rather than dropping posts for a node that falls
+			# too far behind, it is disconnected, and catches up once it reconnects
+			self.pushQueue.maxPending = REPLICA_QUEUE_SIZE
+			self.pushQueue.overflowPolicy = 'disconnect'
+
+			# Subscribe before obtaining the missing posts, so none is inserted in between unseen
+			# (the node ignores any it receives twice)
+			clientThreadIterator.subscribe(self, clientThreadIterator.ALL_POSTS)
+			replPosts = serverDB.getReplPostsSince(originCounts, self.replicaNode)
+			self.sendStream(replPosts, 'ReplSyncResp#' + str(serverDB.nodeID) + '#' + str(len(replPosts)), \
+					'BeginReplSyncResp', 'ReplPostRcvd', 'EndReplSyncResp', 0)
+
+		# Request to search the lines of the books and / or the content of the posts, in the format:
+		# '#SearchReq#[scope: all/books/posts]#[offset]#[count]#[query]'
+		# Matches contain every word of the query, and are ranked best first. The response is a
+		# stream of up to 'count' matches from 'offset' on (both capped), starting with the format:
+		# '#SearchResp#[number of matches]#[offset]'
+		# each in the format: '#LineHit#[score]#[bookname]#[pagenum]#[linenum]#[line]'
+		#                 or: '#PostHit#[score]#PostInfo...|#PostContent...'
+		#   or a single '#Error#[error msg]'
+		# The search stops once it has the best matches, so the number of matches may just be
+		# of those it found, followed by '+' - asking for no matches ('count' 0 at 'offset' 0)
+		# has every match counted.
+		# The books can only be searched once indexed (see 'startIndexingBooks') - until then,
+		# searching 'all' searches just the posts.
+		elif (msg_components[1] == 'SearchReq'):
+
+			# Extract the information given
+			try:
+				scope = msg_components[2]
+				offset = max(min(int(msg_components[3]), self.MAX_SEARCH_OFFSET), 0)
+				count = max(min(int(msg_components[4]), self.MAX_SEARCH_RESULTS), 0)
+			except (ValueError, IndexError):
+				self.sendStream(["#Error#Invalid search offset or count."], 'SearchResp#0#0', \
+						'BeginSearchResp', 'SearchRespRcvd', 'EndSearchResp')
+				return
+			query = '#'.join(msg_components[5:])
+			log.debug("%s searched the %s for %r.", self.client.user_name, scope, query)
+
+			terms = getSearchTerms(query)
+			booksIndex = bookIndex
+			errorStr = None
+			if (scope not in self.SEARCH_SCOPES):
+				errorStr = "#Error#Unknown search scope '%s'." % scope
+			elif (len(terms) == 0):
+				errorStr = "#Error#Nothing to search for."
+			elif (scope == 'books' and booksIndex is None and bookIndexPending):
+				errorStr = "#Error#The books are still being indexed. Try again shortly."
+			elif (scope == 'books' and booksIndex is None):
+				errorStr = "#Error#The books are not indexed for searching on this server."
+			if (errorStr is not None):
+				self.sendStream([errorStr], 'SearchResp#0#' + str(offset), 'BeginSearchResp', 'SearchRespRcvd', 'EndSearchResp')
+				return
+
+			# Find the best matches up to the end of the page asked for, in each index searched
+			limit = offset + count
+			numMatches = 0
+			allCounted = True
+			matches = []
+			if (scope != 'posts' and booksIndex is not None):
+				numLineMatches, lineMatches, linesCounted = booksIndex.search(terms, limit)
+				numMatches = numMatches + numLineMatches
+				allCounted = allCounted and linesCounted
+				matches.extend([ (match[0], 'Line', match[1:]) for match in lineMatches ])
+			if (scope != 'books'):
+				numPostMatches, postMatches, postsCounted = serverDB.searchPosts(terms, limit)
+				numMatches = numMatches + numPostMatches
+				allCounted = allCounted and postsCounted
+				matches.extend([ (score, 'Post', postID) for score, postID in postMatches ])
+
+			# Rank the matches together, and format just the page asked for
+			matches = heapq.nlargest(limit, matches, key=lambda match: match[0])[offset:limit]
+			sendList = []
+			for score, matchType, ref in matches:
+				if (matchType == 'Line'):
+					sendList.append(formatLineHit(score, *ref))
+				else:
+					sendList.append(formatPostHit(score, serverDB.getPostAsStr(ref)[1]))
+
+			numMatchesStr = str(numMatches)
+			if (not allCounted):
+				numMatchesStr = numMatchesStr + '+'
+			log.debug("Sending %d of %s matches to '%s'...", len(sendList), numMatchesStr, self.client.user_name)
+			self.sendStream(sendList, 'SearchResp#' + numMatchesStr + '#' + str(offset), \
+					'BeginSearchResp', 'SearchRespRcvd', 'EndSearchResp')
+
+		# Admin request for the server's metrics, in the format:
+		# '#StatsReq'
+		# answered with: '#StatsResp#[metrics, in the Prometheus text format]'
+		elif (msg_components[1] == 'StatsReq'):
+			log.debug("%s requested the server's metrics.", self.client.user_name)
+			self.client.sock.send('#StatsResp#' + serverMetrics.formatPrometheus())
+
+		# Late acknowledgement of a stream that has already been sent in full (the client
+		# acknowledges items as they arrive, so may still be acking it) - nothing to do
+		elif (msg_components[1].endswith('Rcvd')):
+			log.debug("Late stream acknowledgement from '%s': %r", self.client.user_name, data)
 
-			else:
-				# Unknown type of message
-				reply_msg = "Invalid message: ", data
-			
-			print ""	# formatting
-
-		# Close the socket
-		self.client.sock.close()
-
+		else:
+			# Unknown type of message
+			log.warning("Invalid message from '%s': %r", self.client.user_name, data)
 
-	# Send a single post to the client
+	# Queue a single post to be pushed to the client, in the format:
+	# '#NewSinglePost#[seq]' + postDataStr
 	# postDataStr: postInfoStr...'|postContentStr...
 	# postInfoStr: '#PostInfo#[postID]#[sender]#[bookname]#[page]#[line]'
 	# postContentStr: '#PostContent#[postID]#[post content]'
-	def pushPost(self, postDataStr):
-
-		self.client.sock.send("#NewSinglePost" + postDataStr, BUFFER_SIZE)
-		print "Pushed message to client '%s'" % self.client.user_name
+	def pushPost(self, postDataStr, seq):
+
+		# Another node replicating this one's posts (see 'ReplSyncReq')
+		if (self.replicaNode is not None):
+			postID = int(postDataStr.split('#', 3)[2])
+			if (serverDB.getPostOrigin(postID) != self.replicaNode):
+				self.pushQueue.put(formatReplPost(serverDB.getPostOriginSeq(postID), postDataStr))
+				self.onPushQueued()
+			return
+
+		self.pushQueue.put("#NewSinglePost#" + str(seq) + postDataStr)
+		self.onPushQueued()
+		log.debug("Queued message for client '%s'", self.client.user_name)
+
+	# Called after a message has been queued for pushing (in the pusher's thread)
+	def onPushQueued(self):
+		pass
+
+	# Answer the client's watch on a page (see PageWatchers), in the format:
+	# '#WatchPageResp#[bookname]#[pagenum]#[version]'
+	def pageChanged(self, bookname, pagenum, version):
+		self.pushQueue.put('#WatchPageResp#' + bookname + '#' + str(pagenum) + '#' + str(version))
+		self.onPushQueued()
 
 	# Relay a start chat request to this particular client
 	# Format: '#RelayStartChatReq#[AUsername]#[AIP]#[AFreeport]'
@@ -624,77 +2777,906 @@ class ClientThread(threading.Thread):
 	def relayStartChatReq(self, aUsername, aIP, aFreeport):
 		
 		# Send message to client requesting for a chat from client A
-		reqStr = '#RelayStartChatReq#' + aUsername + '#' + aIP + '#' + aFreeport
-		self.client.sock.send(reqStr)
+		self.client.sock.send(formatRelayStartChatReq(aUsername, aIP, aFreeport))
 
-	# Send back a response message, in the format:
-	# '#StartChatResp#Accept#[BUsername]#[BIP]#[BFreeport]#[AFreeport]
-	#   or
-	# '#StartChatResp#Reject#[BUsername]
+	# Send back a response message (see 'formatStartChatResp')
 	# Args: True, bUsername, bIP, bFreeport, aFreeport
 	#   or: False, bUsername
 	# NOTE: bIP, bFreeport, and aFreeport are STRINGS
 	def startChat(self, *args):
+		self.client.sock.send(formatStartChatResp(*args))
 
-		# Rejected - send appropriate string
-		if (args[0] == False):
-			respStr = '#StartChatResp#Reject#' + args[1]	# bUsername
-			self.client.sock.send(respStr)
+	# Tell the client whether its upload succeeded, in the format:
+	# '#UploadPostResp#Success'  or  '#UploadPostResp#Error#[error msg]'
+	def uploadDone(self, resp, result):
+		if (resp == serverDB.OP_FAILURE):
+			self.client.sock.send("#UploadPostResp#Error#" + result)
+		else:
+			self.client.sock.send('#UploadPostResp#Success')
 
-		# This client (B) accepted client A's chat invitation
-		elif (args[0] == True):
-			
-			bUsername = args[1]
-			bIP = args[2]
-			bFreeport = args[3]
-			aFreeport = args[4]
+	# Send a stream of data to client, while controlling when the server
+	# should continue sending (see StreamSender)
+	def sendStream(self, listToSend, startMsg, startAckPhrase, ackPhrase, endMsg, window=None):
+		serverMetrics.observeStream(startMsg.split('#')[0], len(listToSend))
+		self.numStreams = self.numStreams + 1
+		self.runStream(StreamSender(listToSend, startMsg, startAckPhrase, ackPhrase, endMsg, window, self.numStreams))
 
-			# Construct and send the appropriate chat response string
-			respStr = '#StartChatResp#Accept#' + bUsername + '#' + \
-					bIP + '#' + bFreeport + '#' + aFreeport
+# This is the thread that is executed when a server serves a single client
+class ClientThread(ClientHandler, threading.Thread):
 
-			self.client.sock.send(respStr)
-			
+	# Constructor
+	def __init__(self, clientsocket, addr):
+		threading.Thread.__init__(self)
 
-	# Send a stream of data to client, while controlling when the server
-	# should continue sending
-	# Note: Tacks on a '#' to all parameter messages to adhere to message formatting
-	def sendStream(self, listToSend, startMsg, startAckPhrase, ackPhrase, endMsg):
-
-		# Send start message
-		self.client.sock.send('#' + startMsg)
-
-		# Confirm client is ready for stream receipt
-		self.listenFor(startAckPhrase)
-
-		# Ack received. Start sending stream
-		for listItem in listToSend:
-			self.client.sock.send(listItem)
-			self.listenFor(ackPhrase)
-
-		# Send end message to indicate (to client) end of stream
-		self.client.sock.send('#' + endMsg)
-
-	# Wait for a particular message from the socket before terminating
-	# NOTE: Tacks on a '#' to adhere to format rules
-	def listenFor(self, listenMsg):
-		msg = self.selectRecv(BUFFER_SIZE)		
-		while (msg != ('#' + listenMsg)):
-			msg = self.selectRecv(BUFFER_SIZE)
-			
+		# Exchange whole messages with the client through a framed socket
+		ClientHandler.__init__(self, FramedSocket(clientsocket), addr)
 
-	# Use 'select' module to obtain data from buffer
-	def selectRecv(self, bufferSize):
-		read_sockets, write_sockets, error_sockets = select.select(self.listen_sockets, [], [])
-		for rs in read_sockets:
-			if (rs == self.client.sock):
-				data = self.client.sock.recv(bufferSize)
-				return data			
+	# Execute thread
+	# The connection is closed however serving the client ends (eg. a socket error)
+	def run(self):
+		ClientWriter(self.client.sock, self.pushQueue).start()
+		try:
+			self.serve_client()
+		finally:
+			self.stop()
+			self.pushQueue.close()
+			self.client.sock.close()
+			serverMetrics.connectionClosed(self.client.sock)
+			log.info("Closing connection with %s", self.client.addr)
+
+	# Serve the client
+	def serve_client(self):
+
+		while not self.client_stop:
+			msg = self.nextMsg()
+			self.guardMessage(msg)
+
+	# Handle a message (see ClientHandler) - one that cannot be handled (eg. a malformed
+	# request) closes just this client's connection, rather than silently ending the thread
+	def guardMessage(self, msg):
+		try:
+			self.handleMessage(msg)
+		except Exception:
+			log.error("Could not handle a message from %s: %r - closing the connection.\n%s", \
+					self.client.addr, msg, traceback.format_exc().rstrip())
+			self.deferredMsgs.clear()
+			self.stop()
+
+	# Stop serving the client, and remove it from the clients (unless already done)
+	def stop(self):
+		if (not self.client_stop):
+			self.client_stop = True
+			clientThreadIterator.removeClientThread(self)
+			pageWatchers.cancel(self)
+
+	# Send a stream, blocking until the client has acknowledged all of it
+	# Other messages received meanwhile are handled once the stream is complete
+	def runStream(self, stream):
+		self.client.sock.sendRaw(stream.start())
+		while not stream.done:
+			msg = self.recvMsg()
+			if (msg == ''):
+				self.deferredMsgs.append(msg)
+				return
+			if (stream.accepts(msg)):
+				self.client.sock.sendRaw(stream.receive(msg))
+			else:
+				self.deferredMsgs.append(msg)
+
+	# Insert a post through the bus, blocking until the bus hub has answered
+	def insertThroughBus(self, postInfoStr, postContentStr):
+		inserted = threading.Event()
+		results = []
+		def onInserted(resp, result):
+			results.append((resp, result))
+			inserted.set()
+		busClient.insertPost(postInfoStr, postContentStr, onInserted)
+		inserted.wait()
+		self.uploadDone(*results[0])
+
+	# Obtain the next message to handle, beginning with the deferred ones
+	def nextMsg(self):
+		if (len(self.deferredMsgs) > 0):
+			return self.deferredMsgs.popleft()
+		return self.recvMsg()
+
+	# Obtain the next whole message from the client
+	# Returns an empty string if the client has closed the connection
+	def recvMsg(self):
+		return self.client.sock.recv()
+
+# This class serves a single client on the server's event loop (see EventServer)
+# Messages are handed to it as they arrive, and sends are buffered by a
+# non-blocking framed socket, so serving a client never blocks the loop
+class EventClient(ClientHandler):
+
+	# Constructor given an accepted socket, its address, and a callback for
+	# when the socket has output waiting to be written
+	def __init__(self, clientsocket, addr, onPendingOutput):
+		ClientHandler.__init__(self, NonBlockingFramedSocket(clientsocket, onPendingOutput), addr)
+
+		# Stream currently being sent to the client (if any)
+		self.stream = None
+
+		# Whether an upload is waiting on the bus hub (see 'insertThroughBus')
+		self.awaitingBus = False
+
+		self.onPendingOutput = onPendingOutput
+
+	# Have the event loop write out the queued pushes
+	def onPushQueued(self):
+		self.onPendingOutput(self.client.sock)
+
+	# Read all the messages available from the socket, and handle them
+	def onReadable(self):
+		for msg in self.client.sock.recvAvailable():
+			self.onMessage(msg)
+		if (self.client.sock.closed):
+			self.onClosed()
+
+	# The connection has been closed - abandon any stream, and stop serving the client
+	def onClosed(self):
+		self.pushQueue.close()
+		if (not self.client_stop):
+			self.stream = None
+			self.handleMessage('')
+
+	# Handle a message, unless it belongs to the stream currently being sent
+	def onMessage(self, msg):
+		if (self.client_stop):
+			return
+
+		# No response in progress
+		if (not self.isResponding()):
+			self.handleMessage(msg)
+			return
+
+		# Stream in progress - continue it, or defer the message until the response has ended
+		try:
+			streamFrames = None
+			if (msg != '' and self.stream is not None and self.stream.accepts(msg)):
+				streamFrames = self.stream.receive(msg)
+		except Exception:
+			self.abandon(msg)
+			return
+
+		if (streamFrames is not None):
+			self.client.sock.sendRaw(streamFrames)
+			if (self.stream.done):
+				self.stream = None
+				self.requestDone()
+				self.handleDeferred()
+		else:
+			self.deferredMsgs.append(msg)
+
+	# Handle a message (see ClientHandler) - one that cannot be handled (eg. a malformed
+	# request) drops just this client, rather than the loop serving every client
+	def handleMessage(self, msg):
+		try:
+			ClientHandler.handleMessage(self, msg)
+		except Exception:
+			self.abandon(msg)
+
+	# Stop serving the client after a message from it could not be handled
+	# (the server closes the connection once it next writes out the client's output)
+	def abandon(self, msg):
+		log.error("Could not handle a message from %s: %r - closing the connection.\n%s", \
+				self.client.addr, msg, traceback.format_exc().rstrip())
+		self.stream = None
+		self.awaitingBus = False
+		self.deferredMsgs.clear()
+		if (not self.client_stop):
+			self.client_stop = True
+			clientThreadIterator.removeClientThread(self)
+			pageWatchers.cancel(self)
+		self.onPendingOutput(self.client.sock)
+
+	# Handle the messages deferred during a response, until another response is in progress
+	def handleDeferred(self):
+		while (len(self.deferredMsgs) > 0 and not self.isResponding() and not self.client_stop):
+			self.handleMessage(self.deferredMsgs.popleft())
+
+	# Returns whether a stream is still being sent to the client, or an upload waited on
+	def isResponding(self):
+		return (self.stream is not None or self.awaitingBus)
+
+	# Insert a post through the bus - the client's later messages are deferred until
+	# the bus hub has answered
+	def insertThroughBus(self, postInfoStr, postContentStr):
+		self.awaitingBus = True
+		busClient.insertPost(postInfoStr, postContentStr, self.onInsertedThroughBus)
+
+	# The bus hub has answered an upload
+	def onInsertedThroughBus(self, resp, result):
+		self.awaitingBus = False
+		if (self.client_stop):
+			return
+		self.uploadDone(resp, result)
+		self.requestDone()
+		self.handleDeferred()
+
+	# Begin sending a stream - it continues as the client's acks arrive
+	def runStream(self, stream):
+		self.client.sock.sendRaw(stream.start())
+		if (not stream.done):
+			self.stream = stream
+
+# This class runs a single event loop that serves every client
+# Uses 'poll' to wait on the server socket and all client sockets at once
+class EventServer(object):
+
+	# Constructor given the (bound and listening) server socket
+	def __init__(self, serversock):
+		self.serversock = serversock
+		self.serversock.setblocking(0)
+
+		self.clients = {}		# file descriptor -> EventClient
+		self.pendingOutput = set()	# clients with output waiting to be written
+		self.writeInterest = set()	# clients registered for POLLOUT
+
+		self.poller = select.poll()
+		self.poller.register(self.serversock.fileno(), select.POLLIN)
+
+		# Posts and chat requests from the other workers arrive on the bus
+		if (busClient is not None):
+			self.poller.register(busClient.fileno(), select.POLLIN)
+
+	# Run the event loop forever
+	def run(self):
+		while True:
+			try:
+				# Do not block while there is output to write, nor past the next watch deadline
+				if (len(self.pendingOutput) > 0):
+					events = self.poller.poll(0)
+				else:
+					timeout = pageWatchers.nextTimeout()
+					if (timeout is None):
+						events = self.poller.poll()
+					else:
+						events = self.poller.poll(int(timeout * 1000) + 1)
+			except select.error, e:
+				if (e.args[0] == errno.EINTR):
+					continue
+				raise
+
+			# Answer the watches that have timed out
+			pageWatchers.expire()
+
+			for fd, event in events:
+				# Incoming connection request to server socket
+				if (fd == self.serversock.fileno()):
+					self.acceptClients()
+					continue
+
+				# Messages from the bus
+				if (busClient is not None and fd == busClient.fileno()):
+					busClient.onReadable()
+					continue
+
+				client = self.clients.get(fd)
+				if (client is None):
+					continue
+				if (event & (select.POLLIN | select.POLLHUP | select.POLLERR)):
+					client.onReadable()
+				if (event & select.POLLOUT):
+					self.pendingOutput.add(client)
+				if (client.client_stop):
+					self.closeClient(client)
+
+			self.flushOutput()
+
+	# Accept every pending connection request
+	def acceptClients(self):
+		while True:
+			try:
+				clientsocket, addr = self.serversock.accept()
+			except socket.error, e:
+				if (e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)):
+					return
+				raise
+
+			# Create the client, and add it to the list of clients
+			client = EventClient(clientsocket, addr, self.onPendingOutput)
+			serverMetrics.connectionOpened()
+			fd = client.client.sock.fileno()
+			self.clients[fd] = client
+			self.poller.register(fd, select.POLLIN)
+			clientThreadIterator.addClientThread(client)
+
+	# Note that a client's socket has output waiting to be written
+	def onPendingOutput(self, clientSock):
+		client = self.clients.get(clientSock.fileno())
+		if (client is not None):
+			self.pendingOutput.add(client)
+
+	# Write as much pending output as possible, and wait for the sockets that
+	# could not take all of it to become writable
+	def flushOutput(self):
+		pending = self.pendingOutput
+		self.pendingOutput = set()
+		for client in pending:
+			if (client.client.sock.closed):
+				continue
+			if (client.client_stop):
+				self.closeClient(client)
+				continue
+			flushed = client.client.sock.flush()
+
+			# Socket has caught up - hand it the pushes queued meanwhile
+			if (flushed and client.pushQueue.hasPending()):
+				client.client.sock.sendMany(client.pushQueue.popAll())
+				flushed = client.client.sock.flush()
+
+			if (client.client.sock.closed):
+				client.onClosed()
+				self.closeClient(client)
+			elif (flushed and client in self.writeInterest):
+				self.writeInterest.discard(client)
+				self.poller.modify(client.client.sock.fileno(), select.POLLIN)
+			elif (not flushed and client not in self.writeInterest):
+				self.writeInterest.add(client)
+				self.poller.modify(client.client.sock.fileno(), select.POLLIN | select.POLLOUT)
+
+	# Stop serving a client and close its socket
+	def closeClient(self, client):
+		fd = client.client.sock.fileno()
+		if (self.clients.get(fd) is not client):
+			return
+		del self.clients[fd]
+		self.poller.unregister(fd)
+		self.writeInterest.discard(client)
+		self.pendingOutput.discard(client)
+		client.client.sock.flush()
+		client.client.sock.close()
+		serverMetrics.connectionClosed(client.client.sock)
+		log.info("Closing connection with %s", client.client.addr)
+
+# This class connects a worker process of a multi-process server to the bus hub (see BusHub)
+# Worker -> hub messages:
+#   '#BusInsert#[token]' + postInfoStr + '|' + postContentStr	insert a post uploaded to this worker
+#   '#BusJoin#[username]'	/  '#BusLeave#[username]'		a client has introduced itself / left
+#   '#BusRelay#[username]#[reply username]#[msg]'		send a message to a client on any worker
+# Hub -> worker messages:
+#   '#BusPost#[worker]#[token]' + postDataStr			a post has been inserted (sent to every worker;
+#								worker -1 for a post replicated from another node)
+#   '#BusInsertError#[token]#[error msg]'			a post could not be inserted
+#   '#BusRelay#[username]#[msg]'				send a message to a client on this worker
+# NOTE: Sends are serialised by the framed socket, so any thread may use the bus
+class BusClient(object):
+
+	# Constructor given the worker's end of the bus, and the worker's index
+	def __init__(self, busSock, workerIndex):
+		self.sock = FramedSocket(busSock)
+		self.workerIndex = workerIndex
+
+		# Uploads waiting on the hub: { token: function called with (resp, result) }
+		self.pendingInserts = {}
+		self.nextToken = 0
+		self.lock = threading.Lock()
+
+	# Allows the bus to be given to 'poll'
+	def fileno(self):
+		return self.sock.fileno()
+
+	# Have the hub insert a post (given the strings given to 'ServerDB.insertPost'), then
+	# call 'onInserted(resp, result)' like the result of 'insertPost', once the post has
+	# been added to this worker's database
+	# NOTE: 'onInserted' is called by whichever thread handles the bus
+	def insertPost(self, postInfoStr, postContentStr, onInserted):
+		self.lock.acquire()
+		try:
+			self.nextToken = self.nextToken + 1
+			token = self.nextToken
+			self.pendingInserts[token] = onInserted
+		finally:
+			self.lock.release()
+		self.sock.send('#BusInsert#' + str(token) + postInfoStr + '|' + postContentStr)
+
+	# A client has introduced itself to this worker
+	def userJoined(self, username):
+		self.sock.send('#BusJoin#' + username)
+
+	# A client has left this worker
+	def userLeft(self, username):
+		self.sock.send('#BusLeave#' + username)
+
+	# Send a message to a client, on whichever worker serves it
+	# If no worker does, and 'replyUsername' is given, that client is told the user does not exist
+	def relay(self, username, msg, replyUsername=''):
+		self.sock.send('#BusRelay#' + username + '#' + replyUsername + '#' + msg)
+
+	# Handle the messages that have arrived (for the event engine, once the bus is readable)
+	def onReadable(self):
+		self.guardMessage(self.sock.recv())
+		while (self.sock.hasFrames()):
+			self.guardMessage(self.sock.recv())
+
+	# Bus thread (for the threaded engine) - handle the messages as they arrive
+	def run(self):
+		while True:
+			self.guardMessage(self.sock.recv())
+
+	# Handle a message from the hub - one that cannot be handled is logged and dropped,
+	# rather than stopping the worker (and every client on it)
+	def guardMessage(self, msg):
+		try:
+			self.handleMessage(msg)
+		except Exception:
+			log.error("Could not handle a message from the bus hub: %r\n%s", msg, traceback.format_exc().rstrip())
+
+	# Handle a single message from the hub
+	def handleMessage(self, msg):
+
+		# The hub has gone (the server is shutting down) - the worker cannot carry on alone
+		if (msg == ''):
+			log.error("Lost the connection to the bus hub. Worker %d exiting...", self.workerIndex)
+			log.close()
+			os._exit(1)
+
+		msgType = msg.split('#', 2)[1]
+
+		# A post has been inserted - add it to the database, and publish it to this worker's clients
+		if (msgType == 'BusPost'):
+			_, _, workerIndex, token, postDataStr = msg.split('#', 4)
+			postID = serverDB.applyPost('#' + postDataStr)
+			publishPost(postID)
+			if (int(workerIndex) == self.workerIndex):
+				self.answerInsert(int(token), serverDB.OP_SUCCESS, postID)
+
+		# A post uploaded to this worker could not be inserted
+		elif (msgType == 'BusInsertError'):
+			_, _, token, errorStr = msg.split('#', 3)
+			self.answerInsert(int(token), serverDB.OP_FAILURE, errorStr)
+
+		# Message for one of this worker's clients (eg. a chat request)
+		elif (msgType == 'BusRelay'):
+			_, _, username, clientMsg = msg.split('#', 3)
+			thread = clientThreadIterator.getClientThread(username)
+			if (thread is not None):
+				thread.client.sock.send(clientMsg)
+
+	# Answer the upload waiting on the hub under a token (an unknown token - eg. one already
+	# answered - is logged and ignored)
+	def answerInsert(self, token, resp, result):
+		self.lock.acquire()
+		try:
+			onInserted = self.pendingInserts.pop(token, None)
+		finally:
+			self.lock.release()
+		if (onInserted is None):
+			log.warning("Answer from the bus hub for an unknown upload (token %d) - ignored.", token)
+			return
+		onInserted(resp, result)
+
+# This class is the hub of a multi-process server, run by the main process
+# It forks the worker processes, which all accept clients from the same listening socket,
+# each starting with a copy of the database (made by the fork). The hub then:
+#  - inserts the posts uploaded to every worker, so posts are given ID's and logged in one
+#    place, and sends each one to every worker in the order inserted. So every worker holds
+#    the posts in the same order, under the same sequence numbers (see ServerDB.getPostsSince),
+#    and a push client may sync from any worker.
+#  - keeps track of the worker serving each user, to relay chat requests between workers
+#  - replaces a worker that dies, forking it afresh (with the database as it is then)
+# See BusClient for the messages on the bus
+class BusHub(object):
+
+	# Constants
+	RESTART_DELAY = 1.0		# seconds before replacing a worker that has died
+
+	# Constructor given the number of workers, and the function each worker process runs
+	# (given the worker's index and its end of the bus)
+	def __init__(self, numWorkers, runWorkerFunc):
+		self.numWorkers = numWorkers
+		self.runWorkerFunc = runWorkerFunc
+		self.loop = EventLoop()
+
+		self.workers = {}		# worker index -> (pid, NonBlockingFramedSocket)
+		self.users = {}			# username -> index of the worker serving them
+
+	# Start the workers, and run the hub until interrupted
+	def run(self):
+		for workerIndex in range(self.numWorkers):
+			self.startWorker(workerIndex)
+		self.loop.run()
+
+	# Stop the workers
+	def stop(self):
+		self.loop.stop()
+		for pid, sock in self.workers.values():
+			try:
+				os.kill(pid, signal.SIGTERM)
+				os.waitpid(pid, 0)
+			except OSError:
+				pass
+			sock.close()
+		self.workers = {}
+
+	# Fork a worker process, joined to the hub by a pair of connected sockets
+	def startWorker(self, workerIndex):
+		hubSock, workerSock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+		sys.stdout.flush()		# or the worker would write out this process's buffered output again
+		pid = os.fork()
+
+		# Worker process - serve clients until the server stops (never returns)
+		if (pid == 0):
+			hubSock.close()
+			for _, sock in self.workers.values():
+				sock.sock.close()
+			try:
+				self.runWorkerFunc(workerIndex, workerSock)
+			except KeyboardInterrupt:
+				os._exit(0)
+			except:
+				traceback.print_exc()
+				os._exit(1)
+			os._exit(0)
+
+		workerSock.close()
+		sock = NonBlockingFramedSocket(hubSock, self.onPendingOutput)
+		self.workers[workerIndex] = (pid, sock)
+		self.loop.addReader(sock, lambda: self.onReadable(workerIndex))
+		log.info("Started worker %d (pid %d).", workerIndex, pid)
+
+	# Output is waiting for a worker - write it once its socket is writable
+	def onPendingOutput(self, sock):
+		self.loop.addWriter(sock, lambda: self.onWritable(sock))
+
+	# Write out the pending output for a worker
+	def onWritable(self, sock):
+		if (sock.flush() or sock.closed):
+			self.loop.removeWriter(sock)
+
+	# Handle every whole message received from a worker
+	def onReadable(self, workerIndex):
+		pid, sock = self.workers[workerIndex]
+		for msg in sock.recvAvailable():
+			self.guardMessage(workerIndex, msg)
+		if (sock.closed):
+			self.onWorkerExited(workerIndex)
+
+	# Handle a message from a worker - one that cannot be handled is logged and dropped (and an
+	# upload turned down), rather than stopping the hub, and with it every worker
+	def guardMessage(self, workerIndex, msg):
+		try:
+			self.handleMessage(workerIndex, msg)
+		except Exception:
+			log.error("Could not handle a message from worker %d: %r\n%s", \
+					workerIndex, msg, traceback.format_exc().rstrip())
+			if (msg.startswith('#BusInsert#')):
+				token = msg.split('#', 3)[2]
+				self.send(workerIndex, '#BusInsertError#' + token + '#Post could not be inserted.')
+
+	# A worker has closed its end of the bus (it has died) - replace it
+	def onWorkerExited(self, workerIndex):
+		pid, sock = self.workers.pop(workerIndex)
+		self.loop.removeReader(sock)
+		self.loop.removeWriter(sock)
+		sock.close()
+		_, status = os.waitpid(pid, 0)
+		if (os.WIFSIGNALED(status)):
+			log.warning("Worker %d (pid %d) was killed by signal %d. Restarting it...", workerIndex, pid, os.WTERMSIG(status))
+		else:
+			log.warning("Worker %d (pid %d) exited with status %d. Restarting it...", workerIndex, pid, os.WEXITSTATUS(status))
+
+		for username, userWorker in self.users.items():
+			if (userWorker == workerIndex):
+				del self.users[username]
+		self.loop.callLater(self.RESTART_DELAY, self.startWorker, workerIndex)
+
+	# Insert a post replicated from another node (see Replicator), and send it to every worker
+	# A post that cannot be inserted is logged and dropped, rather than stopping the hub
+	def insertReplicatedPost(self, postDataStr):
+		try:
+			inserted = serverDB.insertReplicatedPost(postDataStr)
+		except Exception:
+			log.error("Could not insert a replicated post: %r\n%s", postDataStr, traceback.format_exc().rstrip())
+			return
+		if (inserted):
+			self.sendPost(postDataStr, -1, '0')
+
+	# Send a post that has been inserted to every worker, on behalf of the worker that
+	# uploaded it (and the upload's token), if any
+	def sendPost(self, postDataStr, workerIndex, token):
+		postMsg = '#BusPost#' + str(workerIndex) + '#' + token + postDataStr
+		for _, sock in self.workers.values():
+			sock.send(postMsg)
+
+	# Send a message to a worker
+	def send(self, workerIndex, msg):
+		worker = self.workers.get(workerIndex)
+		if (worker is not None):
+			worker[1].send(msg)
+
+	# Handle a single message from a worker
+	def handleMessage(self, workerIndex, msg):
+		msgType = msg.split('#', 2)[1]
+
+		# Insert an uploaded post, and send it to every worker (or the error to the uploader)
+		if (msgType == 'BusInsert'):
+			_, _, token, postDataStr = msg.split('#', 3)
+			postInfoStr, postContentStr = ('#' + postDataStr).split('|', 1)
+			resp, result = serverDB.insertPost(postInfoStr, postContentStr)
+			if (resp == serverDB.OP_FAILURE):
+				self.send(workerIndex, '#BusInsertError#' + token + '#' + result)
+				return
+			self.sendPost(serverDB.getPostAsStr(result)[1], workerIndex, token)
+
+		elif (msgType == 'BusJoin'):
+			self.users[msg.split('#', 2)[2]] = workerIndex
+
+		elif (msgType == 'BusLeave'):
+			username = msg.split('#', 2)[2]
+			if (self.users.get(username) == workerIndex):
+				del self.users[username]
+
+		# Relay a message to the worker serving a user - a user that is not connected
+		# can only be the target of a chat request (see 'StartChatReq')
+		elif (msgType == 'BusRelay'):
+			_, _, username, replyUsername, clientMsg = msg.split('#', 4)
+			targetIndex = self.users.get(username)
+			if (targetIndex is not None):
+				self.send(targetIndex, '#BusRelay#' + username + '#' + clientMsg)
+			elif (replyUsername != ''):
+				self.send(workerIndex, '#BusRelay#' + replyUsername + '#' + '#StartChatResp#Error#User does not exists.')
+
+# This class replicates the posts of other server instances (nodes) to this one, on the
+# event loop of the bus hub (see BusHub), which inserts them
+# Each node gives its posts ID's from a range of its own (see ServerDB), and a post's origin
+# sequence number is its position among the posts of its origin node. Every node adds the
+# posts of each origin in that order, so the number of posts it has from each origin tells
+# exactly which posts it is missing.
+# A link to each peer connects to it as a client, sends it those numbers (see 'ReplSyncReq'
+# in ClientHandler), and receives the missing posts, then each post the peer inserts or
+# replicates from then on. As posts from every origin are passed on, the nodes need not
+# all be linked to each other. A post arriving ahead of the posts before it from its origin
+# (eg. one inserted while a peer was sending the missing ones) waits for them.
+# When a link drops (eg. the peer is partitioned away or restarts), it reconnects, and
+# catches up on just the posts inserted meanwhile.
+# Node ID's are exchanged when a link connects, and a peer with the ID of this node or of
+# another peer is not replicated from (nor retried).
+class Replicator(object):
+
+	# Constructor given the event loop, the ID of this node, the (host, port) of each peer,
+	# and the function that inserts a replicated post (given a string in the format given
+	# by 'ServerDB.getPostAsStr')
+	def __init__(self, loop, nodeID, peerAddrs, insertFunc):
+		self.nodeID = nodeID
+		self.insertFunc = insertFunc
+		self.links = [ ReplicationLink(loop, peerAddr, self) for peerAddr in peerAddrs ]
+
+		# Posts waiting for the posts before them: { origin node ID: { origin seq: postDataStr } }
+		self.waiting = {}
+
+	# Connect to the peers
+	def start(self):
+		for link in self.links:
+			link.connect()
+
+	# Return the request for the posts this node is missing (see 'ReplSyncReq')
+	def formatSyncReq(self):
+		originCounts = serverDB.getOriginCounts()
+		return '#ReplSyncReq#' + str(self.nodeID) + '#' + \
+			','.join([ '%d:%d' % (origin, count) for origin, count in sorted(originCounts.items()) ])
+
+	# Return the link to the peer with the given node ID, or None if not linked to it (yet)
+	def findLink(self, peerNode):
+		for link in self.links:
+			if (link.peerNode == peerNode):
+				return link
+		return None
+
+	# A post has arrived from a peer - insert it (and any waiting for it) unless already present
+	def onReplPost(self, originSeq, postDataStr):
+		origin = serverDB.getPostOrigin(int(postDataStr.split('#', 3)[2]))
+		if (origin == self.nodeID):
+			return
+		numPosts = serverDB.getOriginCounts().get(origin, 0)
+		if (originSeq <= numPosts):
+			return
+
+		waiting = self.waiting.setdefault(origin, {})
+		waiting[originSeq] = postDataStr
+		while (numPosts + 1 in waiting):
+			numPosts = numPosts + 1
+			self.insertFunc(waiting.pop(numPosts))
+		if (len(waiting) == 0):
+			del self.waiting[origin]
+
+# This class is a link to a single peer (see Replicator), driven by an event loop
+# Messages received (see 'ReplSyncReq' in ClientHandler):
+#   '#ReplSyncResp#[peer's ID]#[number of posts]'	the posts this node is missing follow
+#   '#ReplSyncRefused#[reason]'		the peer has this node's ID
+#   '#ReplPost#[origin seq]' + postDataStr	a post
+#   '#EndReplSyncResp'			this node has caught up - new posts follow as inserted
+class ReplicationLink(object):
+
+	# Constants
+	MIN_RETRY_DELAY = 0.5		# seconds before reconnecting, doubling on each failure
+	MAX_RETRY_DELAY = 10.0
+
+	# Constructor given the event loop, the peer's (host, port), and the Replicator
+	def __init__(self, loop, peerAddr, replicator):
+		self.loop = loop
+		self.peerAddr = peerAddr
+		self.replicator = replicator
+		self.peerName = '%s:%d' % peerAddr
+
+		self.rawSock = None		# socket, while connecting
+		self.sock = None		# NonBlockingFramedSocket, once connected
+		self.retryDelay = self.MIN_RETRY_DELAY
+		self.peerNode = None		# the peer's node ID, once it has answered
+
+	# Start connecting to the peer (without blocking)
+	def connect(self):
+		self.rawSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.rawSock.setblocking(0)
+		error = self.rawSock.connect_ex(self.peerAddr)
+		if (error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK)):
+			self.onConnectFailed(error)
+			return
+		self.loop.addWriter(self.rawSock, self.onConnected)
+
+	# The connection attempt has finished - ask the peer for the posts this node is missing
+	def onConnected(self):
+		self.loop.removeWriter(self.rawSock)
+		error = self.rawSock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+		if (error != 0):
+			self.onConnectFailed(error)
+			return
+
+		self.sock = NonBlockingFramedSocket(self.rawSock, self.onPendingOutput)
+		self.rawSock = None
+		self.loop.addReader(self.sock, self.onReadable)
+		self.sock.send(self.replicator.formatSyncReq())
+		self.retryDelay = self.MIN_RETRY_DELAY
+
+	# Could not connect - try again later
+	def onConnectFailed(self, error):
+		log.debug("Could not connect to peer %s: %s", self.peerName, os.strerror(error))
+		self.rawSock.close()
+		self.rawSock = None
+		self.retry()
+
+	# Output is waiting - write it once the socket is writable
+	def onPendingOutput(self, sock):
+		self.loop.addWriter(sock, self.onWritable)
+
+	# Write out the pending output
+	def onWritable(self):
+		if (self.sock.flush() or self.sock.closed):
+			self.loop.removeWriter(self.sock)
+
+	# Handle every whole message received from the peer
+	# A message that cannot be handled drops the link (it reconnects, and catches up afresh)
+	def onReadable(self):
+		failed = False
+		for msg in self.sock.recvAvailable():
+			try:
+				self.handleMessage(msg)
+			except Exception:
+				log.error("Could not handle a message from peer %s: %r\n%s", \
+						self.peerName, msg, traceback.format_exc().rstrip())
+				failed = True
+				break
+			if (self.sock is None):
+				return
+
+		# Lost the peer - reconnect, and catch up from where this node is then
+		if (failed or self.sock.closed):
+			log.warning("Lost the link to peer %s. Reconnecting...", self.peerName)
+			self.loop.removeReader(self.sock)
+			self.loop.removeWriter(self.sock)
+			self.sock.close()
+			self.sock = None
+			self.retry()
+
+	# Handle a single message from the peer
+	def handleMessage(self, msg):
+		msgComponents = msg.split('#', 3)
+		if (msgComponents[1] == 'ReplPost'):
+			self.replicator.onReplPost(int(msgComponents[2]), '#' + msgComponents[3])
+		elif (msgComponents[1] == 'ReplSyncResp'):
+			peerNode = int(msgComponents[2])
+			otherLink = self.replicator.findLink(peerNode)
+			if (peerNode == self.replicator.nodeID):
+				self.stop("it has this node's ID (%d)" % peerNode)
+			elif (otherLink is not None and otherLink is not self):
+				self.stop("it has the same node ID (%d) as peer %s" % (peerNode, otherLink.peerName))
+			else:
+				self.peerNode = peerNode
+				log.info("Replicating from peer %s (node %d): catching up on %s posts...", \
+						self.peerName, peerNode, msgComponents[3])
+		elif (msgComponents[1] == 'ReplSyncRefused'):
+			self.stop(msgComponents[2])
+		elif (msgComponents[1] == 'EndReplSyncResp'):
+			log.info("Caught up with peer %s.", self.peerName)
+
+	# Stop replicating from the peer for good (eg. it has the same node ID as this one)
+	def stop(self, reason):
+		log.error("Not replicating from peer %s: %s", self.peerName, reason)
+		self.loop.removeReader(self.sock)
+		self.loop.removeWriter(self.sock)
+		self.sock.close()
+		self.sock = None
+
+	# Reconnect after a delay (backing off while the peer cannot be reached)
+	def retry(self):
+		self.loop.callLater(self.retryDelay, self.connect)
+		self.retryDelay = min(self.retryDelay * 2, self.MAX_RETRY_DELAY)
 
 # ----------------------------------------------------
 # FUNCTIONS
 # ----------------------------------------------------
 
+# Append a single metric (with its help and type) to a list of lines in the Prometheus text format
+def formatMetric(lines, name, metricType, helpStr, value):
+	lines.append('# HELP %s %s' % (name, helpStr))
+	lines.append('# TYPE %s %s' % (name, metricType))
+	lines.append('%s %s' % (name, formatValue(value)))
+
+# Append the series of a histogram (with the given labels) to a list of lines in the Prometheus text format
+def formatHistogram(lines, name, labels, histogram):
+	cumulative, count, total = histogram.getSnapshot()
+	labelPrefix = ''
+	if (labels != ''):
+		labelPrefix = labels + ','
+	for bound, bucketCount in zip(histogram.bounds, cumulative):
+		lines.append('%s_bucket{%sle="%s"} %d' % (name, labelPrefix, formatValue(bound), bucketCount))
+	lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labelPrefix, count))
+	if (labels != ''):
+		labels = '{' + labels + '}'
+	lines.append('%s_sum%s %s' % (name, labels, formatValue(total)))
+	lines.append('%s_count%s %d' % (name, labels, count))
+
+# Format a metric's value (ints as they are, floats without needless digits)
+def formatValue(value):
+	if (isinstance(value, float)):
+		return repr(round(value, 6))
+	return str(value)
+
+# Format a post for a node replicating this one (see Replicator), in the format:
+# '#ReplPost#[origin sequence number]' + postDataStr
+# postDataStr: in the format given by 'ServerDB.getPostAsStr'
+def formatReplPost(originSeq, postDataStr):
+	return '#ReplPost#' + str(originSeq) + postDataStr
+
+# Return the words of a text to index or search for it by (lower case, and without punctuation)
+def getSearchTerms(text):
+	return SEARCH_TERM_PATTERN.findall(text.lower())
+
+# Return the weight of a term found in 'numPostings' of 'numDocs' documents (BM25's IDF) -
+# the rarer, the higher
+def getIDF(numDocs, numPostings):
+	return math.log(1.0 + (numDocs - numPostings + 0.5) / (numPostings + 0.5))
+
+# Format a line of a book matching a search, in the format:
+# '#LineHit#[score]#[bookname]#[pagenum]#[linenum]#[line]'
+def formatLineHit(score, bookname, pagenum, linenum):
+	lineStr = books[bookname].getPageObj(pagenum).lines[linenum-1].getContent()
+	return '#LineHit#%.3f#%s#%d#%d#%s' % (score, bookname, pagenum, linenum, lineStr)
+
+# Format a post matching a search, in the format:
+# '#PostHit#[score]' + postDataStr
+def formatPostHit(score, postDataStr):
+	return '#PostHit#%.3f' % score + postDataStr
+
+# Format a chat request relayed to client B, in the format:
+# '#RelayStartChatReq#[AUsername]#[AIP]#[AFreeport]'
+def formatRelayStartChatReq(aUsername, aIP, aFreeport):
+	return '#RelayStartChatReq#' + aUsername + '#' + aIP + '#' + aFreeport
+
+# Format the response to client A's chat request, in the format:
+# '#StartChatResp#Accept#[BUsername]#[BIP]#[BFreeport]#[AFreeport]
+#   or
+# '#StartChatResp#Reject#[BUsername]
+# Args: True, bUsername, bIP, bFreeport, aFreeport
+#   or: False, bUsername
+def formatStartChatResp(*args):
+	if (args[0] == False):
+		return '#StartChatResp#Reject#' + args[1]
+	bUsername, bIP, bFreeport, aFreeport = args[1:5]
+	return '#StartChatResp#Accept#' + bUsername + '#' + bIP + '#' + bFreeport + '#' + aFreeport
+
 # Basic testing for database
 def runDBTests():
 
@@ -734,77 +3716,350 @@ def runBookTests():
 			print ""
 		print ""
 
+# Compare the memory used per post by the post store, against the dict of tuples
+# ServerDB used to keep: db = { postID: ((sender, bookname, page, line), content) }
+# Posts are made up (with a fixed seed) and parsed from strings as 'insertPost' does.
+# Usage: python -c "import server_ex; server_ex.runPostStoreComparison(1000000)"
+def runPostStoreComparison(numPosts, numSenders=1000, numBooks=20, contentLength=40):
+
+	rand = random.Random(0)
+	senders = [ 'reader%d' % i for i in range(numSenders) ]
+	booknames = [ 'book%d' % i for i in range(numBooks) ]
+
+	# Fill both layouts with the same posts
+	dictDB = {}
+	postStore = PostStore()
+	for i in xrange(numPosts):
+		postID = ServerDB.MIN_ID_VAL + i
+		postInfoString = '#NewPostInfo#%s#%s#%d#%d' % (rand.choice(senders), rand.choice(booknames), \
+						rand.randint(1, 50), rand.randint(1, 20))
+		postContentString = '#NewPostContent#' + ('%x' % rand.getrandbits(contentLength * 4)).zfill(contentLength)
+		postInfoComponents = postInfoString.split('#')
+		postInfo = (postInfoComponents[2], postInfoComponents[3], \
+				int(postInfoComponents[4]), int(postInfoComponents[5]))
+		postContent = postContentString.split('#')[2]
+		dictDB[postID] = (postInfo, postContent)
+		postStore.append(postID, postInfo[0], postInfo[1], postInfo[2], postInfo[3], postContent)
+
+	# Size every object in the dict layout once (small ints, for one, are shared)
+	seen = set()
+	def sizeOf(obj):
+		if (id(obj) in seen):
+			return 0
+		seen.add(id(obj))
+		return sys.getsizeof(obj)
+	dictBytes = sizeOf(dictDB)
+	for postID, (postInfo, postContent) in dictDB.iteritems():
+		dictBytes = dictBytes + sizeOf(postID) + sizeOf(postContent)
+		dictBytes = dictBytes + sizeOf(dictDB[postID]) + sizeOf(postInfo)
+		dictBytes = dictBytes + sum([ sizeOf(field) for field in postInfo ])
+	storeBytes = postStore.getSizeBytes()
+
+	print "Posts: %d (content %d bytes each)" % (numPosts, contentLength)
+	print "%-12s %14s %14s" % ('layout', 'total bytes', 'bytes/post')
+	print "%-12s %14d %14.1f" % ('dict', dictBytes, float(dictBytes) / numPosts)
+	print "%-12s %14d %14.1f" % ('post store', storeBytes, float(storeBytes) / numPosts)
+
+# Serve each client on its own thread
+def runThreadedServer(serversock):
+
+	# Time out the clients watching pages
+	expiryThread = threading.Thread(target=pageWatchers.runExpiry)
+	expiryThread.daemon = True
+	expiryThread.start()
+
+	# Handle the messages from the bus as they arrive
+	if (busClient is not None):
+		busThread = threading.Thread(target=busClient.run)
+		busThread.daemon = True
+		busThread.start()
+
+	# Prepare the server socket to listen for
+	listen_sockets = [serversock]
+	while True:
+
+		# Obtain lists of sockets that are listenable
+		read_sockets, write_sockets, error_sockets = select.select(listen_sockets, [], [])
+
+		# Find the socket for the server in the list of ready sockets	
+		for rs in read_sockets:
+		
+			# Incoming connection request to server socket
+			if (rs == serversock):
+				# Accept the client
+				clientsocket, addr = serversock.accept()
+
+				# Create the client thread
+				clientThread = ClientThread(clientsocket, addr)
+				serverMetrics.connectionOpened()
+
+				# Run the thread
+				clientThread.start()
+
+				# Add to list of client threads
+				clientThreadIterator.addClientThread(clientThread)
+
+# Serve every client from a single event loop
+def runEventServer(serversock):
+	EventServer(serversock).run()
+
+# Serve clients in a worker process of a multi-process server (see BusHub), with one of
+# the server engines. Each worker writes its own metrics file, numbered by its index.
+def runWorker(workerIndex, busSock, serversock, engine, metricsFile, metricsInterval, indexedBooks):
+	global busClient
+
+	# The hub allocates the post ID's and logs the posts - a worker only holds a copy of them
+	log.afterFork()
+	serverDB.postIndex.afterFork()
+	serverDB.postLog = None
+	serverDB.idAllocator.stateFile = None
+	busClient = BusClient(busSock, workerIndex)
+
+	if (metricsFile is not None):
+		metricsBase, metricsExt = os.path.splitext(metricsFile)
+		MetricsWriter('%s.%d%s' % (metricsBase, workerIndex, metricsExt), metricsInterval).start()
+
+	# Threads do not survive the fork, so each worker indexes the books itself
+	if (len(indexedBooks) > 0):
+		startIndexingBooks(indexedBooks)
+
+	SERVER_ENGINES[engine](serversock)
+
+# Index the lines of the given books for searching on a background thread, so clients are
+# served meanwhile - 'bookIndex' is set once the index is built
+def startIndexingBooks(booknames):
+	global bookIndexPending
+	bookIndexPending = True
+	indexer = threading.Thread(target=indexBooks, args=(booknames,))
+	indexer.daemon = True
+	indexer.start()
+
+# Index thread - build the index of the books, then make it available to searches
+def indexBooks(booknames):
+	global bookIndex, bookIndexPending
+	startTime = time.time()
+	newIndex = BookSearchIndex()
+	for bookname in booknames:
+		newIndex.addBook(books[bookname])
+	newIndex.freeze()
+	bookIndex = newIndex
+	bookIndexPending = False
+	log.info("Indexed %d lines (%d distinct words) in %.3fs.", \
+		len(newIndex), newIndex.index.getNumTerms(), time.time() - startTime)
+
+# Push a post that has just been inserted to the clients subscribing to it,
+# and wake the clients waiting for posts on its page
+def publishPost(postID):
+	resp, postSeq = serverDB.getPostSeq(postID)
+	if (resp != serverDB.OP_SUCCESS):
+		log.warning("Could not publish post %d: %s", postID, postSeq)
+		return
+	_, postDataStr = serverDB.getPostAsStr(postID)
+	_, bookname, pagenum, _ = serverDB.getPost(postID)[1][0]
+	clientThreadIterator.pushPost(postDataStr, bookname, pagenum, postSeq)
+	pageWatchers.notifyChanged((bookname, pagenum))
+
 # ----------------------------------------------------
 # MAIN
 # ----------------------------------------------------
-	
-# Global Variables
-clientThreadList = []		# Maintain a list of client threads
-BUFFER_SIZE = 1024		# max message size
-MAX_CONNECTIONS = 1		# Num queued connections
-
-# Extract the port number from args
-script, port_number_str = argv
-port_number = int(port_number_str)
-
-# Parse information about the books contained in the 'booklist' file
-# with format: [book folder name],[book author]
-print "Loading booklist..."
-booklist_file = open('booklist','r').read().split('\n')
-booklist_file.remove('')
-booklist = []
-for line in booklist_file:
-	line = line.split(',')
-	booklist.append((line[0], line[1]))
-
-# Load the books into memory
-print "Loading books..."
-books = {}
-for book in booklist:
-	book_dir, book_author = book			# Book_dir is equivalent to book's name
-	books[book_dir] = Book(book_dir, book_author)
-
-# Create the server database
-print "Intitialising database..."
-serverDB = ServerDB()
-
-# DEBUGGING
-#runBookTests()
-#runDBTests()
-#exit()
-
-# Create the clientThreadIterator object
-clientThreadIterator = ClientThreadIterator()
-
-# Create the socket
-serversock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)		# TCP connection
-serversock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)	# re-usable socket
-serversock.bind((socket.gethostname(), port_number))
-serversock.listen(MAX_CONNECTIONS)
-print "Listening on port number:", port_number
-print "Name of this server:",socket.gethostname()
-
-# Prepare the server socket to listen for
-listen_sockets = [serversock]
-while True:
-
-	# Obtain lists of sockets that are listenable
-	read_sockets, write_sockets, error_sockets = select.select(listen_sockets, [], [])
-
-	# Find the socket for the server in the list of ready sockets	
-	for rs in read_sockets:
-	
-		# Incoming connection request to server socket
-		if (rs == serversock):
-			# Accept the client
-			clientsocket, addr = serversock.accept()
-
-			# Create the client thread
-			clientThread = ClientThread(clientsocket, addr)
 
-			# Run the thread
-			clientThread.start()
+# Outbound push queues (configured from the command line)
+PUSH_QUEUE_SIZE = 256
+REPLICA_QUEUE_SIZE = 65536	# posts queued for another node replicating this one
+PUSH_OVERFLOW_POLICY = 'drop-oldest'
+pushCounters = Counters(['queued', 'delivered', 'dropped', 'coalesced', 'disconnected'])
+
+# Request latencies, stream lengths etc. (see ServerMetrics)
+serverMetrics = ServerMetrics()
+
+# Log, written by a background thread (level etc. configured from the command line)
+log = logger.AsyncLogger()
+
+# Full-text index of the lines of the books (see BookSearchIndex), built in the background
+# once they are loaded (unless turned off) - None until then
+bookIndex = None
+bookIndexPending = False
+SEARCH_TERM_PATTERN = re.compile('[a-z0-9]+')
+
+# Bus to the other worker processes (only in a worker of a multi-process server - see BusHub)
+busClient = None
+
+# Server engines, selectable from the command line
+SERVER_ENGINES = { 'threaded': runThreadedServer, 'event': runEventServer }
+
+#Usage: python server_ex.py [port_number] [--engine threaded|event] [--workers N]
+def main():
+
+	# Global var declarations
+	global books, serverDB, clientThreadIterator, pageWatchers
+	global PUSH_QUEUE_SIZE, PUSH_OVERFLOW_POLICY
+
+	# Global Variables
+	MAX_CONNECTIONS = 128		# Num queued connections
+
+	# Extract the port number and options from args
+	parser = argparse.ArgumentParser(description='E-book forum server.')
+	parser.add_argument('port_number', type=int)
+	parser.add_argument('--engine', choices=sorted(SERVER_ENGINES.keys()), default='threaded',
+			help="'threaded' serves each client on its own thread, 'event' serves all clients from one event loop")
+	parser.add_argument('--push-queue-size', type=int, default=PUSH_QUEUE_SIZE,
+			help="maximum number of pushed posts queued for a client that is not keeping up")
+	parser.add_argument('--push-overflow', choices=OutboundQueue.OVERFLOW_POLICIES, default=PUSH_OVERFLOW_POLICY,
+			help="what to do when a client's push queue is full")
+	parser.add_argument('--lazy-books', action='store_true',
+			help="parse each page on first use, keeping parsed pages in a bounded LRU cache")
+	parser.add_argument('--page-cache-size', type=int, default=1024,
+			help="maximum number of parsed pages kept in memory with --lazy-books")
+	parser.add_argument('--book-index', choices=['on', 'off'], default=None,
+			help="index the lines of the books for searching, in the background (default: on, or off with --lazy-books)")
+	parser.add_argument('--id-file', default=None,
+			help="file in which post ID allocation is persisted, so IDs are never reused across restarts")
+	parser.add_argument('--data-dir', default=None,
+			help="directory for the post log and snapshots; posts survive restarts when given")
+	parser.add_argument('--fsync-every', type=int, default=0,
+			help="also fsync the post log after this many posts, under the database lock; 0 (the default) leaves it to the interval")
+	parser.add_argument('--fsync-interval', type=float, default=1.0,
+			help="maximum seconds a logged post may stay unsynced (group commit by the flusher thread)")
+	parser.add_argument('--snapshot-every', type=int, default=10000,
+			help="write a compacted snapshot after this many logged posts; 0 disables snapshots")
+	parser.add_argument('--metrics-file', default=None,
+			help="file to periodically write the server's metrics to, in the Prometheus text format")
+	parser.add_argument('--metrics-interval', type=float, default=10.0,
+			help="seconds between writes of the metrics file")
+	parser.add_argument('--workers', type=int, default=1,
+			help="number of worker processes serving clients (sharing the listening socket); 1 serves them in this process")
+	parser.add_argument('--node-id', type=int, default=0,
+			help="ID of this server among the nodes replicating each other's posts (each needs its own)")
+	parser.add_argument('--peers', default='',
+			help="comma-separated host:port of the nodes to replicate posts from (needs --data-dir or --id-file)")
+	parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'], default='info',
+			help="lowest level of log records written; each request is logged at 'debug'")
+	parser.add_argument('--log-sample', type=float, default=1.0,
+			help="fraction of 'debug' and 'info' log records to keep, for logging a busy server")
+	parser.add_argument('--log-file', default=None,
+			help="file to append the log to, instead of standard output")
+	args = parser.parse_args()
+	if (args.data_dir is not None and args.fsync_every <= 0 and args.fsync_interval <= 0):
+		parser.error("--fsync-every or --fsync-interval must be positive, or the post log is never synced")
+	port_number = args.port_number
+	log.setLevel(logger.LEVELS[args.log_level])
+	log.setSampleRate(args.log_sample)
+	if (args.log_file is not None):
+		log.stream = open(args.log_file, 'a')
+	PUSH_QUEUE_SIZE = args.push_queue_size
+	PUSH_OVERFLOW_POLICY = args.push_overflow
+
+	# Parse information about the books contained in the 'booklist' file
+	# with format: [book folder name],[book author]
+	print "Loading booklist..."
+	booklist_file = open('booklist','r').read().split('\n')
+	booklist_file.remove('')
+	booklist = []
+	for line in booklist_file:
+		line = line.split(',')
+		booklist.append((line[0], line[1]))
+
+	# Load the books into memory (or prepare to load their pages on demand)
+	print "Loading books..."
+	pageCache = None
+	if (args.lazy_books):
+		pageCache = PageCache(args.page_cache_size)
+	books = {}
+	for book in booklist:
+		book_dir, book_author = book			# Book_dir is equivalent to book's name
+		books[book_dir] = Book(book_dir, book_author, pageCache)
+
+	# Index the lines of the books for searching, once serving has started (parsing every page
+	# would defeat loading them lazily, so only if asked to then)
+	indexedBooks = []
+	if (args.book_index == 'on' or (args.book_index is None and not args.lazy_books)):
+		indexedBooks = [ book[0] for book in booklist ]
+		print "Indexing books in the background..."
+
+	# Create the server database
+	print "Intitialising database..."
+	postLog = None
+	idStateFile = args.id_file
+	if (args.data_dir is not None):
+		postLog = PostLog(args.data_dir, args.fsync_every, args.fsync_interval, args.snapshot_every)
+		if (idStateFile is None):
+			idStateFile = os.path.join(args.data_dir, 'post_id_ceiling')
+	if (args.node_id < 0 or args.node_id > ServerDB.MAX_NODE_ID):
+		parser.error("--node-id must be between 0 and %d" % ServerDB.MAX_NODE_ID)
+	if (args.peers != '' and idStateFile is None):
+		parser.error("--peers needs --data-dir or --id-file, so post IDs are never reused across restarts")
+	serverDB = ServerDB(idStateFile, postLog, args.node_id)
+
+	# Recover the posts from before the restart
+	if (postLog is not None):
+		print "Recovering posts from '%s'..." % args.data_dir
+		startTime = time.time()
+		numFromSnapshot, numFromLog = postLog.recover(serverDB.restorePost)
+		elapsed = max(time.time() - startTime, 1e-6)
+		print "Recovered %d posts (%d from snapshot, %d from log) in %.3fs: %.0f posts/sec" % \
+			(numFromSnapshot + numFromLog, numFromSnapshot, numFromLog, elapsed, \
+			(numFromSnapshot + numFromLog) / elapsed)
+
+	# DEBUGGING
+	#runBookTests()
+	#runDBTests()
+	#exit()
+
+	# Create the clientThreadIterator object
+	clientThreadIterator = ClientThreadIterator()
+
+	# Clients waiting for new posts on a page
+	pageWatchers = PageWatchers(serverDB.getPageVersion)
+
+	# Create the socket
+	serversock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)		# TCP connection
+	serversock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)	# re-usable socket
+	serversock.bind((socket.gethostname(), port_number))
+	serversock.listen(MAX_CONNECTIONS)
+	print "Listening on port number:", port_number
+	print "Name of this server:",socket.gethostname()
+	print "Server engine:", args.engine
+
+	# Dump the metrics periodically
+	if (args.metrics_file is not None):
+		print "Writing metrics to '%s' every %gs." % (args.metrics_file, args.metrics_interval)
+
+	# Peers to replicate posts from
+	peerAddrs = []
+	for peer in args.peers.split(','):
+		if (peer != ''):
+			peerHost, peerPort = peer.rsplit(':', 1)
+			peerAddrs.append((peerHost, int(peerPort)))
+
+	# Serve clients with the chosen engine - in this process, or in worker processes joined by a bus
+	# NOTE: Posts are replicated by the bus hub, so a node with peers runs at least one worker
+	hub = None
+	try:
+		if (args.workers > 1 or len(peerAddrs) > 0):
+			print "Worker processes:", max(args.workers, 1)
+			hub = BusHub(max(args.workers, 1), lambda workerIndex, busSock: runWorker(workerIndex, busSock, serversock, \
+					args.engine, args.metrics_file, args.metrics_interval, indexedBooks))
+			if (len(peerAddrs) > 0):
+				print "Node %d replicating posts from: %s" % (args.node_id, args.peers)
+				replicator = Replicator(hub.loop, args.node_id, peerAddrs, hub.insertReplicatedPost)
+				hub.loop.callLater(0, replicator.start)
+			hub.run()
+		else:
+			if (args.metrics_file is not None):
+				MetricsWriter(args.metrics_file, args.metrics_interval).start()
+			if (len(indexedBooks) > 0):
+				startIndexingBooks(indexedBooks)
+			SERVER_ENGINES[args.engine](serversock)
+	finally:
+		if (hub is not None):
+			hub.stop()
+		serversock.close()
+		if (postLog is not None):
+			postLog.close()
+		log.close()
 
-			# Add to list of client threads
-			clientThreadIterator.addClientThread(clientThread)
-serversock.close()
+# ----------------------------------------------------
+# RUNNING MAIN
+# ----------------------------------------------------
+if (__name__ == "__main__"):
+	main()
@@ -0,0 +1,5 @@
+#!/usr/bin/sh
+
+# Simulate many readers headlessly against the local server (options: reader/loadgen.py --help)
+cd reader
+python loadgen.py localhost 25001 "$@"